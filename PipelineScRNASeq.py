@@ -14,26 +14,309 @@ Code
 '''
 
 import collections
+import hashlib
+import heapq
+import itertools
 import CGATPipelines.Pipeline as P
 import CGAT.IOTools as IOTools
+import CGAT.Experiment as E
 import CGAT.Counts as Counts
 import pysam
 import pandas as pd
 import numpy as np
+import scipy.sparse as sparse
+import scipy.cluster.hierarchy as hierarchy
+from scipy.spatial.distance import squareform
 import glob
-import regex
 import re
 from CGATPipelines.Pipeline import cluster_runnable
 import os
-import CGAT.Fastq as Fastq
+import zlib
+import struct
 from rpy2.robjects import r as R
 from rpy2.robjects import pandas2ri
 import pandas.rpy.common as com
 import rpy2.robjects as robjects
 
 
+def readFastqChunk(infile, nreads):
+    ''' Read the next nreads fastq records from infile as a list of lines,
+    without format checks. Returns an empty list at the end of the file '''
+
+    return list(itertools.islice(infile, 4 * nreads))
+
+
+def qualityArray(qual_lines, length, offset=33):
+    ''' Convert the first length bases of each of a list of quality
+    strings into an (n, length) numpy array of phred scores. Short quality
+    strings are padded with scores of 0 '''
+
+    quals = "".join(qual[:length].ljust(length, chr(offset))
+                    for qual in qual_lines)
+    quals = np.frombuffer(quals, dtype=np.uint8).reshape(-1, length)
+
+    return quals.astype(np.int16) - offset
+
+
+def filterFastqChunk(seq_lines, UMI_lines, barcodes):
+    ''' Filter a chunk of paired fastq records as described for
+    extractUMIsAndFilterFastq.
+
+    seq_lines and UMI_lines are lists of the lines of the same reads from
+    the genomic and barcode/UMI fastqs and barcodes is a set of accepted cell
+    barcodes. Returns a dictionary of the formatted output records for each
+    cell, in read order, and a Counter of the filtering results '''
+
+    counts = collections.Counter()
+    cell_records = collections.defaultdict(list)
+
+    seq_ids = seq_lines[0::4]
+    UMI_seqs = UMI_lines[1::4]
+    UMI_ids = UMI_lines[0::4]
+
+    assert len(seq_ids) == len(UMI_ids), (
+        "fastq files contain different numbers of reads")
+
+    quals = qualityArray(UMI_lines[3::4], 16)
+    barcode_pass = quals[:, 0:6].min(axis=1) >= 10
+    UMI_pass = quals[:, 6:16].min(axis=1) >= 30
+
+    counts["barcode_quality_fail"] = int((~barcode_pass).sum())
+    counts["UMI_quality_fail"] = int((barcode_pass & ~UMI_pass).sum())
+
+    for i in np.flatnonzero(barcode_pass & UMI_pass):
+
+        # check both records are for the same fastq read
+        assert (seq_ids[i].split(" ")[0].strip() ==
+                UMI_ids[i].split(" ")[0].strip()), (
+            "fastq read names do not match")
+
+        cell = UMI_seqs[i][0:6]
+
+        if cell not in barcodes:
+            counts["barcode_match_fail"] += 1
+            continue
+
+        counts["keep"] += 1
+        UMI = UMI_seqs[i][6:16]
+        identifier = seq_ids[i][:-1].replace(" ", ":")
+        cell_records[cell].append("%s_%s\n%s+\n%s" % (
+            identifier, UMI, seq_lines[4*i + 1], seq_lines[4*i + 3]))
+
+    return cell_records, counts
+
+
+def tagFastqRecords(block, cell):
+    ''' Insert the cell barcode into the read names of a block of fastq
+    records named <read id>_<UMI>, giving <read id>_<cell>_<UMI> as
+    expected by umi_tools dedup --per-cell '''
+
+    lines = block.split("\n")
+
+    # block ends with a newline so the last item is empty
+    for i in range(0, len(lines) - 1, 4):
+        read_id, UMI = lines[i].rsplit("_", 1)
+        lines[i] = "%s_%s_%s" % (read_id, cell, UMI)
+
+    return "\n".join(lines)
+
+
+# set in each worker process by _initChunkWorker
+_chunk_filter = None
+_chunk_filter_args = None
+
+
+def _initChunkWorker(filter_function, filter_args):
+    global _chunk_filter
+    global _chunk_filter_args
+    _chunk_filter = filter_function
+    _chunk_filter_args = filter_args
+
+
+def _filterChunkWorker(chunk):
+    seq_lines, UMI_lines = chunk
+    return _chunk_filter(seq_lines, UMI_lines, *_chunk_filter_args)
+
+
+def mapFastqChunks(fastq_seq, fastq_UMI, filter_function, filter_args,
+                   chunk_size=100000, processes=1):
+    ''' Split a pair of open fastq files into chunks of chunk_size read
+    pairs and apply filter_function(seq_lines, UMI_lines, \*filter_args) to
+    each chunk. filter_function must be defined at the top level of the
+    module.
+
+    If processes is greater than 1, chunks are filtered in a pool of
+    processes. Results are always yielded in the order of the chunks in
+    the files, so that output is the same whatever the number of
+    processes '''
+
+    def _chunks():
+        while True:
+            seq_lines = readFastqChunk(fastq_seq, chunk_size)
+            UMI_lines = readFastqChunk(fastq_UMI, chunk_size)
+            if not seq_lines and not UMI_lines:
+                break
+            yield seq_lines, UMI_lines
+
+    if processes is None or processes <= 1:
+        for seq_lines, UMI_lines in _chunks():
+            yield filter_function(seq_lines, UMI_lines, *filter_args)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes,
+                                initializer=_initChunkWorker,
+                                initargs=(filter_function, filter_args))
+
+    # ordered imap keeps chunks in file order
+    for result in pool.imap(_filterChunkWorker, _chunks()):
+        yield result
+
+    pool.close()
+    pool.join()
+
+
+# largest amount of data in a single BGZF block, as used by samtools
+BGZF_BLOCK_SIZE = 65280
+
+# the empty block that marks the end of a BGZF file
+BGZF_EOF = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def compressBGZFBlock(data, compresslevel=6):
+    ''' Compress up to BGZF_BLOCK_SIZE bytes of data into a BGZF block.
+    A BGZF file is a series of gzip members, each with the size of the
+    member recorded in an extra field, so can be read by anything that
+    reads gzip. '''
+
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+
+    header = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" +
+              struct.pack("<H", 6) + "BC" + struct.pack("<H", 2) +
+              struct.pack("<H", len(compressed) + 25))
+
+    return (header + compressed +
+            struct.pack("<I", zlib.crc32(data) & 0xffffffff) +
+            struct.pack("<I", len(data)))
+
+
+class CellFastqWriter(object):
+    ''' Write records to a gzip compressed (BGZF) fastq file for each
+    cell.
+
+    Records are held in a buffer for each cell. When the total size of the
+    buffers exceeds buffer_size bytes, the largest buffers are compressed
+    in BGZF blocks by a pool of threads and written out. At most max_open
+    files are held open at once, the least recently used file being closed
+    when another needs to be opened. The files are completed when close is
+    called. '''
+
+    def __init__(self, output_pattern, buffer_size=200000000, threads=1,
+                 max_open=256, compresslevel=6):
+
+        self.output_pattern = output_pattern
+        self.buffer_size = buffer_size
+        self.max_open = max_open
+        self.compresslevel = compresslevel
+
+        self.buffers = collections.defaultdict(list)
+        self.buffer_sizes = collections.Counter()
+        self.buffered = 0
+
+        self.open_files = collections.OrderedDict()
+        self.created = set()
+
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(threads)
+        else:
+            self.pool = None
+
+    def write(self, cell, data):
+
+        self.buffers[cell].append(data)
+        self.buffer_sizes[cell] += len(data)
+        self.buffered += len(data)
+
+        if self.buffered > self.buffer_size:
+            # flush the largest buffers until half the budget is free
+            to_flush = []
+            remaining = self.buffered
+            for cell, size in self.buffer_sizes.most_common():
+                if remaining <= self.buffer_size // 2:
+                    break
+                to_flush.append(cell)
+                remaining -= size
+
+            self.flush(to_flush)
+
+    def _getFile(self, cell):
+
+        if cell in self.open_files:
+            outf = self.open_files.pop(cell)
+        else:
+            if len(self.open_files) >= self.max_open:
+                lru_cell, lru_file = self.open_files.popitem(last=False)
+                lru_file.close()
+
+            if cell in self.created:
+                outf = open(self.output_pattern % cell, "ab")
+            else:
+                outf = open(self.output_pattern % cell, "wb")
+                self.created.add(cell)
+
+        # keep most recently used at the end
+        self.open_files[cell] = outf
+        return outf
+
+    def flush(self, cells=None):
+        ''' Compress and write out the buffers for cells, or all cells if
+        cells is None '''
+
+        if cells is None:
+            cells = self.buffers.keys()
+
+        blocks = []
+        for cell in cells:
+            data = "".join(self.buffers.pop(cell))
+            self.buffered -= self.buffer_sizes.pop(cell)
+            for start in range(0, len(data), BGZF_BLOCK_SIZE):
+                blocks.append((cell, data[start:start + BGZF_BLOCK_SIZE]))
+
+        def _compress(block):
+            return compressBGZFBlock(block[1], self.compresslevel)
+
+        if self.pool:
+            compressed = self.pool.map(_compress, blocks)
+        else:
+            compressed = map(_compress, blocks)
+
+        for (cell, data), block in zip(blocks, compressed):
+            self._getFile(cell).write(block)
+
+    def close(self):
+
+        self.flush()
+
+        for outf in self.open_files.values():
+            outf.close()
+        self.open_files = collections.OrderedDict()
+
+        for cell in self.created:
+            with open(self.output_pattern % cell, "ab") as outf:
+                outf.write(BGZF_EOF)
+
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
 @cluster_runnable
-def extractUMIsAndFilterFastq(fastq_seq, fastq_UMI, barcodes):
+def extractUMIsAndFilterFastq(fastq_seq, fastq_UMI, barcodes,
+                              chunk_size=100000, processes=1,
+                              tagged=False):
     '''
     Paired end sequencing:
     read 1 - cell barcode (6bp) then UMI (10bp)
@@ -48,100 +331,174 @@ def extractUMIsAndFilterFastq(fastq_seq, fastq_UMI, barcodes):
     4. write out to single cell fastq using barcode as identifier
 
     Filtering performed here mirrors filtering used by Soumillon et al 2014
+
+    Reads are processed chunk_size pairs at a time, with quality checks
+    done on the whole chunk at once and the output for each cell written
+    in one go. If processes is greater than 1, chunks are filtered in
+    parallel, but output order is unchanged. A summary of the filtering is
+    written to <prefix>_filter_summary.tsv
+
+    If tagged is True, the reads for all cells are instead written to a
+    single fastq, <prefix>_tagged.fastq.gz, with the cell barcode and UMI
+    appended to the read name (<read id>_<cell>_<UMI>), so that the run
+    can be mapped and deduplicated in one go (umi_tools dedup --per-cell)
+    and counted per cell with countAlignmentsPerGenePerCell. The summary
+    is then written to <prefix>_tagged_filter_summary.tsv, so that the
+    tagged and per-cell runs do not overwrite each other's summaries
     '''
     # TS - expected location of UMI and barcode is hard-coded in here...
 
     out_prefix = P.snip(fastq_UMI, "_1.fastq.gz")
-    out_prefix_base = os.path.basename(out_prefix)
+
+    if tagged:
+        log_prefix = out_prefix + "_tagged"
+    else:
+        log_prefix = out_prefix
 
     fastq = IOTools.openFile(fastq_seq, "r")
     UMI_fastq = IOTools.openFile(fastq_UMI, "r")
 
-    def FastqNext(infile):
-        ''' get next fastq entry in file - without format checks'''
-        line1 = infile.readline()
-        if not line1:
-            return None
-        line2 = infile.readline()
-        line3 = infile.readline()
-        line4 = infile.readline()
-
-        return Fastq.Record(line1[1:-1], line2[:-1], line4[:-1])
+    barcodes = set(barcodes)
+    counts = collections.Counter()
 
-    record = FastqNext(fastq)
-    UMI_record = FastqNext(UMI_fastq)
+    if tagged:
+        fastq_outfiles = CellFastqWriter(out_prefix + "_%s.fastq.gz",
+                                         threads=processes)
+    else:
+        fastq_outfiles = CellFastqWriter(out_prefix + "_UMI_%s.fastq.gz",
+                                         threads=processes)
+
+    for cell_records, chunk_counts in mapFastqChunks(
+            fastq, UMI_fastq, filterFastqChunk, (barcodes,),
+            chunk_size, processes):
+
+        counts.update(chunk_counts)
+        for cell, records in cell_records.iteritems():
+            if tagged:
+                fastq_outfiles.write(
+                    "tagged", tagFastqRecords("".join(records), cell))
+            else:
+                fastq_outfiles.write(cell, "".join(records))
 
-    def getReadName(record):
-        return record.identifier.split(" ")[0]
+    fastq_outfiles.close()
 
-    counts = collections.Counter()
-    outfs = set()
+    with IOTools.openFile(log_prefix + "_filter_summary.tsv", "w") as outf:
+        outf.write("category\tcount\n")
+        for category in ("barcode_quality_fail", "UMI_quality_fail",
+                         "barcode_match_fail", "keep"):
+            outf.write("%s\t%i\n" % (category, counts[category]))
 
-    # use IOTools.FilePool class to open multiple file handles
-    fastq_outfiles = IOTools.FilePool(
-        output_pattern=out_prefix + "_UMI_%s.fastq.gz")
 
-    while record is not None:
-        # check both records are for the same fastq read
-        assert getReadName(record) == getReadName(record), (
-            "fastq read names do not match")
+def alignmentsPerReference(bamfile, mapq_threshold=0, chunk_size=1000000):
+    ''' Return a numpy array of the number of mapped alignments to each
+    reference in bamfile with a mapq of at least mapq_threshold.
 
-        UMI_record.format = "illumina-1.8"
+    If mapq_threshold is 0 the counts are taken from the bam index
+    statistics without reading the alignments. Otherwise, or if the bam is
+    not indexed, the reference ids, mapqs and flags are read chunk_size
+    alignments at a time into numpy arrays and counted with bincount '''
 
-        # check quality of barcode
-        if not min(UMI_record.toPhred()[0:6]) >= 10:
-            counts["barcode_quality_fail"] += 1
+    insam = pysam.Samfile(bamfile, "rb")
+    nreferences = len(insam.references)
 
+    if mapq_threshold == 0:
+        try:
+            stats = insam.get_index_statistics()
+        except ValueError:
+            E.debug("%s is not indexed, reading all alignments" % bamfile)
         else:
-            # check quality of UMI
-            if not min(UMI_record.toPhred()[6:16]) >= 30:
-                counts["UMI_quality_fail"] += 1
+            counts = np.zeros(nreferences, dtype=np.int64)
+            for stat in stats:
+                counts[insam.get_tid(stat.contig)] = stat.mapped
+            insam.close()
+            return counts
+
+    counts = np.zeros(nreferences, dtype=np.int64)
+    inreads = insam.fetch(until_eof=True)
+
+    while True:
+        chunk = [(read.reference_id, read.mapping_quality, read.flag)
+                 for read in itertools.islice(inreads, chunk_size)]
+        if not chunk:
+            break
 
-            else:
-                # check barcode matches supplied barcodes
-                if not any(UMI_record.seq[0:6] == barcode
-                           for barcode in barcodes):
-                    counts["barcode_match_fail"] += 1
+        chunk = np.array(chunk, dtype=np.int32)
+        keep = ((chunk[:, 2] & 4) == 0) & (chunk[:, 1] >= mapq_threshold)
 
-                else:
-                    counts["keep"] += 1
-                    cell = UMI_record.seq[0:6]
-                    UMI = UMI_record.seq[6:16]
-                    record.identifier = record.identifier.replace(" ", ":") + "_" + UMI
-                    outfs.update((cell,))
-                    fastq_outfiles.write(cell, "%s\n" % record)
+        counts += np.bincount(chunk[keep, 0], minlength=nreferences)
 
-        record = FastqNext(fastq)
-        UMI_record = FastqNext(UMI_fastq)
+    insam.close()
+
+    return counts
 
 
 @cluster_runnable
-def countAlignmentsPerGene(infile, outfile, mapq_threshold=0):
-    ''' count the number of reads aligning to each contig(gene) in bam '''
-    # bash one-liner using cut|uniq -c would be
-    # much quicker but the zero counts would be lost.
+def countAlignmentsPerGene(infile, outfile, mapq_threshold=0,
+                           chunk_size=1000000):
+    ''' count the number of reads aligning to each contig(gene) in bam
+
+    If infile is a list of bams, a table with a header and a column of
+    counts for each bam is written instead, with the bams named by their
+    filenames without the .bam suffix. All the bams must have been aligned
+    to the same references.
+
+    See alignmentsPerReference '''
+
+    if isinstance(infile, basestring):
+        references = pysam.Samfile(infile, "rb").references
+        counts = alignmentsPerReference(infile, mapq_threshold, chunk_size)
+
+        with IOTools.openFile(outfile, "w") as f:
+            for n in np.argsort(-counts, kind="mergesort"):
+                f.write("%s\t%s\n" % (references[n], counts[n]))
+
+        return
+
+    references = pysam.Samfile(infile[0], "rb").references
+    counts = [alignmentsPerReference(bamfile, mapq_threshold, chunk_size)
+              for bamfile in infile]
+    names = [P.snip(os.path.basename(bamfile), ".bam") for bamfile in infile]
+
+    with IOTools.openFile(outfile, "w") as f:
+        f.write("gene\t%s\n" % "\t".join(names))
+        for n, reference in enumerate(references):
+            f.write("%s\t%s\n" % (
+                reference, "\t".join(str(x[n]) for x in counts)))
+
+
+@cluster_runnable
+def countAlignmentsPerGenePerCell(infile, outfile, mapq_threshold=0):
+    ''' count the number of reads aligning to each contig(gene) for each
+    cell in a single pass through a bam containing the reads for all the
+    cells, with read names <read id>_<cell>_<UMI> (see the tagged option
+    of the UMI extraction functions). Writes a gene x cell table of counts
+    in the same format as getGeneCounts, with a sparse copy '''
 
-    counts = collections.Counter()
     insam = pysam.Samfile(infile, "rb")
     references = insam.references
-    references_dict = {}
-
-    for n, reference in enumerate(references):
-        references_dict[n] = reference
-        counts[reference] = 0
 
-    inreads = insam.fetch()
+    # (reference_id, cell) -> count
+    counts = collections.Counter()
 
-    for read in inreads:
+    for read in insam.fetch(until_eof=True):
         if read.is_unmapped:
             continue
         if read.mapq < mapq_threshold:
             continue
-        counts[references_dict[read.reference_id]] += 1
+        cell = read.query_name.rsplit("_", 2)[1]
+        counts[(read.reference_id, cell)] += 1
 
-    with IOTools.openFile(outfile, "w") as f:
-        for k, v in counts.most_common():
-            f.write("%s\t%s\n" % (k, v))
+    insam.close()
+
+    cells = sorted(set(cell for reference_id, cell in counts))
+    cell_positions = dict((cell, n) for n, cell in enumerate(cells))
+
+    gene_index = [reference_id for reference_id, cell in counts]
+    cell_index = [cell_positions[cell] for reference_id, cell in counts]
+
+    counts = SparseCounts.fromTriplets(
+        gene_index, cell_index, counts.values(), references, cells)
+    counts.writeTable(outfile)
 
 
 @cluster_runnable
@@ -266,24 +623,502 @@ def mergeAndPlotEditDistances(infiles, outfile, plot_out):
     plot_edit_distances(r_df)
 
 
-@cluster_runnable
-def getGeneCounts(infiles, outfile):
+def sparseCountsFilename(infile):
+    ''' Return the filename of the sparse matrix stored alongside a gene
+    counts table (see SparseCounts) '''
 
-    df = pd.DataFrame()
+    return re.sub("\.tsv(\.gz)?$", "", infile) + ".npz"
 
-    for infile in infiles:
-        temp_df = pd.io.parsers.read_csv(
-            infile, sep="\t", index_col=0, names=["counts"])
 
-        cell = re.sub(".*_UMI_", "", infile).replace(
-            "_deduped", "").replace(
-            ".trans.gene.counts.tsv", "")
-        temp_df.index = temp_df.index
-        temp_df.sort_index(inplace=True)
-        temp_df.index.names = ['gene']
-        df[cell] = temp_df["counts"]
+class SparseCounts(object):
+    ''' A gene x cell count matrix held as a compressed sparse column
+    (CSC) matrix, with arrays of the gene and cell names.
+
+    Most entries of a single cell count matrix are zero, so the matrix is
+    built, filtered, normalised and summarised without ever being made
+    dense. It is saved as a numpy .npz file holding the CSC arrays (data,
+    indices, indptr, shape) and the gene and cell names, which is written
+    next to the tab separated table for each stage (see writeTable and
+    readCounts). '''
+
+    def __init__(self, matrix, genes, cells):
+
+        self.matrix = sparse.csc_matrix(matrix)
+        self.genes = list(genes)
+        self.cells = list(cells)
+
+        assert self.matrix.shape == (len(self.genes), len(self.cells)), (
+            "matrix shape does not match the number of genes and cells")
+
+    @classmethod
+    def fromTriplets(cls, gene_index, cell_index, counts, genes, cells):
+        ''' Build a matrix from arrays of the gene index, cell index and
+        count of each non-zero entry. Genes are sorted by name '''
+
+        matrix = sparse.csc_matrix(
+            (counts, (gene_index, cell_index)),
+            shape=(len(genes), len(cells)), dtype=np.int64)
+
+        return cls(matrix, genes, cells).sortGenes()
+
+    @classmethod
+    def fromCountFiles(cls, infiles, cells):
+        ''' Build a matrix in one go from per cell counts files with gene
+        and count columns and no header (see countAlignmentsPerGene).
+        cells gives the name of the cell for each file '''
+
+        gene_positions = {}
+        gene_index = []
+        cell_index = []
+        counts = []
+
+        for n, infile in enumerate(infiles):
+            with IOTools.openFile(infile, "r") as inf:
+                for line in inf:
+                    gene, count = line[:-1].split("\t")
+                    if gene not in gene_positions:
+                        gene_positions[gene] = len(gene_positions)
+                    count = int(count)
+                    if count == 0:
+                        continue
+                    gene_index.append(gene_positions[gene])
+                    cell_index.append(n)
+                    counts.append(count)
+
+        genes = sorted(gene_positions, key=gene_positions.get)
+
+        return cls.fromTriplets(gene_index, cell_index, counts, genes, cells)
+
+    @classmethod
+    def fromDataFrame(cls, df):
+        return cls(sparse.csc_matrix(df.values), df.index, df.columns)
+
+    @classmethod
+    def load(cls, filename):
+
+        data = np.load(filename)
+        matrix = sparse.csc_matrix(
+            (data["data"], data["indices"], data["indptr"]),
+            shape=tuple(data["shape"]))
+
+        return cls(matrix, data["genes"].tolist(), data["cells"].tolist())
+
+    def save(self, filename):
+
+        # np.savez appends .npz to filenames without it, so pass a file
+        with open(filename, "wb") as outf:
+            np.savez(outf,
+                     data=self.matrix.data,
+                     indices=self.matrix.indices,
+                     indptr=self.matrix.indptr,
+                     shape=np.array(self.matrix.shape),
+                     genes=np.array(self.genes),
+                     cells=np.array(self.cells))
+
+    def writeTable(self, outfile, rows_per_block=1000):
+        ''' Write the matrix to outfile as a tab separated gene x cell
+        table, and save it alongside as a sparse matrix. The table is
+        made dense a block of rows_per_block genes at a time. The sparse
+        matrix is saved after the table, so that it is newer than the
+        table (see readCounts) '''
+
+        matrix = self.matrix.tocsr()
+
+        with IOTools.openFile(outfile, "w") as outf:
+            outf.write("gene\t%s\n" % "\t".join(self.cells))
+            for start in range(0, len(self.genes), rows_per_block):
+                block = matrix[start:start + rows_per_block].toarray()
+                for gene, row in zip(self.genes[start:], block):
+                    outf.write("%s\t%s\n" % (gene, "\t".join(map(str, row))))
+
+        self.save(sparseCountsFilename(outfile))
+
+    def toDataFrame(self):
+
+        df = pd.DataFrame(self.matrix.toarray(),
+                          index=self.genes, columns=self.cells)
+        df.index.names = ['gene']
+
+        return df
+
+    def sortGenes(self):
+        ''' Return a copy with the genes sorted by name '''
+
+        order = sorted(range(len(self.genes)), key=self.genes.__getitem__)
+
+        return SparseCounts(self.matrix.tocsr()[order],
+                            [self.genes[x] for x in order], self.cells)
+
+    def reindexGenes(self, genes):
+        ''' Return a copy with the rows for genes, in that order. Genes
+        that are not in the matrix have counts of zero '''
+
+        positions = dict((gene, n) for n, gene in enumerate(genes))
+        keep = np.array([gene in positions for gene in self.genes],
+                        dtype=bool)
+        mapping = np.array([positions.get(gene, -1) for gene in self.genes],
+                           dtype=np.int64)
+
+        coo = self.matrix.tocoo()
+        keep = keep[coo.row]
+
+        matrix = sparse.csc_matrix(
+            (coo.data[keep], (mapping[coo.row[keep]], coo.col[keep])),
+            shape=(len(genes), len(self.cells)))
+
+        return SparseCounts(matrix, genes, self.cells)
+
+    def concat(self, others):
+        ''' Return a matrix with the cells of this matrix and each of
+        others, over the union of their genes '''
+
+        matrices = [self] + list(others)
+
+        genes = set()
+        for counts in matrices:
+            genes.update(counts.genes)
+        genes = sorted(genes)
+
+        reindexed = [counts.reindexGenes(genes) for counts in matrices]
+
+        return SparseCounts(
+            sparse.hstack([counts.matrix for counts in reindexed]),
+            genes, sum([counts.cells for counts in reindexed], []))
+
+    def subsetGenes(self, keep):
+        ''' Return a copy with only the genes where keep is True '''
+
+        keep = np.asarray(keep, dtype=bool)
+
+        return SparseCounts(self.matrix.tocsr()[np.flatnonzero(keep)],
+                            [gene for gene, k in zip(self.genes, keep) if k],
+                            self.cells)
+
+    def subsetCells(self, keep):
+        ''' Return a copy with only the cells where keep is True, or the
+        named cells, in the order given, if keep is a list of names '''
+
+        if len(keep) and isinstance(keep[0], basestring):
+            positions = dict((cell, n) for n, cell in enumerate(self.cells))
+            columns = [positions[cell] for cell in keep]
+        else:
+            columns = np.flatnonzero(np.asarray(keep, dtype=bool))
+
+        return SparseCounts(self.matrix[:, columns], self.genes,
+                            [self.cells[x] for x in columns])
+
+    def dropGenes(self, genes):
+        ''' Return a copy without the given genes '''
+
+        genes = set(genes)
+        return self.subsetGenes([gene not in genes for gene in self.genes])
+
+    def removeObservationsFreq(self, min_counts_per_row=1):
+        ''' Return a copy without the genes that have fewer than
+        min_counts_per_row counts in every cell '''
+
+        max_counts = self.matrix.max(axis=1).toarray().ravel()
+        return self.subsetGenes(max_counts >= min_counts_per_row)
+
+    def sizeFactors(self):
+        ''' Return a numpy array of the total counts for each cell '''
+
+        return np.asarray(self.matrix.sum(axis=0)).ravel()
+
+    def normalise(self, method="total-count"):
+        ''' Return a copy with the counts for each cell scaled by its total
+        count:
+
+        total-count - to the mean total count over all cells
+        total-column - to a total of 1
+        million-counts - to a total of one million
+
+        Cells without any counts are left as zero '''
+
+        size_factors = self.sizeFactors().astype(np.float64)
+
+        if method == "total-count":
+            target = size_factors.mean()
+        elif method == "total-column":
+            target = 1.0
+        elif method == "million-counts":
+            target = 1000000.0
+        else:
+            raise ValueError("unknown normalisation method: %s" % method)
+
+        scale = np.zeros(len(size_factors))
+        nonzero = size_factors > 0
+        scale[nonzero] = target / size_factors[nonzero]
+
+        return SparseCounts(self.matrix.dot(sparse.diags(scale, 0)),
+                            self.genes, self.cells)
+
+    def meanAndCV(self):
+        ''' Return numpy arrays of the mean and the coefficient of variation
+        (population standard deviation / mean) of each gene '''
+
+        ncells = float(len(self.cells))
+
+        mean = np.asarray(self.matrix.sum(axis=1)).ravel() / ncells
+        mean_square = np.asarray(
+            self.matrix.multiply(self.matrix).sum(axis=1)).ravel() / ncells
+        variance = np.maximum(mean_square - mean ** 2, 0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cv = np.sqrt(variance) / mean
+
+        return mean, cv
+
+
+def meanAndCVByMethod(matrices):
+    ''' Compute the mean and CV of each gene for each of a list of
+    SparseCounts (e.g. one for each dedup method) at once.
+
+    The matrices are aligned on the genes present in all of them and
+    stacked side by side. The per matrix means of the counts and of the
+    squared counts are then each a single product with a sparse matrix
+    that averages the cells of each matrix.
+
+    Returns the list of shared genes, and numpy arrays (genes x matrices)
+    of the means and CVs (population standard deviation / mean) '''
+
+    genes = set(matrices[0].genes)
+    for counts in matrices[1:]:
+        genes.intersection_update(counts.genes)
+    genes = sorted(genes)
+
+    stacked = sparse.hstack(
+        [counts.reindexGenes(genes).matrix for counts in matrices]).tocsr()
+
+    ncells = np.array([len(counts.cells) for counts in matrices])
+    total_cells = ncells.sum()
+
+    averager = sparse.csr_matrix(
+        (1.0 / np.repeat(ncells, ncells),
+         (np.arange(total_cells),
+          np.repeat(np.arange(len(matrices)), ncells))),
+        shape=(total_cells, len(matrices)))
+
+    mean = stacked.dot(averager).toarray()
+    mean_square = stacked.multiply(stacked).dot(averager).toarray()
+    variance = np.maximum(mean_square - mean ** 2, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cv = np.sqrt(variance) / mean
+
+    return genes, mean, cv
+
+
+def readCounts(infile):
+    ''' Read a gene x cell counts table as a SparseCounts, from the sparse
+    matrix saved alongside it if there is one that is at least as new as
+    the table. An older sparse matrix is ignored, as the table may have
+    been rewritten since '''
+
+    sparse_file = sparseCountsFilename(infile)
+
+    if (os.path.exists(sparse_file) and
+            os.path.getmtime(sparse_file) >= os.path.getmtime(infile)):
+        return SparseCounts.load(sparse_file)
+
+    return SparseCounts.fromDataFrame(
+        pd.read_csv(IOTools.openFile(infile, "r"), sep="\t", index_col=0))
+
+
+def randomizedPCA(matrix, n_components=10, n_oversamples=10, n_iter=4,
+                  seed=1):
+    ''' Principal components of the rows (observations) of matrix, using a
+    randomized truncated SVD (Halko et al 2011) of the column centred
+    matrix, so only the first n_components are computed.
+
+    The range of the matrix is found from its product with a random
+    gaussian matrix of n_components + n_oversamples columns, refined by
+    n_iter power iterations. seed fixes the random matrix so results are
+    reproducible. The sign of each component is fixed so that its largest
+    loading is positive.
+
+    Returns numpy arrays of the scores (observations x components), the
+    loadings (variables x components) and the proportion of the total
+    variance explained by each component, as for prcomp '''
+
+    matrix = np.asarray(matrix, dtype=np.float64)
+    matrix = matrix - matrix.mean(axis=0)
+
+    nrows, ncols = matrix.shape
+    n_components = min(n_components, nrows, ncols)
+    n_random = min(n_components + n_oversamples, nrows, ncols)
+
+    random_state = np.random.RandomState(seed)
+    Q = np.linalg.qr(matrix.dot(
+        random_state.normal(size=(ncols, n_random))))[0]
+
+    for i in range(n_iter):
+        Q = np.linalg.qr(matrix.T.dot(Q))[0]
+        Q = np.linalg.qr(matrix.dot(Q))[0]
+
+    U, s, Vt = np.linalg.svd(Q.T.dot(matrix), full_matrices=False)
+    U = Q.dot(U[:, :n_components])
+    s = s[:n_components]
+    Vt = Vt[:n_components]
+
+    signs = np.sign(Vt[np.arange(n_components),
+                       np.abs(Vt).argmax(axis=1)])
+    U *= signs
+    Vt *= signs[:, np.newaxis]
+
+    # total variance is the sum of the variance of every component
+    variance_explained = s ** 2 / (matrix ** 2).sum()
+
+    return U * s, Vt.T, variance_explained
+
+
+def runPCA(df, n_components=10, seed=1):
+    ''' PCA of the cells (columns) of a gene x cell DataFrame, as
+    prcomp(t(df), center=TRUE) but only for the first n_components (see
+    randomizedPCA).
+
+    Returns DataFrames of the PCs for each cell and the loadings for each
+    gene, with columns PC1, PC2..., and the variance explained by each PC
+    with columns Variance_explained and PC '''
+
+    scores, loadings, variance_explained = randomizedPCA(
+        df.values.T, n_components, seed=seed)
+
+    PCs = ["PC%i" % (x + 1) for x in range(len(variance_explained))]
+
+    PCs_df = pd.DataFrame(scores, index=df.columns, columns=PCs)
+    loadings_df = pd.DataFrame(loadings, index=df.index, columns=PCs)
+    variance_df = pd.DataFrame({
+        "Variance_explained": np.round(variance_explained, 5),
+        "PC": range(1, len(PCs) + 1)}, columns=["Variance_explained", "PC"])
+
+    return PCs_df, loadings_df, variance_df
+
+
+def spearmanCorrelation(df):
+    ''' Spearman's rank correlation between the columns of df. Each column
+    is ranked once (ties get their average rank) and the correlations are
+    the matrix product of the centred, unit length rank vectors. Columns
+    with a single value have a correlation of 0 with every other column '''
+
+    ranks = df.rank(axis=0).values.astype(np.float64)
+    ranks -= ranks.mean(axis=0)
+
+    norms = np.sqrt((ranks ** 2).sum(axis=0))
+    norms[norms == 0] = 1
+    ranks /= norms
+
+    return ranks.T.dot(ranks)
+
+
+def spearmanLinkage(df, method="ward"):
+    ''' Hierarchical clustering of the columns of df, using 1 - Spearman's
+    rank correlation as the distance. method is as for
+    scipy.cluster.hierarchy.linkage, where "ward" is R's "ward.D2" '''
+
+    distances = 1 - spearmanCorrelation(df)
+    np.fill_diagonal(distances, 0)
+    distances = np.maximum(distances, 0)
+
+    return hierarchy.linkage(squareform(distances, checks=False),
+                             method=method)
+
+
+def clusterHeatmap(df, cache_file, column_method="ward",
+                   row_method="average"):
+    ''' Cluster the columns and the rows of df for a heatmap (see
+    spearmanLinkage). The linkages and the dendrogram orders are saved to
+    cache_file (.npz), and read from it instead if it holds the
+    clustering of the same rows, columns and values of df with the same
+    methods. The values and methods are compared by a digest saved with
+    the clustering.
+
+    Returns a dictionary with the column and row linkages, labels and
+    orders '''
+
+    column_labels = [str(x) for x in df.columns]
+    row_labels = [str(x) for x in df.index]
+
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(df.values, dtype=np.float64))
+    digest.update("%s\t%s" % (column_method, row_method))
+    digest = digest.hexdigest()
 
-    df.to_csv(outfile, sep="\t", index=True)
+    if os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        clustering = dict((key, cached[key]) for key in cached.files)
+        if ("digest" in clustering and
+                str(clustering["digest"]) == digest and
+                clustering["column_labels"].tolist() == column_labels and
+                clustering["row_labels"].tolist() == row_labels):
+            E.debug("using cached clustering from %s" % cache_file)
+            return clustering
+
+    clustering = {
+        "columns": spearmanLinkage(df, column_method),
+        "rows": spearmanLinkage(df.T, row_method),
+        "column_labels": np.array(column_labels),
+        "row_labels": np.array(row_labels),
+        "digest": np.array(digest)}
+
+    clustering["column_order"] = hierarchy.leaves_list(clustering["columns"])
+    clustering["row_order"] = hierarchy.leaves_list(clustering["rows"])
+
+    # np.savez appends .npz to filenames without it, so pass a file
+    with open(cache_file, "wb") as outf:
+        np.savez(outf, **clustering)
+
+    return clustering
+
+
+def linkageToHclust(linkage, labels, method):
+    ''' Convert a scipy linkage matrix into an R hclust object, so that R
+    can draw the dendrogram without clustering again '''
+
+    n = len(labels)
+
+    # hclust numbers singletons -1..-n and clusters by merge step 1..n-1
+    merge = linkage[:, :2].astype(np.int64)
+    merge = np.where(merge < n, -(merge + 1), merge - n + 1)
+
+    makeHclust = R('''
+    function(merge, height, order, labels, method){
+    hc = list(merge=matrix(merge, ncol=2), height=height, order=order,
+              labels=labels, method=method)
+    class(hc) = "hclust"
+    hc
+    }''')
+
+    return makeHclust(robjects.IntVector(merge.T.ravel().tolist()),
+                      robjects.FloatVector(linkage[:, 2].tolist()),
+                      robjects.IntVector(
+                          (hierarchy.leaves_list(linkage) + 1).tolist()),
+                      robjects.StrVector([str(x) for x in labels]),
+                      method)
+
+
+def heatmapHclusts(df, cache_file):
+    ''' Cluster the cells (columns, ward.D2) and genes (rows, average) of
+    df for a heatmap (see clusterHeatmap) and return them as R hclust
+    objects '''
+
+    clustering = clusterHeatmap(df, cache_file, "ward", "average")
+
+    return (linkageToHclust(clustering["columns"], df.columns, "ward.D2"),
+            linkageToHclust(clustering["rows"], df.index, "average"))
+
+
+@cluster_runnable
+def getGeneCounts(infiles, outfile):
+    ''' merge the per cell gene counts into a gene x cell table, written
+    with a sparse copy (see SparseCounts) '''
+
+    cells = [re.sub(".*_UMI_", "", infile).replace(
+        "_deduped", "").replace(
+        ".trans.gene.counts.tsv", "") for infile in infiles]
+
+    counts = SparseCounts.fromCountFiles(infiles, cells)
+    counts.writeTable(outfile)
 
 
 @cluster_runnable
@@ -291,13 +1126,18 @@ def makeHeatmapsAndPCA(infiles,
                        outfile,
                        min_counts_per_sample=1000,
                        max_counts_per_sample=100000,
-                       top_genes_heatmap=100, top_genes_pca=2000):
+                       top_genes_heatmap=100, top_genes_pca=2000,
+                       pca_components=10, pca_seed=1):
     '''
     1. Concatenates the counts from day 0 and day 14 and subset to samples
        with counts within set range.
     2. Heatmaps plotted for each dedup method using these samples
        and top 100 genes
     3. PCA plotted for each dedup method using these samples and top 2000 genes
+
+    The first pca_components PCs are computed here (see runPCA) and
+    written to <method>_variance.tsv and <method>_eigenvectors.tsv, which
+    are then read by R for plotting
     '''
 
     def getDay(infile):
@@ -314,44 +1154,64 @@ def makeHeatmapsAndPCA(infiles,
     methods = set([re.sub("_SRR.*", "", os.path.basename(x).replace(
         "dedup_", "")) for x in infiles])
 
-    uniq_final_df = pd.DataFrame()
-
-    with IOTools.openFile(outfile, "w") as outf:
-
-        # start with just the uniq
-        for infile in [x for x in infiles if "unique" in x]:
+    def readDays(infiles):
+        ''' read the counts for the samples with a day, adding the day to
+        the cell names, and merge them '''
 
+        matrices = []
+        for infile in infiles:
             day = getDay(infile)
 
             # ignore sample id SRR1058003 / 1058023
             if not day:
                 continue
 
-            tmp_df = pd.io.parsers.read_csv(infile, sep="\t", index_col=0)
-            tmp_df.columns = [x + day for x in tmp_df.columns]
+            counts = readCounts(infile)
+            counts.cells = [x + day for x in counts.cells]
+            matrices.append(counts)
+
+        return matrices[0].concat(matrices[1:])
+
+    def writePCA(df, size_factors, plot_base):
+        ''' compute the PCA for the cells in df and write out the variance
+        explained and the PCs for each cell '''
 
-            uniq_final_df = pd.concat([uniq_final_df, tmp_df], axis=1)
+        PCs_df, loadings_df, variance_df = runPCA(
+            df, pca_components, pca_seed)
 
-        uniq_genes_only = uniq_final_df.drop(
-            [x for x in uniq_final_df.index if "ERCC" in str(x)])
-        uniq_genes_only = uniq_genes_only.drop("chrM")
+        variance_df.to_csv(plot_base + "_variance.tsv",
+                           sep="\t", index=False)
+
+        PCs_df["id_1"] = [x.split("_")[0] for x in PCs_df.index]
+        PCs_df["id_2"] = [x.split("_")[1] for x in PCs_df.index]
+        PCs_df["id_expression"] = np.log10(size_factors)
+
+        PCs_df.to_csv(plot_base + "_eigenvectors.tsv",
+                      sep="\t", index=False)
+
+    with IOTools.openFile(outfile, "w") as outf:
+
+        # start with just the uniq
+        uniq_final = readDays([x for x in infiles if "unique" in x])
+
+        uniq_genes_only = uniq_final.dropGenes(
+            [x for x in uniq_final.genes if "ERCC" in str(x)] + ["chrM"])
 
         # filter out low abundance and high abundance samples
-        size_factors = uniq_genes_only.sum(axis=0)
+        size_factors = uniq_genes_only.sizeFactors()
 
-        keep = [(float(x) > min_counts_per_sample and
-                 float(x) < max_counts_per_sample) for x in size_factors]
+        keep = ((size_factors > min_counts_per_sample) &
+                (size_factors < max_counts_per_sample))
 
-        uniq_filtered = uniq_genes_only.iloc[:, keep]
-        cells = uniq_filtered.columns
+        uniq_filtered = uniq_genes_only.subsetCells(keep)
+        cells = pd.Index(uniq_filtered.cells)
         outf.write("number of cells: %i\n" % len(cells.tolist()))
 
         # need to recalculate as some samples have been removed
-        size_factors = uniq_filtered.sum(axis=0)
-        r_size_factors = robjects.Vector(size_factors.tolist())
+        size_factors = uniq_filtered.sizeFactors()
 
         # normalise
-        uniq_normed = uniq_filtered * 1000000.0 / size_factors
+        uniq_normed = uniq_filtered.normalise("million-counts").toDataFrame()
 
         # subset to option(**top_genes**) most highly expressed
         sum_counts_per_row = uniq_normed.sum(1)
@@ -386,7 +1246,7 @@ def makeHeatmapsAndPCA(infiles,
         outf.write("number of heatmap genes: %i\n" % len(genes_heatmap.tolist()))
 
         plot_heatmap = R('''
-        function(df, plot_outfile, table_outfile){
+        function(df, col_hc, row_hc, plot_outfile, table_outfile){
         options(expressions = 10000)
         library(Biobase)
         library(RColorBrewer)
@@ -397,9 +1257,10 @@ def makeHeatmapsAndPCA(infiles,
         col_cols = sapply(colnames(df),
           FUN=function(x) ifelse(grepl(".*day0", x), "chartreuse4", "chocolate2"))
 
-        d = as.dendrogram(hclust(as.dist(1-cor(df,
-                                       method = "spearman")),
-                         method = "ward.D2"))
+        d = as.dendrogram(col_hc)
+
+        # as heatmap.2 does for the rows when it clusters them itself
+        row_d = reorder(as.dendrogram(row_hc), rowMeans(df))
 
         # write out clusters
         df_clusters = data.frame(
@@ -419,10 +1280,8 @@ def makeHeatmapsAndPCA(infiles,
                   margin=c(18, 10), keysize=1, cexCol=2,
                   dendrogram="column",
                   Colv = d,
+                  Rowv = row_d,
                   ColSideColors=col_cols,
-                  hclustfun = function(x) hclust(x, method = 'average'),
-                  distfun = function(x) as.dist(1 - cor(t(x),
-                                                method="spearman")),
                   labRow=F, labCol=F, key=F)
 
         legend(0, 1,
@@ -437,9 +1296,7 @@ def makeHeatmapsAndPCA(infiles,
         }''')
 
         plot_PCA = R('''
-        function(df,
-                 r_size_factors,
-                 plot_base){
+        function(plot_base){
 
         library(ggplot2)
         library(grid)
@@ -447,15 +1304,9 @@ def makeHeatmapsAndPCA(infiles,
         m_text = element_text(size=15)
         s_text = element_text(size=10)
 
-        gene_pca <- prcomp(t(df), center = TRUE)
-        variance = gene_pca$sdev^2
-        variance_explained = round(variance/sum(variance), 5)
-
-        variance_df = data.frame("Variance_explained" = variance_explained,
-                                 "PC" = seq(1, length(variance)))
-
-        write.table(variance_df, paste0(plot_base, "_variance.tsv"),
-                    sep="\t", quote=FALSE, row.names=FALSE)
+        variance_df = read.table(paste0(plot_base, "_variance.tsv"),
+                                 sep="\t", header=TRUE)
+        variance_explained = variance_df$Variance_explained
 
         p_variance = ggplot(variance_df, aes(x=PC, y=Variance_explained))+
         geom_point()+
@@ -471,13 +1322,8 @@ def makeHeatmapsAndPCA(infiles,
 
         ggsave(paste0(plot_base, "_pca_variance.png"), width=5, height=5)
 
-        PCs_df = data.frame(gene_pca$x)
-        PCs_df$id_1 = sapply(strsplit(rownames(PCs_df), "_"), "[", 1)
-        PCs_df$id_2 = sapply(strsplit(rownames(PCs_df), "_"), "[", 2)
-        PCs_df$id_expression = log(as.numeric(r_size_factors),10)
-
-        write.table(PCs_df, paste0(plot_base, "_eigenvectors.tsv"),
-                    sep="\t", row.names=FALSE)
+        PCs_df = read.table(paste0(plot_base, "_eigenvectors.tsv"),
+                            sep="\t", header=TRUE)
 
         p = geom_point(size=2, aes(shape=id_2, colour=id_2))
         s_c = scale_colour_discrete(name="")
@@ -537,14 +1383,16 @@ def makeHeatmapsAndPCA(infiles,
         plot_base = os.path.join(os.path.dirname(outfile), "uniq")
         outf.write("%s\n" % plot_base)
 
-        r_uniq_pca_df = com.convert_to_r_dataframe(z_df_pca_filtered)
         r_uniq_heatmap_df = com.convert_to_r_dataframe(log_df_heatmap_filtered)
 
         log_df_heatmap_filtered.to_csv(outfile+"4", sep="\t", index=True)
-        plot_heatmap(r_uniq_heatmap_df, plot_outfile, cluster_table)
-        plot_PCA(r_uniq_pca_df,
-                 r_size_factors,
-                 plot_base)
+        col_hc, row_hc = heatmapHclusts(
+            log_df_heatmap_filtered,
+            P.snip(plot_outfile, ".png") + "_clustering.npz")
+        plot_heatmap(r_uniq_heatmap_df, col_hc, row_hc,
+                     plot_outfile, cluster_table)
+        writePCA(z_df_pca_filtered, size_factors, plot_base)
+        plot_PCA(plot_base)
 
         outf.write("plotting heatmap for uniq deduping\n")
         outf.write("plotting PCAs for uniq deduping\n")
@@ -556,39 +1404,26 @@ def makeHeatmapsAndPCA(infiles,
 
         for method in methods:
 
-            final_df = pd.DataFrame()
-
-            for infile in infiles:
-
-                if method == "transcriptome":
-                    pattern = method
-                else:
-                    pattern = "dedup_%s" % method
-
-                if pattern in infile:
-                    outf.write("%s\n" % infile)
-                    day = getDay(infile)
-
-                    # ignore other sample ids
-                    if not day:
-                        continue
+            if method == "transcriptome":
+                pattern = method
+            else:
+                pattern = "dedup_%s" % method
 
-                    tmp_df = pd.io.parsers.read_csv(infile, sep="\t", index_col=0)
-                    tmp_df.columns = [x + day for x in tmp_df.columns]
+            method_infiles = [x for x in infiles if pattern in x]
+            outf.write("%s\n" % "\n".join(method_infiles))
 
-                    final_df = pd.concat([final_df, tmp_df], axis=1)
+            final = readDays(method_infiles)
 
-            outf.write("%s\n" % "\t".join(map(str, final_df.shape)))
-            outf.write("number of cells: %i\n" % len(final_df.index))
+            outf.write("%s\n" % "\t".join(map(str, final.matrix.shape)))
+            outf.write("number of cells: %i\n" % len(final.genes))
             # subset to chosen cells from uniquq dedup and
             # extract the size factors for the selected cells
-            filtered = final_df.loc[:, cells.tolist()]
-            outf.write("%s\n" % "\t".join(map(str, filtered.shape)))
+            filtered = final.subsetCells(cells.tolist())
+            outf.write("%s\n" % "\t".join(map(str, filtered.matrix.shape)))
 
-            size_factors = filtered.sum(axis=0)
-            r_size_factors = robjects.Vector(size_factors.tolist())
+            size_factors = filtered.sizeFactors()
 
-            normed = filtered * 1000000.0 / size_factors
+            normed = filtered.normalise("million-counts").toDataFrame()
 
             countsLog = Counts.Counts(normed)
             countsLog.normalise(method="total-column")
@@ -615,22 +1450,469 @@ def makeHeatmapsAndPCA(infiles,
             normed_heatmap_filtered.to_csv(
                 outfile.replace(".log", "%s_heatmap_df.tsv" % method), sep="\t")
 
-            r_df_pca = pandas2ri.py2ri(normed_pca_filtered)
             r_df_heatmap = pandas2ri.py2ri(normed_heatmap_filtered)
 
             outf.write("plotting heatmap for %s deduping\n" % method)
-            plot_heatmap(r_df_heatmap, plot_outfile, cluster_table)
+            col_hc, row_hc = heatmapHclusts(
+                normed_heatmap_filtered,
+                P.snip(plot_outfile, ".png") + "_clustering.npz")
+            plot_heatmap(r_df_heatmap, col_hc, row_hc,
+                         plot_outfile, cluster_table)
 
             outf.write("plotting PCAs for %s deduping\n" % method)
-            plot_PCA(r_df_pca,
-                     r_size_factors,
-                     plot_base)
+            writePCA(normed_pca_filtered, size_factors, plot_base)
+            plot_PCA(plot_base)
+
+
+class AdapterMatcher(object):
+    ''' Approximate matcher for a fixed adapter sequence, allowing up to
+    max_mismatches substitutions (but no insertions or deletions).
+
+    search uses a bit-parallel shift-and algorithm with one state vector
+    for each number of mismatches, and searchBatch compares a whole array
+    of reads with the adapter at each offset using numpy. Both return the
+    leftmost start of a match, as regex.search would for the pattern
+    "(ADAPTER){s<=max_mismatches}", or -1 if there is no match. '''
+
+    def __init__(self, adapter, max_mismatches=2):
+
+        self.adapter = adapter
+        self.length = len(adapter)
+        self.max_mismatches = max_mismatches
+
+        # bitmask of the positions of each base in the adapter
+        self.masks = collections.defaultdict(int)
+        for i, base in enumerate(adapter):
+            self.masks[base] |= 1 << i
+
+        self.match_bit = 1 << (self.length - 1)
+        self.adapter_array = np.frombuffer(adapter, dtype=np.uint8)
+
+    def search(self, seq):
+        ''' Return the leftmost start of a match in seq, or -1 '''
+
+        states = [0] * (self.max_mismatches + 1)
+        masks = self.masks
+
+        for i, base in enumerate(seq):
+            mask = masks.get(base, 0)
+            previous = states[0]
+            states[0] = ((previous << 1) | 1) & mask
+            for k in range(1, self.max_mismatches + 1):
+                current = states[k]
+                # extend with a match, or with a substitution from k-1
+                states[k] = ((((current << 1) | 1) & mask) |
+                             ((previous << 1) | 1))
+                previous = current
+
+            if states[self.max_mismatches] & self.match_bit:
+                return i - self.length + 1
+
+        return -1
+
+    def searchBatch(self, seqs):
+        ''' Return a numpy array of the leftmost start of a match in each
+        of the sequences in seqs, or -1 where there is no match '''
+
+        nseqs = len(seqs)
+        starts = np.empty(nseqs, dtype=np.int32)
+        starts.fill(-1)
+
+        if nseqs == 0:
+            return starts
+
+        lengths = np.array([len(seq) for seq in seqs])
+        width = lengths.max()
+        if width < self.length:
+            return starts
+
+        reads = np.frombuffer(
+            "".join(seq.ljust(width, "\0") for seq in seqs),
+            dtype=np.uint8).reshape(nseqs, width)
+
+        for offset in range(width - self.length + 1):
+            mismatches = (reads[:, offset:offset + self.length] !=
+                          self.adapter_array).sum(axis=1)
+            found = ((starts == -1) &
+                     (mismatches <= self.max_mismatches) &
+                     (lengths >= offset + self.length))
+            starts[found] = offset
+
+        return starts
+
+
+INDROP_ADAPTER = AdapterMatcher("GAGTGATTGCTTGTGACGCCTT", 2)
+
+
+class BarcodeCorrector(object):
+    ''' Index for correcting barcodes to a whitelist.
+
+    Every sequence within a Hamming distance of distance of each
+    whitelisted barcode is precomputed, so that correcting a barcode is a
+    single dictionary lookup. A sequence is corrected to the closest
+    whitelisted barcode. Sequences equally close to more than one
+    whitelisted barcode are ambiguous, and are not corrected. Only
+    substitutions are considered, so barcodes are only corrected to
+    whitelisted barcodes of the same length. '''
+
+    def __init__(self, barcodes, distance=2, alphabet="ACGTN"):
+
+        self.barcodes = set(barcodes)
+        self.distance = distance
+
+        # sequence -> (distance, barcode), barcode is None if ambiguous
+        self.neighbours = {}
+
+        for barcode in self.barcodes:
+            for neighbour, dist in self._neighbourhood(barcode, distance,
+                                                       alphabet):
+                self._add(neighbour, dist, barcode)
+
+        E.debug("Built barcode index of %i barcodes, %i neighbours, %i "
+                "ambiguous" % (len(self.barcodes), len(self.neighbours),
+                               sum(1 for d, b in self.neighbours.itervalues()
+                                   if b is None)))
+
+    @staticmethod
+    def _neighbourhood(barcode, distance, alphabet):
+        ''' yield (sequence, distance) for all sequences within distance
+        substitutions of barcode '''
+
+        yield barcode, 0
+        for dist in range(1, distance + 1):
+            for positions in itertools.combinations(range(len(barcode)),
+                                                    dist):
+                choices = [[base for base in alphabet
+                            if base != barcode[position]]
+                           for position in positions]
+                for bases in itertools.product(*choices):
+                    neighbour = list(barcode)
+                    for position, base in zip(positions, bases):
+                        neighbour[position] = base
+                    yield "".join(neighbour), dist
+
+    def _add(self, neighbour, dist, barcode):
+
+        if neighbour not in self.neighbours:
+            self.neighbours[neighbour] = (dist, barcode)
+        else:
+            current_dist, current = self.neighbours[neighbour]
+            if dist < current_dist:
+                self.neighbours[neighbour] = (dist, barcode)
+            elif dist == current_dist and current != barcode:
+                self.neighbours[neighbour] = (dist, None)
+
+    def __contains__(self, barcode):
+        return barcode in self.barcodes
+
+    def correct(self, barcode):
+        ''' Return the whitelisted barcode that barcode corrects to, or
+        None if there is no whitelisted barcode within the distance, or it
+        is ambiguous '''
+
+        try:
+            return self.neighbours[barcode][1]
+        except KeyError:
+            return None
+
+    def isAmbiguous(self, barcode):
+        ''' True if barcode is equally close to more than one whitelisted
+        barcode '''
+
+        return (barcode in self.neighbours and
+                self.neighbours[barcode][1] is None)
+
+
+class BarcodeSpillStore(object):
+    ''' Holds formatted fastq records grouped by cell barcode.
+
+    Records are kept in a buffer for each barcode. When the total size of
+    the buffers exceeds buffer_size bytes, every buffer is compressed and
+    appended to a binary spill file as a block, preceded by a header line
+    giving its barcode and length. No index of the blocks is kept in
+    memory, so memory use is bounded by buffer_size however many barcodes
+    are seen. The records for a set of barcodes are retrieved with a
+    single pass through the spill file. '''
+
+    def __init__(self, filename, buffer_size=100000000, compresslevel=1):
+
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.compresslevel = compresslevel
+
+        self.buffers = collections.defaultdict(list)
+        self.buffered = 0
+        self.spillfile = None
+
+    def add(self, barcode, record):
+
+        self.buffers[barcode].append(record)
+        self.buffered += len(record)
+
+        if self.buffered > self.buffer_size:
+            self.spill()
+
+    def spill(self):
+        ''' Write all buffered records to the spill file '''
+
+        if self.spillfile is None:
+            self.spillfile = open(self.filename, "w+b")
+
+        self.spillfile.seek(0, os.SEEK_END)
+        for barcode, records in self.buffers.iteritems():
+            block = zlib.compress("".join(records), self.compresslevel)
+            self.spillfile.write("%s\t%i\n" % (barcode, len(block)))
+            self.spillfile.write(block)
+
+        self.buffers = collections.defaultdict(list)
+        self.buffered = 0
+
+    def blocks(self, barcodes):
+        ''' Yield (barcode, block of text) for the records of each barcode
+        in barcodes. The blocks for a barcode are yielded in the order
+        the records were added, but blocks for different barcodes are
+        interleaved '''
+
+        barcodes = set(barcodes)
+
+        if self.spillfile is not None:
+            self.spillfile.seek(0)
+            while True:
+                header = self.spillfile.readline()
+                if not header:
+                    break
+                barcode, length = header.split("\t")
+                block = self.spillfile.read(int(length))
+                if barcode in barcodes:
+                    yield barcode, zlib.decompress(block)
+
+        for barcode in barcodes:
+            if barcode in self.buffers:
+                yield barcode, "".join(self.buffers[barcode])
+
+    def close(self):
+
+        if self.spillfile is not None:
+            self.spillfile.close()
+            os.unlink(self.filename)
+            self.spillfile = None
+
+
+class BarcodeCounter(object):
+    ''' Count barcode frequencies.
+
+    If capacity is None, counts are exact. Otherwise at most capacity
+    barcodes are counted, using the Space-Saving algorithm (Metwally et al
+    2005): when a new barcode is seen and the counter is full, the
+    barcode with the smallest count is replaced, and the new barcode
+    inherits its count. Any barcode with a true frequency greater than
+    total/capacity is guaranteed to be counted, and counts overestimate
+    the true count by at most the recorded error. The smallest count is
+    found with a lazily updated heap. '''
+
+    def __init__(self, capacity=None):
+
+        self.capacity = capacity
+        self.counts = collections.Counter()
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+
+    def add(self, barcode, count=1):
+
+        self.total += count
+
+        if barcode in self.counts or self.capacity is None:
+            self.counts[barcode] += count
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[barcode] = count
+            self.errors[barcode] = 0
+            heapq.heappush(self.heap, (count, barcode))
+            return
+
+        # heap entries can only underestimate the current count, so
+        # refresh stale entries until the smallest is up to date
+        while True:
+            min_count, min_barcode = self.heap[0]
+            if self.counts[min_barcode] == min_count:
+                break
+            heapq.heapreplace(self.heap,
+                              (self.counts[min_barcode], min_barcode))
+
+        heapq.heappop(self.heap)
+        del self.counts[min_barcode]
+        del self.errors[min_barcode]
+
+        self.counts[barcode] = min_count + count
+        self.errors[barcode] = min_count
+        heapq.heappush(self.heap, (min_count + count, barcode))
+
+    def update(self, barcodes):
+        for barcode in barcodes:
+            self.add(barcode)
+
+    def most_common(self, n=None):
+        return self.counts.most_common(n)
+
+    def __getitem__(self, barcode):
+        return self.counts[barcode]
+
+
+def findKnee(counts):
+    ''' Find the knee of a barcode rank curve. counts is a list of barcode
+    counts sorted in decreasing order. On a log-log plot of count against
+    rank, the knee is the point furthest from the straight line joining
+    the first and last points. Returns the number of barcodes up to and
+    including the knee '''
+
+    if len(counts) < 3:
+        return len(counts)
+
+    x = np.log10(np.arange(1, len(counts) + 1))
+    y = np.log10(np.array(counts, dtype="float"))
+
+    line = np.array([x[-1] - x[0], y[-1] - y[0]])
+    line = line / np.sqrt((line ** 2).sum())
+
+    distance = np.abs((x - x[0]) * line[1] - (y - y[0]) * line[0])
+
+    return int(distance.argmax()) + 1
+
+
+def filterFastqChunkGSE65525(seq_lines, UMI_lines, barcode_index1,
+                             barcode_index2):
+    ''' Filter a chunk of paired fastq records as described for
+    extractUMIsAndFilterFastqGSE65525.
+
+    seq_lines and UMI_lines are lists of the lines of the same reads from
+    the genomic and barcode/UMI fastqs. barcode_index1 and barcode_index2
+    are BarcodeCorrector objects for the two cell barcodes. Returns a list
+    of (cell, formatted record) tuples for the reads that pass, in read
+    order, with the UMI appended to the read name, and a Counter of the
+    filtering results '''
+
+    counts = collections.Counter()
+    records = []
+
+    assert len(seq_lines) == len(UMI_lines), (
+        "fastq files contain different numbers of reads")
+
+    UMI_seqs = [line[:-1] for line in UMI_lines[1::4]]
+
+    # match must start from at least 9 bp into fastq sequence
+    # allow two mismatches
+    adapter_starts = INDROP_ADAPTER.searchBatch(
+        [UMI_seq[8:] for UMI_seq in UMI_seqs])
+
+    for i in range(0, len(seq_lines), 4):
+
+        # check both records are for the same fastq read
+        assert (seq_lines[i].split(" ")[0].strip() ==
+                UMI_lines[i].split(" ")[0].strip()), (
+            "fastq read names do not match")
+
+        UMI_seq = UMI_seqs[i // 4]
+
+        # Skip if:
+        # - no match
+        # - match starts too far from 5' end
+        # As only substitutions are allowed, the matched string is always
+        # the right length, so adapter_sequence_wrong_length can no longer
+        # occur
+        if adapter_starts[i // 4] == -1:
+            counts["no_adapter_sequence"] += 1
+            continue
+
+        start = int(adapter_starts[i // 4]) + 8
+        if start > 12:
+            counts["no_adapter_sequence_match_in_correct_location"] += 1
+            continue
+
+        barcode1 = UMI_seq[0:start]
+        barcode2 = UMI_seq[start+22:start+30]
+        UMI = UMI_seq[start+30:start+36]
+
+        # check barcode and UMI lengths. This is mainly to exlude
+        # read lengths which are too short to encode the UMI but
+        # also a back up check for barcode 1
+        if len(barcode1) < 8:
+            counts["barcode1_too_short"] += 1
+            continue
+
+        if len(barcode1) > 12:
+            counts["barcode1_too_long"] += 1
+            continue
+
+        if len(barcode2) != 8:
+            counts["barcode2_wrong_length"] += 1
+            continue
+
+        if len(UMI) < 6:
+            counts["UMI_too_short"] += 1
+            continue
+
+        # check barcodes are found in lists, correcting them if not
+        if barcode1 not in barcode_index1:
+            corrected = barcode_index1.correct(barcode1)
+            if corrected is not None:
+                counts["barcode1_corrected"] += 1
+                barcode1 = corrected
+            elif barcode_index1.isAmbiguous(barcode1):
+                counts["barcode1_ambiguous"] += 1
+                continue
+            else:
+                counts["barcode1_mismatch"] += 1
+                continue
+
+        if barcode2 not in barcode_index2:
+            corrected = barcode_index2.correct(barcode2)
+            if corrected is not None:
+                counts["barcode2_corrected"] += 1
+                barcode2 = corrected
+            elif barcode_index2.isAmbiguous(barcode2):
+                counts["barcode2_ambiguous"] += 1
+                continue
+            else:
+                counts["barcode2_mismatch"] += 1
+                continue
+
+        counts["kept"] += 1
+        cell = barcode1 + barcode2
+
+        identifier = "_".join((
+            seq_lines[i][:-1].replace(" ", ":"), UMI))
+        records.append((cell, "%s\n%s+\n%s" % (
+            identifier, seq_lines[i + 1], seq_lines[i + 3])))
+
+    return records, counts
+
+
+def writeBarcodeCounts(outfile, barcode_counts):
+    ''' write (barcode, count) pairs to outfile, via a temporary file
+    which replaces outfile once complete, so that a refreshed table is
+    never seen half written '''
+
+    tmp_outfile = outfile + ".tmp"
+    with IOTools.openFile(tmp_outfile, "w") as outf:
+        for barcode, count in barcode_counts:
+            outf.write("%s\t%i\n" % (barcode, count))
+
+    os.rename(tmp_outfile, outfile)
 
 
 @cluster_runnable
 def extractUMIsAndFilterFastqGSE65525(fastq_UMI, fastq_seq,
                                       barcodes1_infile, barcodes2_infile,
-                                      cell_barcode_count):
+                                      cell_barcode_count,
+                                      chunk_size=100000, processes=1,
+                                      barcode_distance=2,
+                                      spill_buffer_size=100000000,
+                                      barcode_counter_capacity=None,
+                                      tagged=False,
+                                      barcode_report_interval=10,
+                                      barcode_report_size=10000):
     '''Paired end sequencing:
     read 1 - 51bp: cell barcode1 (8-12bp) then adapter sequence (22bp),
              cell barcode2 (8bp) then UMI (6bp), then Ts
@@ -642,28 +1924,53 @@ def extractUMIsAndFilterFastqGSE65525(fastq_UMI, fastq_seq,
     1. Check barcode is an expected sequence (384^2 possible barcodes)
     2. Extract UMI and cell barcode from read 1 and append to read
        name for read pair2
-    3. Write out to temporary single end fastq and generate
+    3. Hold the reads grouped by cell barcode and generate
        frequency table of barcodes
-    4. Identify n most abundant barcodes where n is the the of cells
-       and re-parse single-end fastq to retain only these barcodes
-    5. Strip cell barcode from fastq identifier and write out to
-       single cell fastq using concatenated barcodes as fastq name
+    4. Identify n most abundant barcodes where n is the the of cells,
+       if cell_barcode_count is None, n is found from the knee of the
+       barcode rank curve (see findKnee)
+    5. Write out the reads for these barcodes to single cell fastq
+       using concatenated barcodes as fastq name
 
     Filtering performed here mirrors filtering used by Klein et al
     2015
 
-    Ideally, we would parse the pair of fastqs twice. First to
-    generate the frequency table and then again to identify all cell
-    barcodes within a hamming distance of 2 from the n most abundnant
-    barcodes. However, the identification of cell barcode near
-    mismatches is extremely time consuming and some barcodes cannot be
-    unambiguously resolved at a Hamming distance of 2. Hence, only
-    perfect cell barcode matches are retained.
-
-    Since we have already identified all the candidate perfect matches
-    on the first parse, we can save these out to a temporary single
-    end fastq and parse this to identify the perfect matches to the n
-    most abundant cell barcodes
+    Each of the two cell barcodes is corrected to the expected barcode
+    within a Hamming distance of barcode_distance (default 2), using a
+    precomputed index of all the sequences within that distance of the
+    expected barcodes (see BarcodeCorrector), so that correction is a
+    single lookup per read. Barcodes that are equally close to more than
+    one expected barcode cannot be unambiguously resolved and are
+    discarded. Set barcode_distance to 0 to retain only perfect matches.
+
+    Since we have already identified all the candidate (corrected)
+    matches on the first parse, we hold these grouped by cell barcode
+    (spilling compressed blocks to a temporary file when more than
+    spill_buffer_size bytes are held, see BarcodeSpillStore), and then
+    write out only those for the n most abundant cell barcodes
+
+    Barcodes are counted exactly, unless barcode_counter_capacity is
+    given, in which case at most that many barcodes are counted
+    approximately in fixed memory (see BarcodeCounter). The counts in
+    <prefix>_barcode_counts.tsv are then approximate, but the counts in
+    <prefix>_log2.tsv and <prefix>_barcode_counts2.tsv are always the
+    numbers of reads written out.
+
+    <prefix>_barcode_counts.tsv is refreshed during the first parse every
+    barcode_report_interval chunks with the barcode_report_size most
+    abundant barcodes so far, as <prefix>_log.tsv is, so that a long run
+    can be followed. It is rewritten with all the barcodes at the end.
+
+    The first parse reads the fastqs chunk_size read pairs at a time.
+    If processes is greater than 1 the chunks are filtered in parallel,
+    without changing the order of the output.
+
+    If tagged is True, the reads for the selected cells are written to a
+    single fastq, <prefix>_tagged.fastq.gz, with read names
+    <read id>_<cell>_<UMI> (see extractUMIsAndFilterFastq), and the logs,
+    barcode counts and temporary spill file are named <prefix>_tagged_*
+    rather than <prefix>_*, so that the tagged and per-cell runs do not
+    overwrite each other
     '''
 
     def reverseComp(seq):
@@ -686,228 +1993,122 @@ def extractUMIsAndFilterFastqGSE65525(fastq_UMI, fastq_seq,
         for line in inf:
             barcode_set2.update((reverseComp(line.strip()),))
 
+    barcode_index1 = BarcodeCorrector(barcode_set1, barcode_distance)
+    barcode_index2 = BarcodeCorrector(barcode_set2, barcode_distance)
+
     out_prefix = P.snip(fastq_UMI, "_1.fastq.gz")
     #out_prefix_base = os.path.basename(out_prefix)
 
+    if tagged:
+        log_prefix = out_prefix + "_tagged"
+    else:
+        log_prefix = out_prefix
+
     fastq = IOTools.openFile(fastq_seq, "r")
     UMI_fastq = IOTools.openFile(fastq_UMI, "r")
 
-    def FastqNext(infile):
-        ''' get next fastq entry in file - without format checks'''
-        line1 = infile.readline()
-        if not line1:
-            return None
-        line2 = infile.readline()
-        line3 = infile.readline()
-        line4 = infile.readline()
-
-        return Fastq.Record(line1[1:-1], line2[:-1], line4[:-1])
-
-    def getReadName(record):
-        return record.identifier.split(" ")[0]
-
     counts = collections.Counter()
-    outfs = collections.Counter()
+    outfs = BarcodeCounter(barcode_counter_capacity)
 
-    outfile_tmp = out_prefix + "_tmp.fastq"
-    fastq_tmp_outfile = IOTools.openFile(outfile_tmp, "w")
+    # hold all the reads which pass filters, grouped by cell barcode,
+    # until we know which barcodes are the selected cells
+    store = BarcodeSpillStore(log_prefix + "_spill.tmp",
+                              buffer_size=spill_buffer_size)
 
     n = 0
-    with IOTools.openFile(out_prefix + "_log.tsv", "w") as outf:
-        # should really add an assert here to check for empty files
-        record = 1
-        while record is not None:
-
-            record = FastqNext(fastq)
-            UMI_record = FastqNext(UMI_fastq)
-
-            # check for end of file
-            if record is None or UMI_record is None:
-                if UMI_record is None:
-                    outf.write("reached end of UMI fastq\n")
-                if record is None:
-                    outf.write("reached end of paired end fastq\n")
-                break
+    chunk = 0
+    with IOTools.openFile(log_prefix + "_log.tsv", "w") as outf:
 
-            if n % 100000 == 0:
-                outf.write("read through %i fastq records. %i records retained"
-                           "\n" % (n, counts["keep"]))
-                for reason, count in counts.most_common():
-                    outf.write("%s\t%i\n" % (reason, count))
-
-            n += 1
-
-            # check both records are for the same fastq read
-            assert getReadName(UMI_record) == getReadName(record), (
-                "fastq read names do not match")
-
-            UMI_record.format = "illumina-1.8"
-
-            # match must start from at least 9 bp into fastq sequence
-            # allow two mismatches
-            pos = regex.search("(GAGTGATTGCTTGTGACGCCTT){s<=2}",
-                               UMI_record.seq[8:])
-            
-            #pos = re.search("GAGTGATTGCTTGTGACGCCTT", UMI_record.seq)
-
-            # Skip if:
-            # - no match
-            # - matched string is not the right length
-            # - match starts too far from 5' end
-            if not pos:
-                counts["no_adapter_sequence"] += 1
-                continue
+        for records, chunk_counts in mapFastqChunks(
+                fastq, UMI_fastq, filterFastqChunkGSE65525,
+                (barcode_index1, barcode_index2), chunk_size, processes):
 
-            if len(pos.captures()[0]) != 22:
-                counts["adapter_sequence_wrong_length"] += 1
-                continue
-                
-            start = pos.start() + 8
-            if start > 12:
-                counts["no_adapter_sequence_match_in_correct_location"] += 1
-                continue
+            n += sum(chunk_counts.values())
+            counts.update(chunk_counts)
 
-            barcode1 = UMI_record.seq[0:start]
-            barcode2 = UMI_record.seq[start+22:start+30]
-            UMI = UMI_record.seq[start+30:start+36]
+            outf.write("read through %i fastq records. %i records retained"
+                       "\n" % (n, counts["kept"]))
+            for reason, count in counts.most_common():
+                outf.write("%s\t%i\n" % (reason, count))
 
-            # check barcode and UMI lengths. This is mainly to exlude
-            # read lengths which are too short to encode the UMI but
-            # also a back up check for barcode 1
-            if len(barcode1) < 8:
-                counts["barcode1_too_short"] += 1
-                continue
+            for cell, record in records:
+                outfs.add(cell)
+                store.add(cell, record)
 
-            if len(barcode1) > 12:
-                counts["barcode1_too_long"] += 1
-                continue
-
-            if len(barcode2) != 8:
-                counts["barcode2_wrong_length"] += 1
-                continue
-
-            if len(UMI) < 6:
-                counts["UMI_too_short"] += 1
-                continue
-
-            # check barcodes are found in lists
-            if str(barcode1) not in barcode_set1:
-                counts["barcode1_mismatch"] += 1
-                continue
-
-            if str(barcode2) not in barcode_set2:
-                counts["barcode2_mismatch"] += 1
-                continue
-
-            counts["kept"] += 1
-            cell = barcode1 + barcode2
-
-            # for now, just write out all the fastqs which pass filters
-            # we'll reparse through this fastq later and "correct" the cell barcode
-            record.identifier = "_".join((
-                record.identifier.replace(" ", ":"), UMI,  cell))
-
-            outfs[cell] += 1
-            fastq_tmp_outfile.write("%s\n" % record)
+            chunk += 1
+            if chunk % barcode_report_interval == 0:
+                writeBarcodeCounts(log_prefix + "_barcode_counts.tsv",
+                                   outfs.most_common(barcode_report_size))
 
+        outf.write("reached end of fastqs\n")
         for reason, count in counts.most_common():
             outf.write("%s\t%i\n" % (reason, count))
 
-    fastq_tmp_outfile.close()
     fastq.close()
     UMI_fastq.close()
 
-    with IOTools.openFile(out_prefix + "_barcode_counts.tsv", "w") as outf:
-        for barcode, count in outfs.most_common():
-            outf.write("%s\t%i\n" % (barcode, count))
+    writeBarcodeCounts(log_prefix + "_barcode_counts.tsv",
+                       outfs.most_common())
 
-    with IOTools.openFile(out_prefix + "_barcode1.tsv", "w") as outf:
+    with IOTools.openFile(log_prefix + "_barcode1.tsv", "w") as outf:
         outf.write("barcode set 1\n")
         for x in barcode_set1:
             outf.write("%s\n" % "\t".join((x, "length: ", str(len(x)))))
 
-    with IOTools.openFile(out_prefix + "_barcode2.tsv", "w") as outf:
+    with IOTools.openFile(log_prefix + "_barcode2.tsv", "w") as outf:
         outf.write("barcode set 2\n")
         for x in barcode_set2:
             outf.write("%s\n" % "\t".join((x, "length: ", str(len(x)))))
 
     # find the first n cell barcodes these represent the selected cells
-    cell_barcode_set = set()
-    n = 1
-    for barcode, count in outfs.most_common():
-        if n <= cell_barcode_count:
-            n += 1
-            cell_barcode_set.update((barcode,))
+    if cell_barcode_count is None:
+        cell_barcode_count = findKnee(
+            [count for barcode, count in outfs.most_common()])
+        E.info("Selected %i cell barcodes at the knee of the barcode rank"
+               " curve" % cell_barcode_count)
+
+    cell_barcodes = [barcode for barcode, count in
+                     outfs.most_common(cell_barcode_count)]
+
+    if tagged:
+        fastq_outfiles = CellFastqWriter(out_prefix + "_%s.fastq.gz",
+                                         threads=processes)
+    else:
+        fastq_outfiles = CellFastqWriter(out_prefix + "_UMI_%s.fastq.gz",
+                                         threads=processes)
+
+    # only the reads for the selected cells are written out. The counts
+    # of the records written are exact even if outfs is approximate
+    written = collections.Counter()
+    for cell, block in store.blocks(cell_barcodes):
+        written[cell] += block.count("\n") // 4
+        if tagged:
+            fastq_outfiles.write("tagged", tagFastqRecords(block, cell))
         else:
-            break
-
-    fastq = IOTools.openFile(outfile_tmp, "r")
+            fastq_outfiles.write(cell, block)
 
-    # use IOTools.FilePool class to open multiple file handles
-    fastq_outfiles = IOTools.FilePool(
-        output_pattern=out_prefix + "_UMI_%s.fastq.gz")
+    fastq_outfiles.close()
+    store.close()
 
-    # re-initate objects
     counts = collections.Counter()
-    outfs = collections.Counter()
-
-    counts["total"] = 0
-    with IOTools.openFile(out_prefix + "_log2.tsv", "w") as outf:
-        # should really add an assert here to check for empty files
-        record = 1
-        while record is not None:
-
-            record = FastqNext(fastq)
-
-            # check for end of file
-            if record is None:
-                outf.write("reached end of fastq\n")
-                break
-
-            if counts["total"] % 100000 == 0:
-                outf.write("read through %i fastq records. %i records retained"
-                           "\n" % (counts["total"], counts["kept"]))
-                for reason, count in counts.most_common():
-                    outf.write("%s\t%i\n" % (reason, count))
-
-            counts["total"] += 1
-
-            record.format = "illumina-1.8"
-
-            cell = record.identifier.split("_")[-1]
-
-            # check if cell barcode is in set
-            if cell not in cell_barcode_set:
-                counts["cell_barcode_mismatch"] += 1
-                continue
-
-            else:
-                counts["kept"] += 1
-
-            # append the UMI onto read2 and write out
-            #record.identifier = "_".join((
-            #    record.identifier.replace(" ", ":"), UMI))
-            record.identifier = "_".join((
-                record.identifier.split("_")[0:2]))
-
-            outfs[cell] += 1
-            fastq_outfiles.write(cell, "%s\n" % record)
+    counts["total"] = outfs.total
+    counts["kept"] = sum(written.values())
+    counts["cell_barcode_mismatch"] = counts["total"] - counts["kept"]
 
+    with IOTools.openFile(log_prefix + "_log2.tsv", "w") as outf:
         for reason, count in counts.most_common():
             outf.write("%s\t%i\n" % (reason, count))
 
-    with IOTools.openFile(out_prefix + "_barcode_counts2.tsv", "w") as outf:
-        for barcode, count in outfs.most_common():
-            outf.write("%s\t%i\n" % (barcode, count))
-
-    os.unlink(outfile_tmp)
+    with IOTools.openFile(log_prefix + "_barcode_counts2.tsv", "w") as outf:
+        for barcode in cell_barcodes:
+            outf.write("%s\t%i\n" % (barcode, written[barcode]))
 
 
 @cluster_runnable
 def mergeTimepointsGSE65525(infiles, outfile):
     ''' merge gene counts from different timepoints and write out '''
 
-    df = pd.DataFrame()
+    matrices = []
 
     for infile in infiles:
         if "SRR1784310" in infile:
@@ -919,26 +2120,32 @@ def mergeTimepointsGSE65525(infiles, outfile):
         elif "SRR1784315" in infile:
             day = 7
 
-        tmp_df = pd.read_csv(IOTools.openFile(infile, "r"),
-                             sep="\t", index_col=0)
-
-        tmp_df.columns = ["%s_day%i" % (x, day) for x in tmp_df.columns]
+        counts = readCounts(infile)
+        counts.cells = ["%s_day%i" % (x, day) for x in counts.cells]
 
-        df = pd.concat([df, tmp_df], axis=1)
+        matrices.append(counts)
 
-    df.to_csv(outfile, sep="\t", index=True)
+    counts = matrices[0].concat(matrices[1:])
+    counts.writeTable(outfile)
 
 
 @cluster_runnable
-def plotCV(infiles, plotfile, normalise_method):
-    ''' calculate CVs and plot, split by method'''
+def plotCV(infiles, plotfile, normalise_method, max_genes=5000, seed=1):
+    ''' calculate CVs and plot, split by method
+
+    The means and CVs for every method are computed together over the
+    genes with counts for all methods (see meanAndCVByMethod) and saved
+    to <plotfile>.npz (genes, methods, mean and cv arrays). The table
+    read by R for plotting, <plotfile>.tsv, holds a random sample of
+    max_genes of these genes, for every method '''
 
     plotfile2 = plotfile.replace(".png", "_difference.png")
     plotfile3 = plotfile.replace(".png", "_no_unique.png")
     plotfile4 = plotfile.replace(".png", "_vs_mean.png")
     plotfile5 = plotfile.replace(".png", "_difference_hist.png")
 
-    cv_df = pd.DataFrame()
+    methods = []
+    matrices = []
 
     for infile in infiles:
         method = re.sub("_SRR.*", "", os.path.basename(infile)).replace(
@@ -948,29 +2155,33 @@ def plotCV(infiles, plotfile, normalise_method):
         if method == "Transcriptome":
             method = "None"
 
-        tmp_df = Counts.Counts(pd.read_csv(IOTools.openFile(infile, "r"),
-                                           sep="\t", index_col=0))
-
-        tmp_df.removeObservationsFreq(1)
-        tmp_df.normalise(method=normalise_method)
+        counts = readCounts(infile).removeObservationsFreq(1)
 
-        tmp_cv_df = pd.DataFrame({
-            "Method": method,
-            "mean": tmp_df.table.apply(np.mean, axis=1),
-            "cv": tmp_df.table.apply(
-                func=lambda(x): np.std(x)/np.mean(x), axis=1)})
-
-        cv_df = pd.concat([cv_df, tmp_cv_df], axis=0)
+        methods.append(method)
+        matrices.append(counts.normalise(method=normalise_method))
 
     # need to check all genes have CVs for all methods
     # it's possible for some genes to have no CV value for network-based methods
     # if all reads fail the mapq threshold --> all zero counts --> no CV!
-    # we can do this by operating on the index = gene names
+    # so only the genes present for every method are kept
+
+    genes, mean, cv = meanAndCVByMethod(matrices)
 
-    n_methods = len(set(cv_df['Method']))
-    gene_counts = collections.Counter(cv_df.index)
-    retain_genes = [x for x in gene_counts.keys() if gene_counts[x] == n_methods]
-    cv_df = cv_df.ix[retain_genes]
+    with open(plotfile.replace(".png", ".npz"), "wb") as outf:
+        np.savez(outf, genes=np.array(genes), methods=np.array(methods),
+                 mean=mean, cv=cv)
+
+    keep = np.arange(len(genes))
+    if len(genes) > max_genes:
+        random_state = np.random.RandomState(seed)
+        keep = np.sort(random_state.choice(keep, max_genes, replace=False))
+
+    cv_df = pd.DataFrame({
+        "Method": np.tile(methods, len(keep)),
+        "cv": cv[keep].ravel(),
+        "mean": mean[keep].ravel()},
+        index=np.repeat(np.array(genes)[keep], len(methods)),
+        columns=["Method", "cv", "mean"])
 
     table_outfile = plotfile.replace(".png", ".tsv")
     cv_df.to_csv(table_outfile, sep="\t", index=True)
@@ -1102,7 +2313,7 @@ def plotHeatmapGSE65525(infiles,
     ''' '''
 
     plot_heatmap = R('''
-        function(df, plot_outfile, table_outfile){
+        function(df, col_hc, row_hc, plot_outfile, table_outfile){
 
         options(expressions = 10000)
 
@@ -1119,9 +2330,10 @@ def plotHeatmapGSE65525(infiles,
                                 ,ifelse(grepl(".*day4", x), "#56B4E9",
                                         "#F0E442"))))
 
-        d = as.dendrogram(hclust(as.dist(1-cor(log(df+0.1),
-                                       method = "spearman")),
-                         method = "ward.D2"))
+        d = as.dendrogram(col_hc)
+
+        # as heatmap.2 does for the rows when it clusters them itself
+        row_d = reorder(as.dendrogram(row_hc), rowMeans(log(df+0.1)))
 
         colorCodes <- c(day0="grey50", day2="#E69F00",
                         day4="#56B4E9", day7="#F0E442")
@@ -1152,10 +2364,8 @@ def plotHeatmapGSE65525(infiles,
           margin=c(18, 10), keysize=1, cexCol=2,
           dendrogram="column",
           Colv = d,
+          Rowv = row_d,
           ColSideColors=col_cols,
-          hclustfun = function(x) hclust(x, method = 'average'),
-          distfun = function(x) as.dist(1 - cor(t(x),
-                                        method="spearman")),
           labRow=F, labCol=F, key=F)
 
         legend(0, 1,
@@ -1175,7 +2385,7 @@ def plotHeatmapGSE65525(infiles,
         # start with just the uniq
         for infile in [x for x in infiles if "unique" in x]:
 
-            uniq_df = pd.read_table(infile, sep="\t", index_col=0)
+            uniq_df = readCounts(infile).toDataFrame()
 
             counts = Counts.Counts(uniq_df)
             counts.normalise("total-count")
@@ -1190,7 +2400,9 @@ def plotHeatmapGSE65525(infiles,
             plot_table = P.snip(outfile, ".log") + "_dendogram_clusters_uniq.tsv"
             uniq_outfile = P.snip(outfile, ".log") + "_table_uniq.tsv"
 
-            plot_heatmap(top_df, plot_outfile, plot_table)
+            col_hc, row_hc = heatmapHclusts(
+                counts.table, P.snip(plot_outfile, ".png") + "_clustering.npz")
+            plot_heatmap(top_df, col_hc, row_hc, plot_outfile, plot_table)
             counts.table.to_csv(uniq_outfile, sep="\t")
             outf.write("made unique heatmap\n %s" % plot_outfile)
 
@@ -1200,7 +2412,7 @@ def plotHeatmapGSE65525(infiles,
             method = os.path.basename(infile).replace("dedup_", "").replace(
                 "_merged_gene_counts.tsv", "")
 
-            df = pd.io.parsers.read_csv(infile, sep="\t", index_col=0)
+            df = readCounts(infile).toDataFrame()
 
             counts = Counts.Counts(df)
             counts.normalise("total-count")
@@ -1213,35 +2425,33 @@ def plotHeatmapGSE65525(infiles,
             method_outfile = P.snip(outfile, ".log") + "_table_%s.tsv" % method
 
             counts.table.to_csv(method_outfile, sep="\t")
-            plot_heatmap(top_df, plot_outfile, plot_table)
+            col_hc, row_hc = heatmapHclusts(
+                counts.table, P.snip(plot_outfile, ".png") + "_clustering.npz")
+            plot_heatmap(top_df, col_hc, row_hc, plot_outfile, plot_table)
             outf.write("made %s heatmap\n" % method)
 
 
 @cluster_runnable
 def plotPCAGSE65525(infile,
-                    pca_loadings):
-    ''' '''
+                    pca_loadings,
+                    pca_components=10,
+                    pca_seed=1):
+    ''' PCA of the normalised, logged counts. The first pca_components
+    PCs are computed here (see runPCA) and the variance explained, PCs and
+    loadings written out, then read by R for plotting '''
 
     plot_PCA = R('''
 
-    function(df, variance_table, variance_outfile, vector_outfile,
-             pca_outfile1, pca_outfile2, pca_loadings){
+    function(variance_table, variance_outfile, vector_outfile,
+             pca_outfile1, pca_outfile2){
 
     library(ggplot2)
 
-    gene_pca <- prcomp(t(df), center = TRUE)
-
     m_text = element_text(size=15)
     s_text = element_text(size=10)
 
-    variance = gene_pca$sdev^2
-    variance_explained = round(variance/sum(variance), 5)
-
-    variance_df = data.frame("Variance_explained" = variance_explained,
-                         "PC" = seq(1, length(variance)))
-
-    write.table(variance_df, variance_table, sep="\t", quote=FALSE,
-                row.names=FALSE)
+    variance_df = read.table(variance_table, sep="\t", header=TRUE)
+    variance_explained = variance_df$Variance_explained
 
     p_variance = ggplot(variance_df, aes(x=PC, y=Variance_explained))+
     geom_point()+
@@ -1271,18 +2481,9 @@ def plotPCAGSE65525(infile,
 
     g_p = geom_point(size=2, aes(shape=id_2, colour=id_2))
 
-    PCs_df = data.frame(gene_pca$x)
-
-    PCs_df$id_1 = sapply(strsplit(rownames(PCs_df), "_"), "[", 1)
-    PCs_df$id_2 = sapply(strsplit(rownames(PCs_df), "_"), "[", 2)
-    PCs_df$id_2 = gsub("day0", "mES Cells", PCs_df$id_2)
-    PCs_df$id_2 = gsub("day", "day ", PCs_df$id_2)
+    PCs_df = read.table(vector_outfile, sep="\t", header=TRUE)
     PCs_df$id_2 = relevel(as.factor(PCs_df$id_2), "mES Cells")
 
-    write.table(PCs_df, vector_outfile,
-                sep="\t", row.names=FALSE)
-
-
     p_pca1 = ggplot(PCs_df, aes(x=PC1, y=PC2)) +
     g_p + theme_bw() + t + s_c_d + s_s_d +
     xlab(paste0('PC1 (Variance explained = ' ,
@@ -1301,21 +2502,15 @@ def plotPCAGSE65525(infile,
 
     ggsave(pca_outfile2, width=8, height=7)
 
-    loadings = data.frame(gene_pca$rotation)
-    loadings = loadings[,1:10]
-
-    write.table(loadings, pca_loadings, sep="\t", quote=FALSE)
-
     }''')
 
-    df = pd.io.parsers.read_csv(infile, sep="\t", index_col=0)
+    df = readCounts(infile).toDataFrame()
     counts = Counts.Counts(df)
 
     counts.normalise("total-count")
     counts.log()
     # counts.transform(method="vst", design=design, blind=False)
     df = counts.table
-    r_df = com.convert_to_r_dataframe(df)
 
     variance_outfile = P.snip(pca_loadings, "_loadings.tsv") + "_variance.png"
     variance_table = P.snip(pca_loadings, "_loadings.tsv") + "_variance.tsv"
@@ -1323,8 +2518,23 @@ def plotPCAGSE65525(infile,
     pca_outfile1 = P.snip(pca_loadings, "_loadings.tsv") + "_pca1_pca2.png"
     pca_outfile2 = P.snip(pca_loadings, "_loadings.tsv") + "_pca3_pca4.png"
 
-    plot_PCA(r_df, variance_table, variance_outfile, vector_outfile,
-             pca_outfile1, pca_outfile2, pca_loadings)
+    PCs_df, loadings_df, variance_df = runPCA(
+        df, pca_components, pca_seed)
+
+    variance_df.to_csv(variance_table, sep="\t", index=False)
+
+    PCs_df["id_1"] = [x.split("_")[0] for x in PCs_df.index]
+    PCs_df["id_2"] = [x.split("_")[1] for x in PCs_df.index]
+    PCs_df["id_2"] = [x.replace("day0", "mES Cells").replace("day", "day ")
+                      for x in PCs_df["id_2"]]
+    PCs_df.to_csv(vector_outfile, sep="\t", index=False)
+
+    # as write.table with row names, the header has no entry for the genes
+    loadings_df.iloc[:, :10].to_csv(pca_loadings, sep="\t",
+                                    index_label=False)
+
+    plot_PCA(variance_table, variance_outfile, vector_outfile,
+             pca_outfile1, pca_outfile2)
 
 
 @cluster_runnable
@@ -1,69 +1,175 @@
+import os
 import iCLIP
-import pandas
+import numpy
 import pysam
 
 import CGAT.Experiment as E
 from CGAT import IOTools
+import CGATPipelines.Pipeline as P
 from CGATPipelines.Pipeline import cluster_runnable
 from CGAT import Bed
 
 @cluster_runnable
 def getSigHeights(sig_bed, bam_file, outfile):
-    ''' Take a bedgraph of significant x-linked bases and return a begraph of heights '''
+    ''' Take a bedgraph of significant x-linked bases and return a begraph of heights.
+
+    The crosslinked bases for each contig are counted once, over the span of
+    the significant bases on that contig, and the heights of all the
+    significant bases are then looked up together. Bases with no crosslinks
+    are not output. '''
 
-    print iCLIP.__file__
     bam = pysam.AlignmentFile(bam_file)
+    outf = IOTools.openFile(outfile, "w")
+
+    def _output_contig(contig, intervals):
+
+        E.debug("Getting heights for %i intervals on %s"
+                % (len(intervals), contig))
+        span_start = min(start for start, end in intervals)
+        span_end = max(end for start, end in intervals)
+
+        try:
+            reads = bam.fetch(contig, max(0, span_start - 1), span_end + 1)
+        except ValueError as e:
+            E.debug(e)
+            E.warning("Skipping intervals on contig %s as not present in bam"
+                      % contig)
+            return
+
+        pos_depths, neg_depths, _ = iCLIP.countChr(reads, None, "uint32")
+        depths = pos_depths.add(neg_depths, fill_value=0)
+
+        bases = numpy.concatenate([numpy.arange(start, end)
+                                   for start, end in intervals])
+        heights = depths.reindex(bases.astype("float")).dropna()
+
+        for base, height in heights.iteritems():
+            outf.write("%s\t%i\t%i\t%i\n" % (contig, base, base + 1, height))
+
     last_contig = None
     intervals = []
-    outlist = []
     for line in IOTools.openFile(sig_bed):
 
         contig, start, end, pval = line.strip().split("\t")
 
-        if last_contig is None:
-            last_contig = contig
-
         if contig != last_contig:
-            print last_contig
-            out = iCLIP.count_intervals(bam, intervals, last_contig)
-            out.index.name = "start"
-            out.name = "count"
-            out = out.reset_index()
-            out["contig"] = last_contig
-            outlist.append(out)
+            if last_contig is not None:
+                _output_contig(last_contig, intervals)
             intervals = []
             last_contig = contig
-        
-        intervals.append((int(start), int(end)))
 
+        intervals.append((int(start), int(end)))
 
     # output the final chrom
-    out = iCLIP.count_intervals(bam, intervals, last_contig)
-    out.index.name = "start"
-    out.name = "count"
-    out = out.reset_index()
-    out["contig"] = last_contig
-    outlist.append(out)
-    
-    outframe = pandas.concat(outlist)
-    outframe["end"] = outframe["start"] + 1
-    outframe = outframe.loc[:,["contig", "start", "end", "count"]]
-    outframe["start"] = outframe["start"].astype("int")
-    outframe["end"] = outframe["end"].astype("int")
+    if last_contig is not None:
+        _output_contig(last_contig, intervals)
 
-    outframe.to_csv(IOTools.openFile(outfile, "w"), sep="\t", index=False, header=False)
+    outf.close()
 
     
 @cluster_runnable
-def countTagsInClusters(bedfile, bamfile, outfile):
+def countTagsInClusters(bedfile, bamfile, outfile, stranded=False):
+    ''' Count the crosslinked bases in each cluster in bedfile.
+
+    Clusters are counted in a single sweep along each contig, rather than
+    fetching the reads for each cluster. If stranded is True, only sites on
+    the same strand as the cluster are counted, otherwise sites on both
+    strands are counted.
+
+    bamfile can also be a list of bam files, in which case there is one
+    count column for each, named after the bam file. '''
+
+    if isinstance(bamfile, basestring):
+        bamfiles = [bamfile]
+        header = ["position", "count"]
+    else:
+        bamfiles = bamfile
+        header = ["position"] + [
+            P.snip(os.path.basename(fn), ".bam") for fn in bamfiles]
+
+    bams = [pysam.AlignmentFile(fn) for fn in bamfiles]
+    outf = IOTools.openFile(outfile, "w")
+    outf.write("\t".join(header) + "\n")
 
-    bam = pysam.AlignmentFile(bamfile)
+    def _output_contig(contig, clusters):
 
-    outlines = []
+        features = [([(bed.start, bed.end)],
+                     bed.strand if stranded else ".",
+                     i) for i, bed in enumerate(clusters)]
 
+        counts = numpy.zeros((len(clusters), len(bams)), dtype="int64")
+
+        for sample, bam in enumerate(bams):
+            try:
+                reads = bam.fetch(contig)
+            except ValueError as e:
+                E.debug(e)
+                E.warning("Skipping clusters on contig %s as not present in"
+                          " %s" % (contig, bamfiles[sample]))
+                continue
+
+            for i, cluster_count, _ in iCLIP.sweep_features(
+                    iCLIP.iterate_crosslinks(reads), features):
+                counts[i, sample] = cluster_count
+
+        for bed, row in zip(clusters, counts):
+            outf.write("\t".join(
+                ["%s:%i-%i" % (bed.contig, bed.start, bed.end)] +
+                map(str, row)) + "\n")
+
+    last_contig = None
+    clusters = []
     for bed in Bed.iterator(IOTools.openFile(bedfile)):
-        interval = (bed.start, bed.end)
-        counts = iCLIP.count_intervals(bam, [interval], bed.contig).sum()
-        outlines.append(["%s:%i-%i" % (bed.contig, bed.start, bed.end), str(counts)])
 
-    IOTools.writeLines(outfile, outlines, header=["position","count"])
+        if bed.contig != last_contig:
+            if last_contig is not None:
+                _output_contig(last_contig, clusters)
+            clusters = []
+            last_contig = bed.contig
+
+        clusters.append(bed)
+
+    if last_contig is not None:
+        _output_contig(last_contig, clusters)
+
+    outf.close()
+
+
+@cluster_runnable
+def dedupBamAllMethods(infile, outfiles, methods, stats_prefixes=None,
+                       further_stats_prefix=None, per_contig=False,
+                       per_cell=False, counts_outfile=None):
+    ''' Dedup infile with each of methods in one pass, writing the deduped
+    reads for each method to the corresponding entry of outfiles, and
+    index them. The bam is read and the reads grouped by position and UMI
+    only once, and the outputs are written sorted.
+
+    If stats_prefixes are given, the edit distance stats for each method
+    are written to <prefix>_edit_distance.tsv, and if further_stats_prefix
+    is given the cluster topologies and sizes are written to
+    <prefix>_topologies.tsv and <prefix>_nodes.tsv. The number of reads
+    output by each method is written to counts_outfile (not logfile, which
+    cluster_runnable takes for the job log when submitted). '''
+
+    outfiles = dict(zip(methods, outfiles))
+    if stats_prefixes is not None:
+        stats_prefixes = dict(zip(methods, stats_prefixes))
+
+    counts = iCLIP.dedup_bam(infile, outfiles,
+                             stats_prefixes=stats_prefixes,
+                             further_stats_prefix=further_stats_prefix,
+                             per_contig=per_contig,
+                             per_cell=per_cell)
+
+    for outfile in outfiles.values():
+        pysam.index(outfile)
+
+    E.info("%s: %i reads grouped, %i skipped" % (
+        infile, counts["input"], counts["skipped"]))
+
+    if counts_outfile is not None:
+        with IOTools.openFile(counts_outfile, "w") as outf:
+            outf.write("method\treads_in\treads_out\n")
+            for method in methods:
+                outf.write("%s\t%i\t%i\n" % (method, counts["input"],
+                                             counts[method]))
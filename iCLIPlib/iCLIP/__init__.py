@@ -1,8 +1,13 @@
 ''' This a modeule that holds functions and classes useful for analysing iCLIP data '''
 
 from counting import count_intervals, count_transcript, countChr
+from counting import countChrChunks
+from counting import iterate_crosslinks, sweep_features, count_features
 from utils import spread, rand_apply, randomiseSites, TranscriptCoordInterconverter
 from meta import meta_gene, processing_index
 from kmers import pentamer_enrichment, pentamer_frequency
 from distance import calcAverageDistance, findMinDistance, corr_profile
 from clusters import Ph, fdr, get_crosslink_fdr_by_randomisation
+from clusters import call_reproducible_clusters
+from parallel import map_contigs
+from umi import dedup_bam, UMIGrouper
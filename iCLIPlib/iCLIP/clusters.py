@@ -5,6 +5,11 @@ import CGAT.Experiment as E
 import numpy as np
 import pandas as pd
 import CGAT.GTF as GTF
+import CGAT.Bed as Bed
+import CGAT.IOTools as IOTools
+import CGAT.Intervals as Intervals
+import collections
+import heapq
 
 from utils import spread, rand_apply, TranscriptCoordInterconverter
 from counting import count_transcript, count_intervals
@@ -154,3 +159,104 @@ def get_crosslink_fdr_by_randomisation(gtf_iterator, bam,
     return results
 
     
+
+
+##################################################
+def _read_replicate_clusters(bedfile):
+    ''' Read the clusters in a bed12 file into lists of
+    (start, end, blocks) sorted on start, keyed by (contig, strand) '''
+
+    clusters = collections.defaultdict(list)
+    for bed in Bed.iterator(IOTools.openFile(bedfile)):
+        clusters[(bed.contig, bed.strand)].append(
+            (bed.start, bed.end, bed.toIntervals()))
+
+    for key in clusters:
+        clusters[key].sort()
+
+    return clusters
+
+
+def call_reproducible_clusters(bedfiles, outfile, min_overlap=2):
+    ''' Find regions covered by clusters in at least min_overlap of the
+    replicate bed12 files in bedfiles.
+
+    Each file is read once. Then for each contig and strand the
+    replicates are merged into a single sorted stream, and overlapping
+    (or abutting) clusters are merged. Merged regions containing clusters
+    from at least min_overlap different replicates are output. The blocks
+    of the output are the union of the blocks of the clusters in the
+    region, merged where they overlap.
+
+    Output is written as bed12 to outfile, sorted by contig and start,
+    with the number of supporting replicates as the score.
+
+    Returns the number of reproducible clusters found. '''
+
+    replicates = [_read_replicate_clusters(bedfile) for bedfile in bedfiles]
+
+    keys = set()
+    for replicate in replicates:
+        keys.update(replicate.keys())
+
+    contigs = sorted(set(contig for contig, strand in keys))
+
+    def _merge(contig, strand):
+
+        streams = [
+            [(start, end, rep, blocks)
+             for start, end, blocks in replicate.get((contig, strand), [])]
+            for rep, replicate in enumerate(replicates)]
+
+        group_end = None
+        group_reps = set()
+        group_blocks = []
+
+        for start, end, rep, blocks in heapq.merge(*streams):
+
+            if group_end is not None and start > group_end:
+                if len(group_reps) >= min_overlap:
+                    yield (len(group_reps), Intervals.combine(group_blocks))
+                group_end = None
+                group_reps = set()
+                group_blocks = []
+
+            if group_end is None or end > group_end:
+                group_end = end
+            group_reps.add(rep)
+            group_blocks.extend(blocks)
+
+        if group_end is not None and len(group_reps) >= min_overlap:
+            yield (len(group_reps), Intervals.combine(group_blocks))
+
+    nclusters = 0
+    with IOTools.openFile(outfile, "w") as outf:
+
+        for contig in contigs:
+
+            clusters = []
+            for strand in ("+", "-"):
+                for nreps, blocks in _merge(contig, strand):
+                    clusters.append((blocks[0][0], strand, nreps, blocks))
+
+            clusters.sort()
+
+            for start, strand, nreps, blocks in clusters:
+                bed = Bed.Bed()
+                bed.contig = contig
+                # make bed12 so that fromIntervals sets the blocks
+                bed.fields = ["."] * 9
+                bed.fromIntervals(blocks)
+                bed["name"] = "%s:%i-%i" % (contig, bed.start, bed.end)
+                bed["score"] = nreps
+                bed["strand"] = strand
+                bed["thickStart"] = bed.start
+                bed["thickEnd"] = bed.end
+                bed["itemRGB"] = 0
+                outf.write(str(bed) + "\n")
+                nclusters += 1
+
+    E.info("Found %i clusters reproducible in at least %i replicates"
+           % (nclusters, min_overlap))
+
+    return nclusters
@@ -3,10 +3,15 @@ in general they return a pandas Series of read counts. '''
 
 
 import pandas as pd
+import numpy as np
 import collections
+import heapq
+import bisect
+import array
 
 import CGAT.Experiment as E
 import CGAT.GTF as GTF
+import CGAT.Intervals as Intervals
 
 from utils import TranscriptCoordInterconverter
 
@@ -141,6 +146,158 @@ def countChr(reads, chr_len, dtype='uint16'):
     return (pos_depths, neg_depths, counter)
 
 
+##################################################
+def iterate_crosslinks(reads):
+    ''' Generator yielding a (position, is_reverse) tuple for the
+    crosslinked base (see :func:`getCrosslink`) of each read in the
+    coordinate sorted iterator reads, in order of crosslink position.
+
+    Because the crosslinked base can lie before or after the start of
+    the read, sites are held in a small heap until no later read could
+    produce an earlier site. '''
+
+    buffer = []
+    for read in reads:
+
+        # no read starting at or after read.pos can produce a
+        # crosslink before read.pos - 1
+        while buffer and buffer[0][0] < read.pos - 1:
+            yield heapq.heappop(buffer)
+
+        heapq.heappush(buffer, (getCrosslink(read), read.is_reverse))
+
+    while buffer:
+        yield heapq.heappop(buffer)
+
+
+##################################################
+def sweep_features(crosslinks, features):
+    ''' Assign the crosslinked bases on a single contig to the exons and
+    introns of a set of features in a single coordinate sorted pass.
+
+    crosslinks is an iterator of (position, is_reverse) tuples sorted on
+    position, such as that returned by :func:`iterate_crosslinks`.
+
+    features is a list of (exons, strand, data) tuples, where exons is
+    a sorted list of non-overlapping (start, end) tuples, as returned by
+    GTF.asRanges. Sites between the first and last exon that are not
+    in an exon are counted as intronic. Sites are only counted if they
+    are on the same strand as the feature, unless the strand is ".", in
+    which case both strands are counted.
+
+    Yields (data, exon_count, intron_count) tuples as each feature is
+    passed, so output is in order of feature end, not input order. '''
+
+    features = sorted(features, key=lambda x: x[0][0][0])
+    nfeatures = len(features)
+    next_feature = 0
+
+    # heap of (end, index, exon_starts, exon_ends, strand, data, counts)
+    active = []
+
+    def _close(entry):
+        return (entry[5], entry[6][0], entry[6][1])
+
+    for pos, is_reverse in crosslinks:
+
+        while active and active[0][0] <= pos:
+            yield _close(heapq.heappop(active))
+
+        while (next_feature < nfeatures and
+               features[next_feature][0][0][0] <= pos):
+
+            exons, strand, data = features[next_feature]
+            entry = (exons[-1][1], next_feature,
+                     [start for start, end in exons],
+                     [end for start, end in exons],
+                     strand, data, [0, 0])
+
+            if entry[0] <= pos:
+                yield _close(entry)
+            else:
+                heapq.heappush(active, entry)
+
+            next_feature += 1
+
+        site_strand = "-" if is_reverse else "+"
+        for entry in active:
+
+            if entry[4] != "." and entry[4] != site_strand:
+                continue
+
+            exon = bisect.bisect_right(entry[2], pos) - 1
+            if exon >= 0 and pos < entry[3][exon]:
+                entry[6][0] += 1
+            else:
+                entry[6][1] += 1
+
+    while active:
+        yield _close(heapq.heappop(active))
+
+    for exons, strand, data in features[next_feature:]:
+        yield (data, 0, 0)
+
+
+##################################################
+def countChrChunks(reads, chunk_size=1000000, dtype='uint32'):
+    ''' Counts the crosslinked bases for each read in the coordinate
+    sorted pysam iterator reads, one genomic window of chunk_size bases at a
+    time, so that memory use depends on the window size rather than the
+    depth or length of the contig.
+
+    Yields a tuple of (window_start, positive strand Series, negative strand
+    Series) for each window that contains at least one crosslinked base. The
+    Series are indexed on integer genome position and contain only non-zero
+    positions. Windows are yielded in order.
+
+    Overflow of dtype will cause a ValueError. '''
+
+    def _to_series(positions, start):
+
+        if len(positions) == 0:
+            return pd.Series({}, dtype=dtype)
+
+        positions = np.frombuffer(positions, dtype="i%i" % positions.itemsize)
+        counts = np.bincount(positions - start)
+        bases = counts.nonzero()[0]
+        result = pd.Series(counts[bases].astype(dtype), index=bases + start)
+
+        if not result.sum() == len(positions):
+            raise ValueError(
+                "Sum of depths is not equal to number of "
+                "reads counted, possibly dtype %s not large enough" % dtype)
+
+        return result
+
+    window = None
+    pos_sites = array.array("l")
+    neg_sites = array.array("l")
+
+    for pos, is_reverse in iterate_crosslinks(reads):
+
+        if pos // chunk_size != window:
+            if window is not None:
+                start = window * chunk_size
+                yield (start,
+                       _to_series(pos_sites, start),
+                       _to_series(neg_sites, start))
+
+            window = pos // chunk_size
+            pos_sites = array.array("l")
+            neg_sites = array.array("l")
+
+        if is_reverse:
+            neg_sites.append(pos)
+        else:
+            pos_sites.append(pos)
+
+    if window is not None:
+        start = window * chunk_size
+        yield (start,
+               _to_series(pos_sites, start),
+               _to_series(neg_sites, start))
+
+
 ##################################################
 def count_intervals(bam, intervals, contig, strand=".", dtype='uint16'):
     ''' Count the crosslinked bases accross a transcript '''
@@ -194,6 +351,58 @@ def count_intervals(bam, intervals, contig, strand=".", dtype='uint16'):
     return transcript_counts
 
 
+##################################################
+def count_features(bam, features, method="sweep"):
+    ''' Count the crosslinked bases in the exons and introns of each of
+    a list of features in a bam file.
+
+        :param features: list of (contig, exons, strand) tuples, where
+                         exons is as returned by GTF.asRanges
+        :param method: "sweep" to count using :func:`sweep_features`
+                       in a single pass over each contig, or "fetch"
+                       to use :func:`count_intervals` on each feature.
+        :rtype: tuple of numpy arrays of exon and intron counts, in the
+                same order as features '''
+
+    exon_counts = np.zeros(len(features), dtype="uint32")
+    intron_counts = np.zeros(len(features), dtype="uint32")
+
+    if method == "fetch":
+
+        for i, (contig, exons, strand) in enumerate(features):
+            exon_counts[i] = count_intervals(bam, exons, contig, strand,
+                                             dtype="uint32").sum()
+            intron_counts[i] = count_intervals(bam,
+                                               Intervals.complement(exons),
+                                               contig, strand,
+                                               dtype="uint32").sum()
+
+    elif method == "sweep":
+
+        contig_features = collections.defaultdict(list)
+        for i, (contig, exons, strand) in enumerate(features):
+            contig_features[contig].append((exons, strand, i))
+
+        for contig, contig_list in contig_features.iteritems():
+            try:
+                reads = bam.fetch(contig)
+            except ValueError as e:
+                E.debug(e)
+                E.warning("Skipping intervals on contig %s as not present"
+                          " in bam" % contig)
+                continue
+
+            for i, exon_count, intron_count in sweep_features(
+                    iterate_crosslinks(reads), contig_list):
+                exon_counts[i] = exon_count
+                intron_counts[i] = intron_count
+
+    else:
+        raise ValueError("Unknown counting method %s" % method)
+
+    return exon_counts, intron_counts
+
+
 ##################################################
 def count_transcript(transcript, bam, flanks=0):
     '''Count clip sites from a bam and return a Series which transcript 
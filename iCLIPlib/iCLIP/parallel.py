@@ -0,0 +1,109 @@
+''' Functions for spreading genome wide calculations over a pool of
+processes, one contig at a time. '''
+
+import pysam
+
+import CGAT.Experiment as E
+
+
+# set in each worker process by _init_worker
+_bamfiles = None
+_func = None
+_args = None
+
+
+def _open_bam(bamfile):
+    ''' Open bamfile if it is a filename, otherwise assume it is
+    already an open pysam.AlignmentFile '''
+
+    if isinstance(bamfile, basestring):
+        return pysam.AlignmentFile(bamfile)
+    else:
+        return bamfile
+
+
+def _init_worker(bamfiles, func, args):
+
+    global _bamfiles
+    global _func
+    global _args
+
+    _bamfiles = [_open_bam(bamfile) for bamfile in bamfiles]
+    _func = func
+    _args = args
+
+
+def _run_contig(contig):
+
+    chrom, length = contig
+    return (chrom, _func(_bamfiles, chrom, length, *_args))
+
+
+##################################################
+def map_contigs(func, bamfiles, contigs=None, processes=None, args=()):
+    ''' Apply func to each contig of a set of bam files, spreading the
+    contigs over a pool of processes.
+
+    func is called as func(bams, contig, length, \*args), where bams is a
+    list of pysam.AlignmentFile objects, opened once in each worker
+    process. func must be defined at the top level of a module, and
+    its return value must be picklable.
+
+        :param bamfiles: list of bam filenames. If processes is None,
+                         these can also be already open AlignmentFiles
+                         (e.g. reading from stdin).
+        :param contigs: list of (contig, length) tuples. Defaults to
+                        all the references in the first bam file.
+        :param processes: Number of processes to use. If None or 1,
+                          contigs are processed in this process.
+        :param args: extra arguments to pass to func.
+        :rtype: generator of (contig, result) tuples, in the same order
+                as contigs.
+
+    Contigs are submitted to the pool largest first, so that the longest
+    jobs do not hold up the end of the run, but results are yielded in
+    the order given, so that output can be written in sorted order. '''
+
+    if contigs is None:
+        bam = _open_bam(bamfiles[0])
+        contigs = zip(bam.references, bam.lengths)
+
+    contigs = list(contigs)
+
+    pool = None
+    if processes is not None and processes > 1:
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes,
+                                        initializer=_init_worker,
+                                        initargs=(bamfiles, func, args))
+        except ImportError:
+            E.warn("Failed to setup multiprocessing, using single processor")
+            pool = None
+
+    if pool is None:
+        bams = [_open_bam(bamfile) for bamfile in bamfiles]
+        for chrom, length in contigs:
+            E.debug("Processing contig %s" % chrom)
+            yield (chrom, func(bams, chrom, length, *args))
+        return
+
+    by_size = sorted(contigs, key=lambda x: x[1], reverse=True)
+    results = pool.imap_unordered(_run_contig, by_size)
+
+    # hold results that are finished before earlier contigs
+    finished = {}
+    next_contig = 0
+
+    for chrom, result in results:
+        E.debug("Finished contig %s" % chrom)
+        finished[chrom] = result
+
+        while (next_contig < len(contigs) and
+               contigs[next_contig][0] in finished):
+            chrom = contigs[next_contig][0]
+            yield (chrom, finished.pop(chrom))
+            next_contig += 1
+
+    pool.close()
+    pool.join()
@@ -0,0 +1,575 @@
+''' Functions for grouping reads by position and UMI, and deduplicating
+them with the methods of UMI-tools (unique, percentile, cluster, adjacency
+and directional), so that a bam file can be read and grouped once and
+every method applied to the same groups.
+
+UMIs (and, for single cell data, cell barcodes) are taken from the read
+names, which should end _<UMI> or _<cell>_<UMI>. '''
+
+import collections
+import heapq
+import itertools
+import random
+
+import numpy as np
+import pysam
+
+import CGAT.IOTools as IOTools
+
+
+METHODS = ["unique", "percentile", "cluster", "adjacency", "directional"]
+
+
+##################################################
+def get_umi(read):
+    ''' The UMI of a read, the last _ separated field of its name '''
+    return read.query_name.rsplit("_", 1)[-1]
+
+
+def get_cell(read):
+    ''' The cell barcode of a read, the second to last _ separated field of
+    its name '''
+    return read.query_name.rsplit("_", 2)[-2]
+
+
+def get_read_position(read):
+    ''' The position of the 5' end of a read, including any soft clipping,
+    as used for grouping reads by UMI-tools. Returns (position,
+    is_reverse) '''
+
+    if read.is_reverse:
+        position = read.aend
+        if read.cigar[-1][0] == 4:
+            position += read.cigar[-1][1]
+    else:
+        position = read.pos
+        if read.cigar[0][0] == 4:
+            position -= read.cigar[0][1]
+
+    return position, read.is_reverse
+
+
+##################################################
+def edit_distance(first, second):
+    ''' Hamming distance between two UMIs. Any difference in length counts
+    as mismatches '''
+
+    return (sum(a != b for a, b in itertools.izip(first, second)) +
+            abs(len(first) - len(second)))
+
+
+def average_umi_distance(umis):
+    ''' Average edit distance over all the pairs of a list of UMIs, or -1
+    for a single UMI.
+
+    For UMIs of the same length this is computed from the base counts at
+    each position, as the number of pairs that differ at a position is the
+    number of pairs less the pairs with the same base, so no pairs need to
+    be compared. '''
+
+    n = len(umis)
+    if n == 1:
+        return -1
+
+    pairs = n * (n - 1) / 2.0
+    lengths = set(len(umi) for umi in umis)
+
+    if len(lengths) > 1:
+        return sum(edit_distance(a, b)
+                   for a, b in itertools.combinations(umis, 2)) / pairs
+
+    differing = 0
+    for bases in itertools.izip(*umis):
+        same = sum(count * (count - 1) / 2
+                   for count in collections.Counter(bases).itervalues())
+        differing += pairs - same
+
+    return differing / pairs
+
+
+##################################################
+def get_adjacency(umis, threshold=1):
+    ''' Dictionary of the UMIs within threshold edit distance of each of
+    umis. For a threshold of 1, the neighbours are found by looking up each
+    single substitution of each UMI, rather than comparing all pairs '''
+
+    adjacency = dict((umi, []) for umi in umis)
+
+    if threshold == 1:
+        umi_set = set(umis)
+        for umi in umis:
+            for i, base in enumerate(umi):
+                for substitute in "ACGTN":
+                    if substitute == base:
+                        continue
+                    neighbour = umi[:i] + substitute + umi[i+1:]
+                    if neighbour in umi_set:
+                        adjacency[umi].append(neighbour)
+    else:
+        for a, b in itertools.combinations(umis, 2):
+            if edit_distance(a, b) <= threshold:
+                adjacency[a].append(b)
+                adjacency[b].append(a)
+
+    return adjacency
+
+
+def get_directional_adjacency(adjacency, counts):
+    ''' Keep only the edges of adjacency from a UMI to a neighbour with
+    a count no more than (count + 1) / 2, as for the directional method '''
+
+    return dict((umi, [neighbour for neighbour in neighbours
+                       if counts[umi] >= 2 * counts[neighbour] - 1])
+                for umi, neighbours in adjacency.iteritems())
+
+
+def breadth_first_search(node, adjacency):
+    ''' The set of nodes reachable from node '''
+
+    found = set((node,))
+    queue = collections.deque((node,))
+
+    while queue:
+        for neighbour in adjacency[queue.popleft()]:
+            if neighbour not in found:
+                found.add(neighbour)
+                queue.append(neighbour)
+
+    return found
+
+
+def get_components(sorted_umis, adjacency):
+    ''' Split UMIs, sorted by decreasing count, into the sets of nodes
+    reachable from the most abundant UMI not yet in a component. Returns a
+    list of (top UMI, component) tuples '''
+
+    found = set()
+    components = []
+
+    for umi in sorted_umis:
+        if umi not in found:
+            component = breadth_first_search(umi, adjacency)
+            found.update(component)
+            components.append((umi, component))
+
+    return components
+
+
+def get_best_min_account(component, sorted_umis, adjacency):
+    ''' The fewest UMIs from component, taken in order of count, that,
+    with their neighbours, account for all the UMIs in the component '''
+
+    component_umis = [umi for umi in sorted_umis if umi in component]
+
+    if len(component_umis) == 1:
+        return component_umis
+
+    remaining = set(component)
+    for i, umi in enumerate(component_umis):
+        remaining.discard(umi)
+        remaining.difference_update(adjacency[umi])
+        if not remaining:
+            return component_umis[:i + 1]
+
+    return component_umis
+
+
+def get_topology(component, adjacency):
+    ''' Classify a cluster of UMIs as a single node, a single hub (one UMI
+    adjacent to all the others) or complex '''
+
+    if len(component) == 1:
+        return "single node"
+
+    for umi in component:
+        if len(set(adjacency[umi]) & component) == len(component) - 1:
+            return "single hub"
+
+    return "complex"
+
+
+def dedup_umis(counts, methods=METHODS, threshold=1):
+    ''' Apply each of methods to a group of UMIs at one position.
+
+        :param counts: dictionary of the number of reads with each UMI.
+        :param methods: the methods to apply.
+        :param threshold: edit distance for UMIs to be adjacent.
+        :rtype: dictionary of the UMIs representing a molecule under each
+                method, and the list of clusters (connected components)
+                of UMIs with the undirected adjacency
+
+    The network methods share the same adjacency, built once. '''
+
+    sorted_umis = sorted(counts, key=lambda umi: (-counts[umi], umi))
+    selected = {}
+
+    if "unique" in methods:
+        selected["unique"] = sorted_umis
+
+    if "percentile" in methods:
+        if len(sorted_umis) == 1:
+            selected["percentile"] = sorted_umis
+        else:
+            cutoff = np.median(counts.values()) / 100.0
+            selected["percentile"] = [umi for umi in sorted_umis
+                                      if counts[umi] > cutoff]
+
+    clusters = None
+    network_methods = set(methods) & set(("cluster", "adjacency",
+                                          "directional"))
+
+    if network_methods:
+        adjacency = get_adjacency(sorted_umis, threshold)
+        clusters = get_components(sorted_umis, adjacency)
+
+        if "cluster" in methods:
+            selected["cluster"] = [umi for umi, component in clusters]
+
+        if "adjacency" in methods:
+            selected["adjacency"] = []
+            for umi, component in clusters:
+                selected["adjacency"].extend(
+                    get_best_min_account(component, sorted_umis, adjacency))
+
+        if "directional" in methods:
+            directional = get_directional_adjacency(adjacency, counts)
+            selected["directional"] = [
+                umi for umi, component in
+                get_components(sorted_umis, directional)]
+
+        clusters = [(component, adjacency) for umi, component in clusters]
+
+    return selected, clusters
+
+
+##################################################
+class UMIGroup(object):
+    ''' The reads at one position (or on one contig) with each UMI. counts
+    holds the number of reads with each UMI, reads the read chosen to
+    represent each UMI, and draws, if random draws are kept, the uniform
+    random number drawn for each read with each UMI '''
+
+    __slots__ = ("counts", "reads", "draws")
+
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+        self.reads = {}
+        self.draws = None
+
+
+class UMIGrouper(object):
+    ''' Group the reads from a coordinate sorted bam by position (or contig)
+    and UMI, as UMI-tools does, reading the bam once.
+
+        :param reads: iterator of pysam.AlignedSegments, sorted by
+                      position.
+        :param per_contig: group all the reads on a contig, whatever their
+                           position or strand (e.g. for transcriptomes).
+        :param per_cell: group the reads from each cell separately.
+        :param window: reads are grouped by the position of their 5' end,
+                       including soft clipping, so a group is only complete
+                       once reads start window bases after it.
+        :param keep_reads: choose a read to represent each UMI, the read
+                           with the highest mapq, with ties broken at
+                           random.
+        :param random_draws: give each read a uniform random number, and
+                             keep those for the reads with each UMI.
+        :param seed: seed for the random numbers.
+
+    Iterating yields (contig, key, group) for each group, where key is
+    (position, is_reverse, cell), or (cell,) if per_contig, and group is a
+    UMIGroup. While groups are yielded, flush_pos is no more than the start
+    of any read in a group not yet processed, so that reads chosen from the
+    groups can be written out in sorted order, or None at the end of a
+    contig. Unmapped, secondary and supplementary alignments are skipped.
+    counts holds the number of reads grouped and skipped, and umi_counts
+    the number of reads with each UMI over the whole file. '''
+
+    def __init__(self, reads, per_contig=False, per_cell=False, window=1000,
+                 keep_reads=True, random_draws=False, seed=None):
+
+        self.reads = reads
+        self.per_contig = per_contig
+        self.per_cell = per_cell
+        self.window = window
+        self.keep_reads = keep_reads
+        self.random_draws = random_draws
+        self.random = random.Random(seed)
+
+        self.flush_pos = None
+        self.counts = collections.Counter()
+        self.umi_counts = collections.Counter()
+
+    def __iter__(self):
+
+        groups = {}
+        # heap of (position, key) for the groups, to find finished groups
+        pending = []
+        # heap of (start of first read, key) for the groups, to find
+        # flush_pos. Entries for groups already yielded are skipped lazily
+        starts = []
+        contig = None
+
+        for read in self.reads:
+
+            if read.is_unmapped or read.is_secondary or \
+               read.is_supplementary:
+                self.counts["skipped"] += 1
+                continue
+
+            if read.reference_id != contig:
+                for output in self._finish(contig, groups, pending, starts):
+                    yield output
+                contig = read.reference_id
+
+            if self.per_contig:
+                key = (get_cell(read),) if self.per_cell else (None,)
+                position = 0
+            else:
+                position, is_reverse = get_read_position(read)
+                cell = get_cell(read) if self.per_cell else None
+                key = (position, is_reverse, cell)
+
+                if pending and pending[0][0] < read.pos - self.window:
+                    for output in self._finish(contig, groups, pending,
+                                               starts, read.pos):
+                        yield output
+
+            group = groups.get(key)
+            if group is None:
+                group = UMIGroup()
+                groups[key] = group
+                heapq.heappush(pending, (position, key))
+                heapq.heappush(starts, (read.pos, key, id(group)))
+
+            self._add(group, read)
+
+        for output in self._finish(contig, groups, pending, starts):
+            yield output
+
+    def _add(self, group, read):
+
+        umi = get_umi(read)
+        self.counts["grouped"] += 1
+        self.umi_counts[umi] += 1
+
+        group.counts[umi] += 1
+
+        if self.random_draws:
+            if group.draws is None:
+                group.draws = collections.defaultdict(list)
+            group.draws[umi].append(self.random.random())
+
+        if not self.keep_reads:
+            return
+
+        current = group.reads.get(umi)
+        if current is None or read.mapq > current.mapq:
+            group.reads[umi] = read
+        elif (read.mapq == current.mapq and
+              self.random.random() < 1.0 / group.counts[umi]):
+            group.reads[umi] = read
+
+    def _finish(self, contig, groups, pending, starts, current_pos=None):
+        ''' yield the groups at positions more than window before
+        current_pos, or all the groups if current_pos is None '''
+
+        if current_pos is None:
+            self.flush_pos = None
+            finished = [key for position, key in sorted(pending)]
+            del pending[:]
+            del starts[:]
+        else:
+            # the finished groups are still counted here, as they are
+            # yielded one by one
+            while starts and id(groups.get(starts[0][1])) != starts[0][2]:
+                heapq.heappop(starts)
+            self.flush_pos = min(starts[0][0], current_pos) if starts \
+                else current_pos
+
+            finished = []
+            while pending and pending[0][0] < current_pos - self.window:
+                finished.append(heapq.heappop(pending)[1])
+
+        for key in finished:
+            yield contig, key, groups.pop(key)
+
+
+##################################################
+def _histogram(values, maximum):
+    ''' counts of the values (average edit distances, -1 for single UMIs)
+    in integer bins from -1 to maximum '''
+
+    bins = np.arange(-1, maximum + 2)
+    return np.histogram(values, bins=bins)[0]
+
+
+def _null_distances(sizes, umi_counts, rng):
+    ''' Average edit distances for groups of the given sizes of UMIs drawn
+    at random from the frequencies of all the UMIs in the file, the null
+    expectation for the edit distances after deduping. Groups of the same
+    size are drawn together '''
+
+    umis = umi_counts.keys()
+    frequencies = np.array(umi_counts.values(), dtype=np.float64)
+    frequencies /= frequencies.sum()
+
+    distances = []
+    for size, n in collections.Counter(sizes).iteritems():
+        if size == 1:
+            distances.extend([-1] * n)
+            continue
+        draws = rng.choice(len(umis), (n, size), p=frequencies)
+        distances.extend(average_umi_distance([umis[x] for x in row])
+                         for row in draws)
+
+    return distances
+
+
+def write_edit_distances(outfile, method, distances, null_distances):
+    ''' Write the histogram of average edit distances between the UMIs at
+    each position before (unique) and after deduping with method, and the
+    null expectation for each, as UMI-tools dedup --output-stats does '''
+
+    columns = ["unique", "unique_null"]
+    if method != "unique":
+        columns.extend([method, method + "_null"])
+
+    values = {"unique": distances["unique"],
+              "unique_null": null_distances["unique"],
+              method: distances[method],
+              method + "_null": null_distances[method]}
+
+    maximum = int(max([max(values[column] + [-1]) for column in columns]))
+    histograms = dict((column, _histogram(values[column], maximum))
+                      for column in columns)
+
+    with IOTools.openFile(outfile, "w") as outf:
+        outf.write("%s\tedit_distance\n" % "\t".join(columns))
+        for i, edit_distance in enumerate(range(-1, maximum + 1)):
+            if edit_distance == -1:
+                edit_distance = "Single_UMI"
+            outf.write("%s\t%s\n" % (
+                "\t".join(str(histograms[column][i]) for column in columns),
+                edit_distance))
+
+
+##################################################
+def dedup_bam(infile, outfiles, stats_prefixes=None, further_stats_prefix=None,
+              per_contig=False, per_cell=False, threshold=1, window=1000,
+              seed=None):
+    ''' Deduplicate a coordinate sorted bam with several UMI-tools methods,
+    reading and grouping the bam only once.
+
+        :param infile: bam filename.
+        :param outfiles: dictionary of the output bam filename for each
+                         method in METHODS to apply.
+        :param stats_prefixes: dictionary of a prefix for each method. If
+                               given, the edit distance stats for the
+                               method are written to
+                               <prefix>_edit_distance.tsv
+        :param further_stats_prefix: if given, the topology and number of
+                                     UMIs of each cluster of UMIs is
+                                     written to <prefix>_topologies.tsv
+                                     and <prefix>_nodes.tsv.
+        :param per_contig: group reads by contig rather than position.
+        :param per_cell: dedup the reads for each cell separately.
+        :param threshold: edit distance for UMIs to be adjacent.
+        :rtype: Counter of the number of input and output reads.
+
+    The output bams are written in coordinate order, so they do not need to
+    be sorted again. '''
+
+    methods = [method for method in METHODS if method in outfiles]
+    stats_prefixes = stats_prefixes or {}
+
+    inbam = pysam.AlignmentFile(infile)
+    outbams = dict((method, pysam.AlignmentFile(outfiles[method], "wb",
+                                                template=inbam))
+                   for method in methods)
+
+    grouper = UMIGrouper(inbam.fetch(until_eof=True), per_contig, per_cell,
+                         window, keep_reads=True, seed=seed)
+
+    # reads waiting to be written, for each method, as (pos, n, read)
+    waiting = dict((method, []) for method in methods)
+    serial = itertools.count()
+
+    counts = collections.Counter()
+    distances = collections.defaultdict(list)
+    sizes = collections.defaultdict(list)
+    topologies = collections.Counter()
+    nodes = collections.Counter()
+
+    def _flush(before):
+        for method in methods:
+            heap = waiting[method]
+            while heap and (before is None or heap[0][0] < before):
+                outbams[method].write(heapq.heappop(heap)[2])
+
+    last_contig = None
+    for contig, key, group in grouper:
+
+        if contig != last_contig:
+            _flush(None)
+            last_contig = contig
+
+        selected, clusters = dedup_umis(group.counts, methods, threshold)
+
+        for method in methods:
+            heap = waiting[method]
+            for umi in selected[method]:
+                read = group.reads[umi]
+                heapq.heappush(heap, (read.pos, next(serial), read))
+            counts[method] += len(selected[method])
+
+        if stats_prefixes:
+            distances["unique"].append(
+                average_umi_distance(group.counts.keys()))
+            sizes["unique"].append(len(group.counts))
+            for method in methods:
+                if method != "unique":
+                    distances[method].append(
+                        average_umi_distance(selected[method]))
+                    sizes[method].append(len(selected[method]))
+
+        if further_stats_prefix and clusters is not None:
+            for component, adjacency in clusters:
+                topologies[get_topology(component, adjacency)] += 1
+                nodes[len(component)] += 1
+
+        if grouper.flush_pos is not None:
+            _flush(grouper.flush_pos)
+
+    _flush(None)
+
+    for outbam in outbams.values():
+        outbam.close()
+    inbam.close()
+
+    counts["input"] = grouper.counts["grouped"]
+    counts["skipped"] = grouper.counts["skipped"]
+
+    if stats_prefixes:
+        rng = np.random.RandomState(seed)
+        null_distances = dict(
+            (method, _null_distances(sizes[method], grouper.umi_counts, rng))
+            for method in sizes)
+        for method in methods:
+            if method in stats_prefixes:
+                write_edit_distances(
+                    stats_prefixes[method] + "_edit_distance.tsv",
+                    method, distances, null_distances)
+
+    if further_stats_prefix:
+        with IOTools.openFile(further_stats_prefix + "_topologies.tsv",
+                              "w") as outf:
+            for topology, count in sorted(topologies.iteritems()):
+                outf.write("%s\t%i\n" % (topology, count))
+
+        with IOTools.openFile(further_stats_prefix + "_nodes.tsv",
+                              "w") as outf:
+            for size, count in sorted(nodes.iteritems()):
+                outf.write("%i\t%i\n" % (size, count))
+
+    return counts
@@ -2,13 +2,19 @@ import CGAT.GTF as GTF
 import CGAT.IOTools as IOTools
 import CGATPipelines.Pipeline as P
 import CGAT.FastaIterator as FastaIterator
+import CGAT.Bed as Bed
 import CGAT.Experiment as E
 #import CGATPipelines.PipelineUtilities as PUtils
 from CGATPipelines.Pipeline import cluster_runnable
 import pandas
 import os
 import re
+import bisect
+import collections
+import heapq
+import random
 import pysam
+import iCLIP
 
 # The PARAMS dictionary must be provided by the importing
 # code
@@ -105,34 +111,11 @@ def callClusters(bamfile, gtffile, outfiles,
 
 
 ###################################################################
+@cluster_runnable
 def callReproducibleClusters(infiles, outfile, min_overlap):
     '''Find clusters that appear in more than one replicate'''
 
-    checkParams()
-
-    merge_template = '''<( zcat %s
-                          | sort -k1,1 -k2,2n
-                          | python %s/bed2bed.py
-                          --method=merge
-                          --merge-and-resolve-blocks
-                          --merge-stranded
-                           -L /dev/null
-                            ) '''
-    infiles = " ".join(
-        [merge_template % (infile, PARAMS["scriptsdir"])
-         for infile in infiles])
-    logfile = P.snip(outfile, ".bed.gz")
-    statement = ''' cat %(infiles)s
-                  | sort -k1,1 -k2,2n -k3,3n
-                  | python %(scriptsdir)s/bed2bed.py
-                          --method=merge
-                          --merge-and-resolve-blocks
-                          --merge-min-intervals=%(min_overlap)s
-                          --merge-stranded
-                           -L %(logfile)s.log
-                  | gzip > %(outfile)s '''
-
-    P.run()
+    iCLIP.call_reproducible_clusters(infiles, outfile, int(min_overlap))
 
 
 ###################################################################
@@ -213,77 +196,205 @@ def makeClustersUCSC(infiles, outfile, group, label):
 
 
 ###################################################################
-def subsampleNReadsFromFasta(infile, outfile, nreads, logfile=""):
+def reservoirSample(iterator, n, seed=None, weight=None):
+    ''' Sample exactly n items (or all items if there are fewer than n)
+    from iterator in a single pass.
+
+    If weight is given it should be a function returning a positive
+    weight for each item, and items are sampled with probability
+    proportional to their weight (algorithm A-Res of Efraimidis and
+    Spirakis). Items with a weight of 0 or less are never sampled.
+    Otherwise every item has an equal chance of being sampled (algorithm
+    R).
+
+    Returns the sampled items in the order they appeared in iterator. '''
+
+    rng = random.Random(seed)
+    reservoir = []
+
+    if weight is None:
+        for i, item in enumerate(iterator):
+            if i < n:
+                reservoir.append((i, item))
+            else:
+                j = rng.randint(0, i)
+                if j < n:
+                    reservoir[j] = (i, item)
+
+        reservoir.sort(key=lambda x: x[0])
+        return [item for i, item in reservoir]
+
+    # heap of the n largest keys seen so far
+    for i, item in enumerate(iterator):
+        w = weight(item)
+        if w <= 0:
+            continue
+
+        key = rng.random() ** (1.0/w)
+        if len(reservoir) < n:
+            heapq.heappush(reservoir, (key, i, item))
+        elif key > reservoir[0][0]:
+            heapq.heapreplace(reservoir, (key, i, item))
+
+    reservoir.sort(key=lambda x: x[1])
+    return [item for key, i, item in reservoir]
 
-    checkParams()
 
-    nseqs = FastaIterator.count(infile)
+###################################################################
+def subsampleNReadsFromFasta(infile, outfile, nreads, logfile="",
+                             seed=None, weight=None):
+    ''' Write a random sample of nreads sequences from infile to outfile,
+    reading infile once. See reservoirSample for the meaning of seed and
+    weight, which is called on each FastaRecord. '''
 
-    if nreads > nseqs:
-        prop = 1
-    else:    
-        prop = float(nreads)/float(nseqs)
+    nreads = int(nreads)
+    nseqs = [0]
 
-    if logfile:
-        logfile = "-L %s" % logfile
+    def _count(records):
+        for record in records:
+            nseqs[0] += 1
+            yield record
 
-    statement = ''' python %(scriptsdir)s/fasta2fasta.py 
-                     -I %(infile)s
-                     %(logfile)s
-                     -m sample
-                     --sample-proportion=%(prop)s
-                     -S %(outfile)s '''
+    sample = reservoirSample(
+        _count(FastaIterator.iterate(IOTools.openFile(infile))),
+        nreads, seed=seed, weight=weight)
 
-    P.run()
+    with IOTools.openFile(outfile, "w") as outf:
+        for record in sample:
+            outf.write(">%s\n%s\n" % (record.title, record.sequence))
+
+    if logfile:
+        with IOTools.openFile(logfile, "a") as logf:
+            logf.write("sampled %i of %i sequences from %s\n"
+                       % (len(sample), nseqs[0], infile))
 
 
 ###################################################################
+def _get_junctions(read):
+    ''' Return a list of the (start, end) of the skipped regions in read,
+    from its cigar tuples '''
+
+    junctions = []
+    pos = read.reference_start
+    for operation, length in read.cigartuples:
+        if operation == 3:
+            junctions.append((pos, pos + length))
+            pos += length
+        elif operation in (0, 2, 7, 8):
+            pos += length
+
+    return junctions
+
+
 @cluster_runnable
-def calculateSplicingIndex(bamfile, gtffile, outfile):
+def calculateSplicingIndex(bamfile, gtffile, outfile, intron_outfile=None):
+    ''' Count reads spliced at annotated introns, and unspliced reads that
+    cross an exon-intron or intron-exon boundary by at least 3 bases.
+
+    Introns are read from gtffile once and then each contig of the bamfile
+    is read in a single pass. Spliced reads are categorised by looking up
+    each of their junctions in the set of annotated introns. Unspliced reads
+    are categorised using sorted arrays of the intron boundaries. Reads that
+    do not overlap an intron are ignored.
+
+    Introns shared by several transcripts are counted once. An intron
+    annotated on both strands is given the strand ".", and its boundaries
+    are categorised as for the + strand.
+
+    If intron_outfile is given, the Exon_Exon, Exon_Intron and Intron_Exon
+    counts for each intron are written to it. '''
 
     bamfile = pysam.AlignmentFile(bamfile)
 
     counts = E.Counter()
 
+    # for each contig, a dictionary of (start, end) -> strand
+    introns = collections.defaultdict(dict)
+
     for transcript in GTF.transcript_iterator(
             GTF.iterator(IOTools.openFile(gtffile))):
 
-        introns = GTF.toIntronIntervals(transcript)
-        E.debug("Gene %s (%s), Transcript: %s, %i introns" %
-                (transcript[0].gene_id,
-                 transcript[0].contig,
-                 transcript[0].transcript_id,
-                 len(introns)))
-
-        for intron in introns:
-            reads = bamfile.fetch(
-                reference=transcript[0].contig,
-                start=intron[0], end=intron[1])
-            
-            for read in reads:
-                if 'N' in read.cigarstring:
-                    blocks = read.get_blocks()
-                    starts, ends = zip(*blocks)
-                    if intron[0] in ends and intron[1] in starts:
+        contig = transcript[0].contig
+        strand = transcript[0].strand
+        for intron in GTF.toIntronIntervals(transcript):
+            intron = tuple(intron)
+            known_strand = introns[contig].get(intron, strand)
+            introns[contig][intron] = strand if known_strand == strand \
+                else "."
+
+    # for each contig, a list of (position, intron, category) for each
+    # boundary of each distinct intron
+    boundaries = collections.defaultdict(list)
+
+    for contig, contig_introns in introns.iteritems():
+        for intron, strand in contig_introns.iteritems():
+
+            if strand == "-":
+                five, three = "Intron_Exon", "Exon_Intron"
+            else:
+                five, three = "Exon_Intron", "Intron_Exon"
+
+            boundaries[contig].append((intron[0], intron, five))
+            boundaries[contig].append((intron[1], intron, three))
+
+    intron_counts = collections.defaultdict(E.Counter)
+
+    for contig in introns:
+
+        if contig not in bamfile.references:
+            E.warn("Contig %s not in bam file, skipping" % contig)
+            continue
+
+        contig_boundaries = sorted(boundaries[contig])
+        boundary_positions = [b[0] for b in contig_boundaries]
+
+        # for testing overlap with any intron: sorted starts, and the
+        # largest end of all introns up to each start.
+        sorted_introns = sorted(introns[contig])
+        intron_starts = [start for start, end in sorted_introns]
+        max_ends = []
+        max_end = 0
+        for start, end in sorted_introns:
+            max_end = max(max_end, end)
+            max_ends.append(max_end)
+
+        E.debug("Contig %s: %i introns" % (contig, len(sorted_introns)))
+
+        for read in bamfile.fetch(contig):
+
+            read_start = read.reference_start
+            read_end = read.reference_end
+
+            last_intron = bisect.bisect_left(intron_starts, read_end) - 1
+            if last_intron < 0 or max_ends[last_intron] <= read_start:
+                continue
+
+            junctions = _get_junctions(read)
+
+            if junctions:
+                matched = [junction for junction in junctions
+                           if junction in introns[contig]]
+                if matched:
+                    for junction in matched:
                         counts["Exon_Exon"] += 1
-                    else:
-                        counts["spliced_uncounted"] += 1
-                elif (read.reference_start <= intron[0] - 3
-                      and read.reference_end >= intron[0] + 3):
-                    if transcript[0].strand == "+":
-                        counts["Exon_Intron"] += 1
-                    else:
-                        counts["Intron_Exon"] += 1
-                elif (read.reference_start <= intron[1] - 3
-                      and read.reference_end >= intron[1] + 3):
-                    if transcript[0].strand == "+":
-                        counts["Intron_Exon"] += 1
-                    else:
-                        counts["Exon_Intron"] += 1
+                        intron_counts[(contig, junction)]["Exon_Exon"] += 1
                 else:
-                    counts["unspliced_uncounted"] += 1
+                    counts["spliced_uncounted"] += 1
+                continue
+
+            first = bisect.bisect_left(boundary_positions, read_start + 3)
+            last = bisect.bisect_right(boundary_positions, read_end - 3)
+
+            if first >= last:
+                counts["unspliced_uncounted"] += 1
+                continue
+
+            for position, intron, category in contig_boundaries[first:last]:
+                counts[category] += 1
+                intron_counts[(contig, intron)][category] += 1
 
         E.debug("Done, counts are: " + str(counts))
+
     header = ["Exon_Exon",
               "Exon_Intron",
               "Intron_Exon",
@@ -296,6 +407,297 @@ def calculateSplicingIndex(bamfile, gtffile, outfile):
         outf.write("\t".join(map(str, [counts[col] for col in header]))
                    + "\n")
 
+    if intron_outfile:
+        with IOTools.openFile(intron_outfile, "w") as outf:
+            outf.write("\t".join(["contig", "start", "end", "strand"] +
+                                 header[:3]) + "\n")
+            for contig in sorted(introns):
+                for intron in sorted(introns[contig]):
+                    intron_count = intron_counts[(contig, intron)]
+                    outf.write("\t".join(
+                        [contig, str(intron[0]), str(intron[1]),
+                         introns[contig][intron]] +
+                        [str(intron_count[col]) for col in header[:3]])
+                        + "\n")
 
-        
 
+###################################################################
+class ContextCounter(object):
+    ''' Find the contexts (names of the intervals in a bed file, such as
+    that made by generateContextBed) that alignments overlap, as
+    bam_vs_bed.py does: an alignment is in a context once for each
+    interval covering at least min_overlap of its span.
+
+    The intervals on a contig are swept in as alignments move along it.
+    Alignments should come in order of position on each contig, or, if
+    not, release should be called with a position no greater than the
+    start of any alignment still to come, after which intervals ending
+    before it are forgotten. '''
+
+    def __init__(self, bedfile, min_overlap=0.5):
+
+        self.intervals = collections.defaultdict(list)
+        for bed in Bed.iterator(IOTools.openFile(bedfile)):
+            self.intervals[bed.contig].append((bed.start, bed.end, bed.name))
+
+        for contig in self.intervals:
+            self.intervals[contig].sort()
+
+        self.min_overlap = min_overlap
+        self._start_contig(None)
+
+    def _start_contig(self, contig):
+
+        self.contig = contig
+        self.contig_intervals = self.intervals.get(contig, [])
+        self.next_interval = 0
+        self.active = []
+        self.min_end = None
+
+    def contexts(self, contig, start, end):
+        ''' The names of the intervals covering at least min_overlap of
+        start to end on contig, once for each interval '''
+
+        if contig != self.contig:
+            self._start_contig(contig)
+
+        intervals = self.contig_intervals
+        while (self.next_interval < len(intervals) and
+               intervals[self.next_interval][0] < end):
+            interval = intervals[self.next_interval]
+            self.active.append(interval)
+            if self.min_end is None or interval[1] < self.min_end:
+                self.min_end = interval[1]
+            self.next_interval += 1
+
+        min_bases = self.min_overlap * (end - start)
+        return [name for interval_start, interval_end, name in self.active
+                if min(end, interval_end) - max(start, interval_start) >=
+                max(min_bases, 1)]
+
+    def release(self, pos):
+        ''' Forget the intervals ending at or before pos '''
+
+        if self.min_end is None or pos < self.min_end:
+            return
+
+        self.active = [interval for interval in self.active
+                       if interval[1] > pos]
+        self.min_end = min(interval[1] for interval in self.active) \
+            if self.active else None
+
+
+###################################################################
+SATURATION_FRACTIONS = ([1.0/(2 ** x) for x in range(5, 0, -1)] +
+                        [x/10.0 for x in range(6, 11)])
+
+
+@cluster_runnable
+def saturationAnalysis(bamfile, context_bed, outfiles, method="cluster",
+                       fractions=SATURATION_FRACTIONS, seed=None):
+    ''' Count the unique molecules and the molecules in each context that
+    would be found if only a fraction of the reads in bamfile had been
+    sequenced, for each of fractions.
+
+    Rather than subsetting and deduping the bam once for each fraction,
+    each read is given a single uniform random number, and the reads are
+    grouped by position and UMI once. Then for each fraction, the UMIs in
+    each group are counted from the reads with a random number below the
+    fraction, and deduped with method. Deduped molecules are placed in
+    contexts in context_bed using the read chosen to represent each UMI
+    in the full set of reads.
+
+    outfiles are the molecule counts, as the reads_total, reads_mapped,
+    alignments_total and alignments_mapped categories of bam2stats.py
+    (all the same, as there is one alignment per molecule), and the
+    context counts, as bam_vs_bed.py, each with a subset column. No
+    intermediate bam files are written. '''
+
+    stats_outfile, context_outfile = outfiles
+    fractions = sorted(fractions)
+
+    counter = ContextCounter(context_bed)
+    inbam = pysam.AlignmentFile(bamfile)
+    grouper = iCLIP.UMIGrouper(inbam.fetch(until_eof=True),
+                               random_draws=True, seed=seed)
+
+    molecules = collections.Counter()
+    contexts = collections.defaultdict(collections.Counter)
+
+    for contig, key, group in grouper:
+
+        contig = inbam.references[contig]
+        draws = dict((umi, sorted(umi_draws))
+                     for umi, umi_draws in group.draws.iteritems())
+        umi_contexts = {}
+
+        for fraction in fractions:
+            counts = {}
+            for umi, umi_draws in draws.iteritems():
+                n = bisect.bisect_left(umi_draws, fraction)
+                if n > 0:
+                    counts[umi] = n
+
+            if not counts:
+                continue
+
+            selected = iCLIP.umi.dedup_umis(counts, [method])[0][method]
+            molecules[fraction] += len(selected)
+
+            for umi in selected:
+                if umi not in umi_contexts:
+                    read = group.reads[umi]
+                    umi_contexts[umi] = counter.contexts(
+                        contig, read.pos, read.aend)
+                for context in umi_contexts[umi]:
+                    contexts[fraction][context] += 1
+
+        if grouper.flush_pos is not None:
+            counter.release(grouper.flush_pos)
+
+    inbam.close()
+
+    E.info("%s: %i reads grouped, %i skipped" % (
+        bamfile, grouper.counts["grouped"], grouper.counts["skipped"]))
+
+    with IOTools.openFile(stats_outfile, "w") as outf:
+        outf.write("subset\tcategory\tcounts\n")
+        for fraction in fractions:
+            for category in ("reads_total", "reads_mapped",
+                             "alignments_total", "alignments_mapped"):
+                outf.write("%.3f\t%s\t%i\n" % (fraction, category,
+                                               molecules[fraction]))
+
+    with IOTools.openFile(context_outfile, "w") as outf:
+        outf.write("subset\tcategory\talignments\n")
+        for fraction in fractions:
+            outf.write("%.3f\ttotal\t%i\n" % (fraction, molecules[fraction]))
+            for context, count in sorted(contexts[fraction].iteritems()):
+                outf.write("%.3f\t%s\t%i\n" % (fraction, context, count))
+
+
+###################################################################
+BAM_FLAGS = {1: "paired",
+             2: "proper_pair",
+             4: "unmapped",
+             8: "mate_unmapped",
+             16: "reverse",
+             32: "mate_reverse",
+             64: "read1",
+             128: "read2",
+             256: "secondary",
+             512: "qc_fail",
+             1024: "duplicate",
+             2048: "supplementary"}
+
+
+def _percent(numerator, denominator):
+    if denominator == 0:
+        return "na"
+    return "%5.2f" % (100.0 * numerator / denominator)
+
+
+@cluster_runnable
+def collectBamStats(bamfile, context_bed, prefix, min_overlap=0.5):
+    ''' Compute the statistics that were calculated by separate scans of
+    each deduped bam in a single pass over bamfile:
+
+        * <prefix>.bam_stats.tsv: alignment flag and mapping counts, in the
+          format of bam2stats.py (reads from NH tags as when bam2stats.py
+          reads from stdin, without the error rates or pair stats).
+        * <prefix>.nspliced.txt: the number of alignments with an N in the
+          cigar.
+        * <prefix>.umi_stats.tsv.gz: the number of reads with each UMI.
+        * <prefix>.reference_context.tsv: the number of alignments in
+          each context in context_bed, as bam_vs_bed.py, using
+          ContextCounter.
+
+    Fragment lengths are not computed here, so that the deduped and
+    mapped fragment lengths, which are compared in the report, come from
+    the same code (length_stats.py). '''
+
+    flags = collections.Counter()
+    nh = collections.Counter()
+    umis = collections.Counter()
+    contexts = collections.Counter()
+    nalignments = 0
+    nspliced = 0
+
+    counter = ContextCounter(context_bed, min_overlap=min_overlap)
+    inbam = pysam.AlignmentFile(bamfile)
+
+    for read in inbam.fetch(until_eof=True):
+
+        nalignments += 1
+        for bit, flag in BAM_FLAGS.iteritems():
+            if read.flag & bit:
+                flags[flag] += 1
+
+        if read.cigartuples and \
+           any(operation == 3 for operation, length in read.cigartuples):
+            nspliced += 1
+
+        if read.is_unmapped:
+            continue
+
+        if read.has_tag("NH"):
+            nh[read.get_tag("NH")] += 1
+
+        umis[iCLIP.umi.get_umi(read)] += 1
+
+        contig = inbam.references[read.reference_id]
+        for context in counter.contexts(contig, read.pos, read.aend):
+            contexts[context] += 1
+        counter.release(read.pos)
+
+    inbam.close()
+
+    nunmapped = flags["unmapped"]
+    nmapped = nalignments - nunmapped
+
+    with IOTools.openFile(prefix + ".bam_stats.tsv", "w") as outf:
+
+        def _write(category, numerator, denominator, base):
+            outf.write("%s\t%i\t%s\t%s\n" % (
+                category, numerator, _percent(numerator, denominator), base))
+
+        outf.write("category\tcounts\tpercent\tof\n")
+        _write("alignments_total", nalignments, nalignments,
+               "alignments_total")
+        _write("alignments_mapped", nmapped, nalignments,
+               "alignments_total")
+        _write("alignments_unmapped", nunmapped, nalignments,
+               "alignments_total")
+
+        for flag in sorted(BAM_FLAGS.values()):
+            if flag != "unmapped":
+                _write("alignments_" + flag, flags[flag], nmapped,
+                       "alignments_mapped")
+
+        # alignments of a read mapped to n places count 1/n each
+        nmulti = sum(count for n, count in nh.iteritems() if n > 1)
+        nreads_multi = sum(float(count) / n
+                           for n, count in nh.iteritems() if n > 1)
+        nreads_mapped = nmapped - nmulti + int(round(nreads_multi))
+        nreads_total = nreads_mapped + nunmapped
+
+        _write("reads_total", nreads_total, nreads_total, "reads_total")
+        _write("reads_mapped", nreads_mapped, nreads_total, "reads_total")
+        _write("reads_unmapped", nunmapped, nreads_total, "reads_total")
+        _write("reads_missing", 0, nreads_total, "reads_total")
+        if len(nh) > 1:
+            _write("reads_unique", nh[1], nreads_mapped, "reads_mapped")
+
+    with IOTools.openFile(prefix + ".nspliced.txt", "w") as outf:
+        outf.write("%i\n" % nspliced)
+
+    with IOTools.openFile(prefix + ".umi_stats.tsv.gz", "w") as outf:
+        outf.write("UMI\tcount\n")
+        for umi, count in sorted(umis.iteritems()):
+            outf.write("%s\t%i\n" % (umi, count))
+
+    with IOTools.openFile(prefix + ".reference_context.tsv", "w") as outf:
+        outf.write("category\talignments\n")
+        outf.write("total\t%i\n" % nmapped)
+        for context, count in sorted(contexts.iteritems()):
+            outf.write("%s\t%i\n" % (context, count))
@@ -645,7 +645,29 @@ def dedup_alignments(infile, outfile):
 
 
 ###################################################################
-@transform([dedup_alignments,indexMergedBAMs], 
+@subdivide(dedup_alignments,
+           regex("(.+).bam"),
+           add_inputs(generateContextBed),
+           [r"\1.bam_stats.tsv",
+            r"\1.nspliced.txt",
+            r"\1.umi_stats.tsv.gz",
+            r"\1.reference_context.tsv"],
+           r"\1")
+def collectDedupedBamStats(infiles, outfiles, prefix):
+    ''' Calculate the mapping stats, number of spliced reads, UMI
+    frequencies and context stats on the deduped bams, reading each bam
+    once '''
+
+    infile, context_bed = infiles
+
+    job_memory = "4G"
+    PipelineiCLIP.collectBamStats(infile, context_bed, prefix,
+                                  submit=True,
+                                  job_memory=job_memory)
+
+
+###################################################################
+@transform([dedup_alignments, indexMergedBAMs],
            regex("(?:merged_)?(.+).bam(?:.bai)?"),
            r"\1.frag_length.tsv")
 def getFragLengths(infile, outfile):
@@ -676,20 +698,9 @@ def loadFragLengths(infiles, outfile):
 
 
 ###################################################################
-@transform(dedup_alignments,
-           suffix(".bam"), ".bam_stats.tsv")
-def dedupedBamStats(infile, outfile):
-    ''' Calculate statistics on the dedeupped bams '''
-
-    statement = '''python %(scripts_dir)s/bam2stats.py
-                         --force-output
-                          < %(infile)s > %(outfile)s '''
-
-    P.run()
-
-
-###################################################################
-@merge(dedupedBamStats, "deduped_bam_stats.load")
+@collate(collectDedupedBamStats,
+         regex(".+\.bam_stats.tsv"),
+         "deduped_bam_stats.load")
 def loadDedupedBamStats(infiles, outfile):
 
     P.concatenateAndLoad(infiles, outfile,
@@ -697,21 +708,9 @@ def loadDedupedBamStats(infiles, outfile):
 
 
 ###################################################################
-@transform(dedup_alignments,
-           suffix(".bam"),
-           ".nspliced.txt")
-def getNspliced(infile, outfile):
-    ''' Calculate the number of reads spliced by grepping the
-    cigar string for Ns'''
-
-    statement = ''' samtools view %(infile)s
-                  | awk '$6 ~ /N/'
-                  | wc -l > %(outfile)s '''
-    P.run()
-
-
-###################################################################
-@merge(getNspliced, "deduped_nspliced.load")
+@collate(collectDedupedBamStats,
+         regex(".+\.nspliced.txt"),
+         "deduped_nspliced.load")
 def loadNspliced(infiles, outfile):
     P.concatenateAndLoad(infiles, outfile,
                          regex_filename=".+/(.+).nspliced.txt",
@@ -721,20 +720,9 @@ def loadNspliced(infiles, outfile):
 
 
 ###################################################################
-@transform(dedup_alignments, suffix(".bam"), ".umi_stats.tsv.gz")
-def deduped_umi_stats(infile, outfile):
-    ''' calculate histograms of umi frequencies '''
-
-    statement = '''python %(project_src)s/umi_hist.py
-                           -I %(infile)s
-                           -L %(outfile)s.log
-                  | gzip > %(outfile)s '''
-
-    P.run()
-
-
-###################################################################
-@merge(deduped_umi_stats, "dedup_umi_stats.load")
+@collate(collectDedupedBamStats,
+         regex(".+\.umi_stats.tsv.gz"),
+         "dedup_umi_stats.load")
 def loadDedupedUMIStats(infiles, outfile):
 
     P.concatenateAndLoad(infiles, outfile,
@@ -746,63 +734,42 @@ def loadDedupedUMIStats(infiles, outfile):
 ###################################################################
 @follows(mkdir("saturation.dir"), run_mapping)
 @subdivide(indexMergedBAMs, regex(".+/merged_(.+)\.[^\.]+\.bam.bai"),
-       [r"saturation.dir/\1.%.3f.bam" % (1.0/(2 ** x))
-        for x in range(1, 6)] +
-       [r"saturation.dir/\1.%.3f.bam" % (x/10.0)
-        for x in range(6, 11, 1)])
-def subsetForSaturationAnalysis(infile, outfiles):
-    '''Perform subsetting of the original BAM files, dedup and
-    return the context stats. Test for resturn on investment for
-    further sequencing of the same libraries '''
-
-    track = re.match(".+/merged_(.+)\.[^\.]+\.bam", infile).groups()[0]
-    infile = P.snip(infile, ".bai")
-    statements = []
-    statement_template = '''
-                            python %%(project_src)s/UMI-tools/dedup_umi.py
-                              %%(dedup_options)s
-                              -I %(infile)s
-                              -L %(outfile)s.log
-                              -S %(outfile)s.tmp.bam
-                              --subset=%(subset).3f;
-                             checkpoint;
-                             samtools sort %(outfile)s.tmp.bam %(outfile)s;
-                             checkpoint;
-                             samtools index %(outfile)s.bam '''
-    for x in range(1, 6):
-        subset = 1.0/(2 ** x)
-        outfile = "saturation.dir/%%(track)s.%.3f" % subset
-        statements.append(statement_template % locals())
-
-    for x in range(6, 11):
-        subset = x/10.0
-        outfile = "saturation.dir/%%(track)s.%.3f" % subset
-        statements.append(statement_template % locals())
-
-    P.run()
+           add_inputs(generateContextBed),
+           [r"saturation.dir/\1.subset_bam_stats.tsv",
+            r"saturation.dir/\1.saturation_context_stats.tsv"])
+def saturationAnalysis(infiles, outfiles):
+    '''Count the unique molecules, and the molecules in each context, in
+    random subsets of between 1/32 and all of the reads. Test for return
+    on investment for further sequencing of the same libraries.
 
+    Each read is given one random number and the reads are grouped once,
+    so the counts for every subset come from a single pass over the BAM'''
 
-###################################################################
-@transform(subsetForSaturationAnalysis, suffix(".bam"), ".bamstats.tsv")
-def subsetBamStats(infile, outfile):
-    ''' Stats on the subset BAMs '''
+    infile, context_bed = infiles
+    infile = P.snip(infile, ".bai")
 
-    job_options = "-l mem_free=500M"
-    statement = ''' python %(scripts_dir)s/bam2stats.py 
-                    --force-output < %(infile)s > %(outfile)s '''
-    P.run()
+    job_memory = "4G"
+    PipelineiCLIP.saturationAnalysis(infile, context_bed, outfiles,
+                                     method=PARAMS["saturation_method"],
+                                     submit=True,
+                                     job_memory=job_memory)
 
 
 ###################################################################
-@merge(subsetBamStats, "subset_bam_stats.load")
-def loadSubsetBamStats(infiles, outfile):
+@collate(saturationAnalysis,
+         regex(".+/.+\.(subset_bam_stats|saturation_context_stats).tsv"),
+         r"\1.load")
+def loadSaturationStats(infiles, outfile):
+
+    table = P.snip(outfile, ".load")
     P.concatenateAndLoad(infiles, outfile,
-                         regex_filename= ".+/(.+-.+-.+)\.([0-9]+\.[0-9]+).bamstats.tsv",
-                         cat="track,subset")
+                         regex_filename=".+/(.+-.+-.+)\.%s.tsv" % table,
+                         cat="track",
+                         options="-i track -i subset")
 
 
 ###################################################################
-@transform([indexMergedBAMs, dedup_alignments],
+@transform(indexMergedBAMs,
            regex("(?:merged_)?(.+).bam(?:.bai)?"),
            add_inputs(generateContextBed),
            r"\1.reference_context.tsv")
@@ -822,21 +789,14 @@ def buildContextStats(infiles, outfile):
 
 
 ###################################################################
-@collate(buildContextStats,
-         regex("(mapping|deduped|saturation).dir/(?:[^/]+.dir/)?(.+).tsv"),
+@collate([buildContextStats, collectDedupedBamStats],
+         regex("(mapping|deduped).dir/.+\.reference_context.tsv"),
          r"\1_context_stats.load")
 def loadContextStats(infiles, outfile):
 
-    if "saturation" in infiles[0]:
-        regex_filename = ".+/(.+-.+-.+)\.([0-9]+\.[0-9]+).reference_context.tsv"
-        cat = "track,subset"
-    else:
-        regex_filename = ".+/(.+).reference_context.tsv"
-        cat = "track"
-
     P.concatenateAndLoad(infiles, outfile,
-                         regex_filename=regex_filename,
-                         cat=cat)
+                         regex_filename=".+/(.+).reference_context.tsv",
+                         cat="track")
 
 
 ###################################################################
@@ -884,7 +844,7 @@ def loadSplicingIndex(infiles, outfile):
 
 ###################################################################
 @follows(loadContextStats,
-         
+         loadSaturationStats,
          loadDedupedBamStats,
          loadFragLengths,
          loadNspliced,
@@ -1273,7 +1233,8 @@ def callReproducibleClusters(infiles, outfile):
     '''Find clusters that appear in more than one replicate'''
 
     PipelineiCLIP.callReproducibleClusters(infiles, outfile,
-                                           PARAMS["clusters_min_reproducible"])
+                                           PARAMS["clusters_min_reproducible"],
+                                           submit=True)
 
 
 ###################################################################
@@ -1443,7 +1404,8 @@ def runMeme(infiles, outfile):
     logfile = outfile + ".log"
     PipelineiCLIP.subsampleNReadsFromFasta(foreground, tmpfile,
                                            PARAMS["meme_max_sequences"],
-                                           logfile)
+                                           logfile,
+                                           seed=PARAMS.get("meme_seed", 1))
     PipelineMotifs.runMEMEOnSequences(tmpfile, outfile)
 
     os.unlink(tmpfile)
@@ -1533,6 +1495,7 @@ def generateBigWigs(infile, outfiles):
     out_pattern = P.snip(outfiles[0], "_plus.bw")
     statement = '''python %(project_src)s/iCLIP2bigWig.py
                           -I %(infile)s
+                          --chunk-size=1000000
                           -L %(out_pattern)s.log
                           %(out_pattern)s '''
 
@@ -36,6 +36,9 @@ Options
         chromosome. This could be useful if it was neccesary to parrellise the
         excution for any reason, or for quick testing perpuses. 
 
+-p, --processes, Number of processes to use. Contigs are distributed
+        accross the processes, largest first.
+
 Usage
 -----
 <Example use case>
@@ -65,6 +68,77 @@ import pandas as pd
 import os.path
 
 
+def contigReproducibility(samfiles, ref, length, names, use_index,
+                          max_level, dtype):
+    ''' Calculate the number of sites at each level in each of the
+    samfiles, and the number of those replicated in other samfiles, on a
+    single contig. Returns a tuple of dictionaries of totals and hits,
+    each keyed by sample name, containing a list with a dictionary for
+    each fold of replication, keyed by level. '''
+
+    totals = {sf: [collections.defaultdict(int)
+                   for x in range(len(names) - 1)]
+              for sf in names}
+    hits = {sf: [collections.defaultdict(int)
+                 for x in range(len(names) - 1)]
+            for sf in names}
+
+    E.debug("Starting %s, length %i" % (ref, length))
+
+    depths = pd.DataFrame(dtype=dtype)
+
+    for sf in range(len(samfiles)):
+        E.debug("Reading File %s" % names[sf])
+        pos_depth, neg_depth, counter = \
+            iCLIP.countChr(samfiles[sf].fetch(ref), length, dtype)
+
+        neg_depth.index = neg_depth.index + length
+        depth = pd.concat([pos_depth, neg_depth])
+        depth.name = names[sf]
+
+        depths = depths.join(depth, how="outer")
+
+    depths = depths.fillna(0)
+
+    for sf in use_index:
+
+        try:
+            E.debug("Max depth for %s is %i" %
+                    (names[sf], int(depths.iloc[:, sf].max())))
+        except ValueError:
+            E.warn("Zero max depth for both")
+            continue
+
+        if int(max_level) == 0:
+            n_max = int(depths.iloc[:, sf].max())
+        else:
+            n_max = int(max_level)
+
+        for n in range(n_max):
+
+            E.debug("Calculating %i level reproducibility for file %s"
+                    % (n, names[sf]))
+
+            sites = depths.iloc[:, sf] > n
+            for i in range(len(names) - 1):
+                totals[names[sf]][i][n] += sites.sum()
+
+            replicating_sites = \
+                depths.ix[sites, np.arange(len(samfiles)) != sf] > 0
+            n_replicating_samples = replicating_sites.sum(axis=1)
+
+            for i in range(len(names) - 1):
+                hits[names[sf]][i][n] += \
+                    (n_replicating_samples > i).sum()
+            del sites
+            del replicating_sites
+            del n_replicating_samples
+
+    del depths
+
+    return totals, hits
+
+
 def main(argv=None):
     """script main.
 
@@ -92,6 +166,9 @@ def main(argv=None):
                        help="Restrict analysis to one of the input samples vs."
                             "all the others",
                        default=None)
+    parser.add_option("-p", "--processes", dest="proc", type="int",
+                      help="Number of processes to use for multiprocessing",
+                      default=None)
         
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
@@ -118,65 +195,23 @@ def main(argv=None):
 
     E.debug("Reporting on input(s) %s: %s" %(",".join(map(str,use_index)),",".join(use_names)))
 
-    for ref, length in contigs:
-
-        E.debug("Starting %s, length %i" % (ref, length))
-
-        depths = pd.DataFrame(dtype=options.dtype)
-
-        for sf in range(len(samfiles)):
-            E.debug("Reading File %s" % args[sf])
-            pos_depth, neg_depth, counter = \
-                iCLIP.countChr(samfiles[sf].fetch(ref), length, options.dtype)
-            #(depths[:length, sf], depths[length:, sf], counter) = \
-            #    iCLIP.countChr(samfiles[sf].fetch(ref), length, options.dtype)
-            
-            neg_depth.index = neg_depth.index + length
-            depth = pd.concat([pos_depth, neg_depth])
-            depth.name = args[sf]
-            
-            depths = depths.join(depth, how="outer")
-#            total_counter[sf] += counter
-        
-        depths = depths.fillna(0)
-
-        for sf in use_index:
-        
-            try:
-                E.debug("Max depth for %s is %i" % 
-                        (args[sf], int(depths.iloc[:, sf].max())))
-            except ValueError:
-                E.warn("Zero max depth for both")
-                continue
-
-
-
-            if int(options.max_level) == 0:
-                n_max = int(depths.iloc[:, sf].max())
-            else:
-                n_max = int(options.max_level)
-
-            for n in range(n_max):
-
-                E.debug("Calculating %i level reproducibility for file %s"
-                        % (n, args[sf]))
-
-                sites = depths.iloc[:, sf] > n
-                for i in range(len(args) - 1):
-                    running_totals[args[sf]][i][n] += sites.sum()
-                
-                replicating_sites = \
-                    depths.ix[sites, np.arange(len(samfiles)) != sf] > 0
-                n_replicating_samples = replicating_sites.sum(axis=1)
-
-                for i in range(len(args) - 1):
-                    running_hits[args[sf]][i][n] += \
-                        (n_replicating_samples > i).sum()
-                del sites
-                del replicating_sites
-                del n_replicating_samples
-
-        del depths
+    if options.proc:
+        # each worker opens its own copies of the files
+        samfiles = args
+
+    results = iCLIP.map_contigs(contigReproducibility, samfiles,
+                                contigs=contigs,
+                                processes=options.proc,
+                                args=(args, use_index, options.max_level,
+                                      options.dtype))
+
+    for ref, (totals, hits) in results:
+        for sf in args:
+            for i in range(len(args) - 1):
+                for n in totals[sf][i]:
+                    running_totals[sf][i][n] += totals[sf][i][n]
+                for n in hits[sf][i]:
+                    running_hits[sf][i][n] += hits[sf][i][n]
 
     outlines = []
     for sf in use_names:
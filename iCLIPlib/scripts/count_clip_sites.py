@@ -15,7 +15,23 @@ Count the number of clip sites in each gene, transcript or exon
 Usage
 -----
 
-python count_clip_sites.py BAMFILE [OPTIONS]
+python count_clip_sites.py BAMFILE [BAMFILE ...] [OPTIONS]
+
+Two counting methods are available. ``--method=fetch`` (the default)
+fetches the reads for each exon and intron of each feature from the
+BAM file. ``--method=sweep`` reads all the features into memory, and
+then makes a single coordinate sorted pass over each contig in the BAM
+file, assigning each crosslinked base to the exons and introns of the
+features it overlaps. This is much faster where there are many features
+(e.g. ``-f exon``), but output rows are written in order of feature
+end rather than input order.
+
+If more than one BAM file is given, the annotation is read once and
+each BAM file is counted by a separate worker (see ``--processes``).
+Output is then a single matrix with one row per feature and
+``<sample>_exon_count`` and ``<sample>_intron_count`` columns for each
+BAM file (intron columns are omitted for ``-f exon``). Sample names are
+taken from the BAM file names, or can be given with ``--sample-names``.
 
 
 .. Example use case
@@ -40,6 +56,8 @@ import CGAT.Experiment as E
 import CGAT.GTF as GTF
 import CGAT.Intervals as Intervals
 import os
+import re
+import collections
 import pysam
 
 sys.path.insert(1, os.path.join(
@@ -48,6 +66,28 @@ sys.path.insert(1, os.path.join(
 
 import iCLIP
 
+# set in each worker process by _init_worker
+_features = None
+_method = None
+
+
+def _init_worker(features, method):
+    global _features
+    global _method
+    _features = features
+    _method = method
+
+
+def _count_bam(bamfile):
+    ''' count the features set by _init_worker in bamfile '''
+
+    E.debug("Counting features in %s" % bamfile)
+    bam = pysam.AlignmentFile(bamfile)
+    counts = iCLIP.count_features(bam, _features, _method)
+    bam.close()
+    return counts
+
+
 def main(argv=None):
     """script main.
     parses command line options in sys.argv, unless *argv* is given.
@@ -65,6 +105,22 @@ def main(argv=None):
                       default="transcript",
                       help="supply help")
 
+    parser.add_option("-m", "--method", dest="method", type="choice",
+                      choices=["fetch", "sweep"],
+                      default="fetch",
+                      help="Count by fetching reads for each interval, or "
+                           "by sweeping along each contig")
+
+    parser.add_option("-p", "--processes", dest="proc", type="int",
+                      default=None,
+                      help="Number of processes to use for multiprocessing "
+                           "when more than one BAM file is given")
+
+    parser.add_option("--sample-names", dest="sample_names", type="string",
+                      default=None,
+                      help="Comma seperated list of names for the BAM files "
+                           "to use in the count matrix header")
+
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
 
@@ -80,48 +136,88 @@ def main(argv=None):
                 yield [exon]
         iterator = _exon_iterator(iterator)
 
-    bamfile = pysam.AlignmentFile(args[0])
-    outlines = []
-    for feature in iterator:
-        exons = GTF.asRanges(feature, "exon")
-
-        exon_counts = iCLIP.count_intervals(bamfile,
-                                            exons,
-                                            feature[0].contig,
-                                            feature[0].strand,
-                                            dtype="uint32")
-
-        exon_counts = exon_counts.sum()
-
-        introns = Intervals.complement(exons)
-        intron_counts = iCLIP.count_intervals(bamfile,
-                                              introns,
-                                              feature[0].contig,
-                                              feature[0].strand,
-                                              dtype="uint32")
-
-        intron_counts = intron_counts.sum()
+    def _get_ids(feature):
 
         if options.feature == "exon":
-
             try:
                 exon_id = feature[0].exon_id
             except AttributeError:
                 exon_id = "missing"
+        else:
+            exon_id = "NA"
+
+        return [feature[0].gene_id,
+                feature[0].transcript_id,
+                exon_id]
 
-            gene_id = feature[0].gene_id
-            transcript_id = feature[0].transcript_id
+    def _write_row(ids, exon_counts, intron_counts):
+
+        if options.feature == "exon":
             intron_counts = "NA"
+
+        options.stdout.write("\t".join(ids + [str(exon_counts),
+                                               str(intron_counts)]) + "\n")
+
+    if len(args) > 1:
+
+        if options.sample_names:
+            sample_names = options.sample_names.split(",")
+            assert len(sample_names) == len(args), \
+                "Number of sample names does not match number of BAM files"
         else:
-            exon_id = "NA"
-            gene_id = feature[0].gene_id
-            transcript_id = feature[0].transcript_id
+            sample_names = [re.sub("\.bam$", "", os.path.basename(bamfile))
+                            for bamfile in args]
+
+        ids = []
+        features = []
+        for feature in iterator:
+            ids.append(_get_ids(feature))
+            features.append((feature[0].contig,
+                             GTF.asRanges(feature, "exon"),
+                             feature[0].strand))
+
+        if options.proc:
+            try:
+                import multiprocessing
+                pool = multiprocessing.Pool(options.proc,
+                                            initializer=_init_worker,
+                                            initargs=(features,
+                                                      options.method))
+            except ImportError:
+                E.warn("Failed to setup multiprocessing, using single"
+                       " processor")
+                pool = None
+        else:
+            pool = None
+
+        if pool:
+            results = pool.map(_count_bam, args)
+            pool.close()
+            pool.join()
+        else:
+            _init_worker(features, options.method)
+            results = map(_count_bam, args)
+
+        header = ["gene_id", "transcript_id", "exon_id"]
+        for sample in sample_names:
+            header.append(sample + "_exon_count")
+            if not options.feature == "exon":
+                header.append(sample + "_intron_count")
+
+        options.stdout.write("\t".join(header) + "\n")
 
-        outlines.append([gene_id,
-                         transcript_id,
-                         exon_id,
-                         str(exon_counts),
-                         str(intron_counts)])
+        for i, feature_ids in enumerate(ids):
+            row = list(feature_ids)
+            for exon_counts, intron_counts in results:
+                row.append(str(exon_counts[i]))
+                if not options.feature == "exon":
+                    row.append(str(intron_counts[i]))
+            options.stdout.write("\t".join(row) + "\n")
+
+        E.Stop()
+        return
+
+    bamfile = pysam.AlignmentFile(args[0])
 
     options.stdout.write("\t".join(["gene_id",
                                     "transcript_id",
@@ -129,9 +225,57 @@ def main(argv=None):
                                     "exon_count",
                                     "intron_count"])+"\n")
 
-    outlines = ["\t".join(outline) for outline in outlines]
-    outlines = "\n".join(outlines)
-    options.stdout.write(outlines + "\n")
+    if options.method == "fetch":
+
+        for feature in iterator:
+            exons = GTF.asRanges(feature, "exon")
+
+            exon_counts = iCLIP.count_intervals(bamfile,
+                                                exons,
+                                                feature[0].contig,
+                                                feature[0].strand,
+                                                dtype="uint32")
+
+            exon_counts = exon_counts.sum()
+
+            introns = Intervals.complement(exons)
+            intron_counts = iCLIP.count_intervals(bamfile,
+                                                  introns,
+                                                  feature[0].contig,
+                                                  feature[0].strand,
+                                                  dtype="uint32")
+
+            intron_counts = intron_counts.sum()
+
+            _write_row(_get_ids(feature), exon_counts, intron_counts)
+
+    elif options.method == "sweep":
+
+        contigs = []
+        features = collections.defaultdict(list)
+        for feature in iterator:
+            exons = GTF.asRanges(feature, "exon")
+            contig = feature[0].contig
+            if contig not in features:
+                contigs.append(contig)
+            features[contig].append((exons,
+                                     feature[0].strand,
+                                     _get_ids(feature)))
+
+        for contig in contigs:
+
+            try:
+                reads = bamfile.fetch(contig)
+            except ValueError as e:
+                E.debug(e)
+                E.warning("Skipping intervals on contig %s as not present"
+                          " in bam" % contig)
+                reads = []
+
+            crosslinks = iCLIP.iterate_crosslinks(reads)
+            for ids, exon_counts, intron_counts in iCLIP.sweep_features(
+                    crosslinks, features[contig]):
+                _write_row(ids, exon_counts, intron_counts)
 
     # write footer and output benchmark information.
     E.Stop()
@@ -39,7 +39,49 @@ import CGAT.Bed as Bed
 import pandas
 import iCLIP
 import pysam
-import numpy
+
+
+def binContig(bams, contig, length, window_size, dtype):
+    ''' Sum the crosslinked bases on each strand of contig in windows of
+    window_size '''
+
+    E.debug("Doing chromosome %s ..." % contig)
+    E.debug("Getting depth vector")
+    pos_depths, neg_depths, _ = \
+        iCLIP.countChr(bams[0].fetch(contig), length, dtype)
+
+    E.debug("Binning counts ...")
+    pos_bin_sums = pos_depths.groupby(
+        pos_depths.index.values//window_size).sum()
+    neg_bin_sums = neg_depths.groupby(
+        neg_depths.index.values//window_size).sum()
+
+    return pos_bin_sums, neg_bin_sums
+
+
+def binContigChunks(bams, contig, length, window_size, dtype, chunk_size):
+    ''' As binContig, but count crosslinked bases one chunk of the contig
+    at a time, so only the bin sums for the whole contig are held in
+    memory. '''
+
+    # chunks must be a whole number of windows so no bin is split
+    chunk_size = -(-chunk_size//window_size) * window_size
+
+    E.debug("Doing chromosome %s in chunks of %i ..." % (contig, chunk_size))
+    pos_bin_sums = []
+    neg_bin_sums = []
+    for start, pos_depths, neg_depths in iCLIP.countChrChunks(
+            bams[0].fetch(contig), chunk_size, dtype):
+
+        pos_bin_sums.append(pos_depths.groupby(
+            pos_depths.index.values//window_size).sum())
+        neg_bin_sums.append(neg_depths.groupby(
+            neg_depths.index.values//window_size).sum())
+
+    if len(pos_bin_sums) == 0:
+        return pandas.Series(), pandas.Series()
+
+    return pandas.concat(pos_bin_sums), pandas.concat(neg_bin_sums)
 
 
 def main(argv=None):
@@ -61,6 +103,13 @@ def main(argv=None):
     parser.add_option("-c", "--contig", dest="contig", type="string",
                       help="restrict to contig")
     parser.add_option("--dtype", dest="dtype", default = "uint32")
+    parser.add_option("-p", "--processes", dest="proc", type="int",
+                      default=None,
+                      help="Number of processes to use for multiprocessing")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      default=None,
+                      help="Count each contig in chunks of this many bases,"
+                           " to limit memory usage")
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
@@ -74,23 +123,21 @@ def main(argv=None):
     if options.contig:
         contigs = [x for x in contigs if x[0] == options.contig]
 
-    for contig, length in contigs:
-
-        E.debug("Doing chromosome %s ..." % contig)
-        E.debug("Getting depth vector")
-        pos_depths, neg_depths, _ = \
-            iCLIP.countChr(samfile.fetch(contig), length, options.dtype)
-        
-        E.debug("Binning counts ...")
-        num_bins = -(-length//options.window_size)
-        bin_edges = numpy.arange(num_bins+1) * options.window_size
-        
-        pos_bin_sums = pos_depths.groupby(
-            pos_depths.index.values//options.window_size).sum()
-        neg_bin_sums = neg_depths.groupby(
-            neg_depths.index.values//options.window_size).sum()
-
-        E.debug("Creating bed entries ...")
+    if options.chunk_size:
+        results = iCLIP.map_contigs(binContigChunks, [args[0]],
+                                    contigs=contigs,
+                                    processes=options.proc,
+                                    args=(options.window_size, options.dtype,
+                                          options.chunk_size))
+    else:
+        results = iCLIP.map_contigs(binContig, [args[0]],
+                                    contigs=contigs,
+                                    processes=options.proc,
+                                    args=(options.window_size, options.dtype))
+
+    for contig, (pos_bin_sums, neg_bin_sums) in results:
+
+        E.debug("Creating bed entries for %s ..." % contig)
         def _score2bed(bin, score, strand):
 
             start = int(bin)*options.window_size
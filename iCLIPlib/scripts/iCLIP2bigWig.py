@@ -14,6 +14,13 @@ Takes a bam file on the stdin and converts it into two
 bigWig files, each containing the depth of crosslinked bases
 at any given position on each strand.
 
+Contigs can be counted in parallel with -p/--processes, in which
+case the BAM file must be given with -I rather than on the stdin.
+
+For deep libraries, --chunk-size will count each contig in windows
+of the given number of bases, writing each window out as it is
+finished, rather than holding a whole contig in memory.
+
 Output files are named according to the provided template
 with _plus and _minus suffixes.
 
@@ -71,18 +78,60 @@ def outputToBW(infile, outfile_prefix, chrom_sizes):
         E.debug("Conversion successful")
         os.unlink(infile)
     
-def outputToWig(depths,chrom, wigfile):
+def outputToWig(depths,chrom, wigfile, header=True):
     '''depths is a pandas series keyed on chromosome position,
     chrom is a chromosome, wigfile is a file to output to.
     This function converts a series of depths into wig formated
-    text and writes it to the specified file '''
+    text and writes it to the specified file. If header is False
+    the variableStep line is not written, so that a contig can be
+    written in several pieces '''
 
-    wigfile.write("variableStep\tchrom=%s\n" % chrom)
+    if header:
+        wigfile.write("variableStep\tchrom=%s\n" % chrom)
     for row in depths.iteritems():
         row = list(row)
         row = "\t".join(map(str,row)) + "\n"
         wigfile.write(row)
 
+def countContig(bams, chrom, chrom_length, dtype):
+    ''' Count the crosslinked bases on chrom, returning sorted Series
+    for the positive strand, and the negated negative strand '''
+
+    pos_depth, neg_depth, counter = iCLIP.countChr(bams[0].fetch(chrom),
+                                                   chrom_length,
+                                                   dtype)
+    pos_depth_sorted = pos_depth.sort_index()
+    del pos_depth
+    neg_depth_sorted = neg_depth.sort_index()
+    del neg_depth
+    neg_depth_sorted = -1*neg_depth_sorted
+
+    return pos_depth_sorted, neg_depth_sorted
+
+
+def countContigChunks(bams, chrom, chrom_length, dtype, chunk_size):
+    ''' Count the crosslinked bases on chrom one window at a time,
+    writing them to temporary wig files. Returns the names of the
+    positive and negative strand files '''
+
+    plus_wig = tempfile.NamedTemporaryFile(delete=False)
+    minus_wig = tempfile.NamedTemporaryFile(delete=False)
+
+    plus_wig.write("variableStep\tchrom=%s\n" % chrom)
+    minus_wig.write("variableStep\tchrom=%s\n" % chrom)
+
+    for start, pos_depth, neg_depth in iCLIP.countChrChunks(
+            bams[0].fetch(chrom), chunk_size, dtype):
+        outputToWig(pos_depth, chrom, plus_wig, header=False)
+        outputToWig(-1*neg_depth.astype("int64"), chrom, minus_wig,
+                    header=False)
+
+    plus_wig.close()
+    minus_wig.close()
+
+    return plus_wig.name, minus_wig.name
+
+
 def main(argv=None):
     """script main.
 
@@ -102,12 +151,24 @@ def main(argv=None):
     parser.add_option("--dtype", dest = "dtype", type="string",
                       default="uint32",
                       help="dtype for storing depths")
+    parser.add_option("-p", "--processes", dest="proc", type="int",
+                      default=None,
+                      help="Number of processes to use for multiprocessing."
+                           " Requires the BAM file to be specified with -I")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      default=None,
+                      help="Count each contig in windows of this many bases,"
+                           " to limit memory usage")
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
 
     if options.stdin == sys.stdin:
         in_bam = pysam.Samfile("-", "rb")
+        if options.proc:
+            E.warn("Cannot read BAM from stdin with multiple processes,"
+                   " using single processor")
+            options.proc = None
     else:
         fn = options.stdin.name
         options.stdin.close()
@@ -116,34 +177,44 @@ def main(argv=None):
     plus_wig = tempfile.NamedTemporaryFile(delete=False)
     minus_wig = tempfile.NamedTemporaryFile(delete=False)
 
-    contig_sizes = []
+    contig_sizes = zip(in_bam.references, in_bam.lengths)
 
-    for chrom, chrom_length in zip(in_bam.references, in_bam.lengths):
+    if options.proc:
+        # each worker opens its own copy of the file
+        in_bam = fn
 
-        # get depths over chromosome
-        pos_depth, neg_depth, counter = iCLIP.countChr(in_bam.fetch(chrom),
-                                                       chrom_length,
-                                                       options.dtype)
-        pos_depth_sorted = pos_depth.sort_index()
-        del pos_depth
-        neg_depth_sorted = neg_depth.sort_index()
-        del neg_depth
-        neg_depth_sorted = -1*neg_depth_sorted
+    if options.chunk_size:
 
-#        E.debug("Counted %i truncated on positive strand, %i on negative"
-#                % (counter.truncated_pos, counter.truncated_neg))
-#        E.debug("and %i deletion reads on positive strand, %i on negative"
-#                % (counter.deletion_pos, counter.deletion_neg))
+        results = iCLIP.map_contigs(countContigChunks, [in_bam],
+                                    contigs=contig_sizes,
+                                    processes=options.proc,
+                                    args=(options.dtype, options.chunk_size))
 
-        # output to temporary wig file
-        outputToWig(pos_depth_sorted, chrom, plus_wig)
-        outputToWig(neg_depth_sorted, chrom, minus_wig)
-    
-        contig_sizes.append([chrom, chrom_length])
+        for chrom, (plus_chunk, minus_chunk) in results:
+
+            # append temporary contig files in reference order
+            for chunk, wigfile in ((plus_chunk, plus_wig),
+                                   (minus_chunk, minus_wig)):
+                with open(chunk) as inf:
+                    shutil.copyfileobj(inf, wigfile)
+                os.unlink(chunk)
+
+    else:
+
+        results = iCLIP.map_contigs(countContig, [in_bam],
+                                    contigs=contig_sizes,
+                                    processes=options.proc,
+                                    args=(options.dtype,))
+
+        for chrom, (pos_depth_sorted, neg_depth_sorted) in results:
+
+            # output to temporary wig file
+            outputToWig(pos_depth_sorted, chrom, plus_wig)
+            outputToWig(neg_depth_sorted, chrom, minus_wig)
+
+            del pos_depth_sorted
+            del neg_depth_sorted
 
-        del pos_depth_sorted
-        del neg_depth_sorted
-    
     plus_wig_name = plus_wig.name
     minus_wig_name = minus_wig.name
     plus_wig.close()
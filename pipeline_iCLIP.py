@@ -440,52 +440,26 @@ METHODS = ["unique", "cluster", "percentile", "adjacency", "directional"]
 
 
 ###################################################################
-@originate(["dedup_%s.sentinal" % method for method in METHODS])
-def dedup_method_sentinals(outfile):
-    ''' make sentinal files for each dedup method so can be
-    called with @product, and create output directories'''
-
-    os.mkdir(P.snip(outfile, ".sentinal") + ".dir")
-    P.touch(outfile)
-
-
-###################################################################
-@product(run_mapping,
-         formatter(".+/(?P<TRACK>.+).bam"),
-         dedup_method_sentinals,
-         formatter("dedup_(?P<method>.+)\.sentinal"),
-         "dedup_{method[1][0]}.dir/{TRACK[0][0]}.bam",
-         ["{basename[0][0]}", "{method[1][0]}"])
-def dedup_bams(infiles, outfile, params):
-    '''run umi_tools dedup on all tracks using all methods'''
-
-    track, method = params
-
-    infile, outdir = infiles
-    outdir = P.snip(outdir, ".sentinal") + ".dir"
-    track = os.path.join(outdir, track)
+@follows(mkdir(["dedup_%s.dir" % method for method in METHODS]))
+@subdivide(run_mapping,
+           formatter(".+/(?P<TRACK>.+).bam"),
+           ["dedup_%s.dir/{TRACK[0]}.bam" % method for method in METHODS],
+           "{TRACK[0]}")
+def dedup_bams(infile, outfiles, track):
+    '''dedup each track with all the methods, reading and grouping the
+    reads only once. The deduped bams are output already sorted'''
 
     job_memory = "21G"
 
-    if method == "cluster":
-        further_stats = "--further-stats"
-    else:
-        further_stats = ""
-
-    statement = []
-    statement.append('''umi_tools dedup
-                         --method=%(method)s
-                         --output-stats=%(track)s
-                         %(further_stats)s
-                          -I %(infile)s
-                          -S %(track)s.unsorted.bam
-                          -L %(track)s.log ''')
-
-    statement.append("samtools sort %(track)s.unsorted.bam -O bam -T %(track)s > %(track)s.bam")
-    statement.append("samtools index %(track)s.bam")
-    statement.append("rm %(track)s.unsorted.bam")
-    statement = "; checkpoint;".join(statement)
-    P.run()
+    stats_prefixes = [P.snip(outfile, ".bam") for outfile in outfiles]
+
+    PipelineUMI.dedupBamAllMethods(
+        infile, outfiles, METHODS,
+        stats_prefixes=stats_prefixes,
+        further_stats_prefix="dedup_cluster.dir/%s" % track,
+        counts_outfile="dedup_%s.log" % track,
+        submit=True,
+        job_memory=job_memory)
 
 
 ###################################################################
@@ -725,19 +699,26 @@ def intersect_exons(infile, outfile):
 
 
 ###################################################################
-@transform([dedup_bams, mergeBamsByRep],
-           suffix(".bam"),
-           add_inputs(intersect_exons),
-           ".exon_count.tsv.gz")
+@collate([dedup_bams, mergeBamsByRep],
+         regex("(dedup_.+).dir/.+.bam"),
+         add_inputs(intersect_exons),
+         r"\1.dir/exon_counts.tsv.gz")
 def count_exons(infiles, outfile):
-    '''Count the number of clip tags in each exon'''
-    bamfile, gtffile = infiles
+    '''Count the number of clip tags in each exon in every track
+    deduped with a method, giving an exon x track matrix'''
+
+    bamfiles = " ".join([infile[0] for infile in infiles])
+    gtffile = infiles[0][1]
 
+    job_threads = 6
     statement = '''python %(pipeline_src)s/iCLIPlib/scripts/count_clip_sites.py
                           -I %(gtffile)s
-                          %(bamfile)s
-                           -f exon
-                          -S %(outfile)s '''
+                          %(bamfiles)s
+                          -f exon
+                          --method=sweep
+                          -p %(job_threads)i
+                          -S %(outfile)s
+                          -L %(outfile)s.log '''
 
     P.run()
 
@@ -748,9 +729,9 @@ def count_exons(infiles, outfile):
 def load_exon_counts(infiles, outfile):
 
     P.concatenateAndLoad(infiles, outfile,
-                         regex_filename="dedup_(.+).dir/(.+).exon_count.tsv.gz",
-                         cat="method,track",
-                         options="-i method -i track -i gene_id")
+                         regex_filename="dedup_(.+).dir/exon_counts.tsv.gz",
+                         cat="method",
+                         options="-i method -i gene_id")
 
 
 ###################################################################
@@ -804,9 +785,11 @@ def calculate_base_level_reproducibility(infiles, outfile):
     '''Find the number of bases in one sample clipping in others'''
 
     infiles = " ".join([infile for infile in infiles if re.search("R[123]", infile)])
+    job_threads = 6
     statement = '''python %(pipeline_src)s/iCLIPlib/scripts/calculateiCLIPReproducibility.py
                        %(infiles)s
                        -m 2
+                       -p %(job_threads)i
                        -S %(outfile)s
                        -L %(outfile)s.log'''
     P.run()
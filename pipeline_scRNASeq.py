@@ -88,6 +88,7 @@ import CGAT.IOTools as IOTools
 import CGATPipelines.PipelinePreprocess as PipelinePreprocess
 import CGATPipelines.PipelineMapping as PipelineMapping
 import PipelineScRNASeq
+import PipelineUMI
 
 ###################################################
 # Pipeline configuration
@@ -159,8 +160,12 @@ def extractUMIsAndFilterGSE53638(infile, outfiles):
         if line_number % 3 == 0:
             barcodes.append(line)
 
+    job_threads = 4
+
     PipelineScRNASeq.extractUMIsAndFilterFastq(fastq, UMI_fastq, barcodes,
-                                               submit=True)
+                                               processes=job_threads,
+                                               submit=True,
+                                               job_threads=job_threads)
 
 
 @transform(PARAMS['soumillon_fasta'],
@@ -226,31 +231,23 @@ def mapBWAAgainstGenesetGSE53638(infiles, outfile):
             r"GSE53638/dedup_adjacency.dir/\1_UMI_\2_deduped.trans.bam",
             r"GSE53638/dedup_directional.dir/\1_UMI_\2_deduped.trans.bam"])
 def dedupGSE53638(infile, outfiles):
-    ''' perform deduping with various methods'''
-
-    for outfile in outfiles:
-        outfile_tmp = outfile.replace("_deduped.trans.bam", "_temp.trans.bam")
-
-        method = P.snip(os.path.basename(
-            os.path.dirname(outfile).replace("dedup_", "")), ".dir")
-                
-        if method == "cluster":
-            options = "--further-stats"
-        else:
-            options = ""
-
-        statement = '''
-        umi_tools dedup
-        --per-contig --method=%(method)s
-        -I %(infile)s -S %(outfile_tmp)s -L %(outfile)s.log
-        --output-stats=%(outfile)s.stats %(options)s;
-        checkpoint;
-        samtools sort %(outfile_tmp)s > %(outfile)s;
-        checkpoint;
-        samtools index %(outfile)s;
-        checkpoint;
-        rm -rf %(outfile_tmp)s'''
-        P.run()
+    ''' perform deduping with various methods, reading and grouping the
+    reads once for all the methods'''
+
+    methods = [P.snip(os.path.basename(os.path.dirname(outfile)),
+                      ".dir").replace("dedup_", "")
+               for outfile in outfiles]
+
+    job_memory = "4G"
+
+    PipelineUMI.dedupBamAllMethods(
+        infile, outfiles, methods,
+        stats_prefixes=[outfile + ".stats" for outfile in outfiles],
+        further_stats_prefix=outfiles[methods.index("cluster")] + ".stats",
+        per_contig=True,
+        counts_outfile=P.snip(infile, ".trans.bam") + "_dedup.log",
+        submit=True,
+        job_memory=job_memory)
 
 
 @collate([mapBWAAgainstGenesetGSE53638,
@@ -346,6 +343,116 @@ def plotCVGSE53638(infiles, plotfile):
         submit=True, job_memory=job_memory)
 
 
+###############################################################################
+# Cell-tagged workflow - a single fastq and bam for each run, with the cell
+# barcode and UMI in the read name, rather than one for each cell
+###############################################################################
+
+
+@transform(extractGGSE53638,
+           regex("GSE53638/fastqs.dir/(\S+)_1.fastq.gz"),
+           r"GSE53638/fastqs.dir/\1_tagged.fastq.gz")
+def extractTaggedGSE53638(infile, outfile):
+    ''' extract UMIs from read 1 and filter as per Soumillon et al 2014,
+    writing all cells to a single fastq with the cell barcode and UMI in
+    the read name '''
+
+    UMI_fastq = infile
+    fastq = infile.replace("_1.fastq.gz", "_2.fastq.gz")
+
+    barcode_inf = IOTools.openFile(PARAMS['soumillon_barcodes'], "r")
+    barcodes = []
+
+    # different barcodes for Differentiation 1 and Differentiation 3
+    if "SRR1058003" in UMI_fastq or "SRR1058023" in UMI_fastq:
+        start = -1
+
+    elif "SRR1058032" in UMI_fastq or "SRR1058038" in UMI_fastq:
+        start = -2
+
+    for line_number, line in enumerate(barcode_inf.read().splitlines(), start):
+        if line_number % 3 == 0:
+            barcodes.append(line)
+
+    job_threads = 4
+
+    PipelineScRNASeq.extractUMIsAndFilterFastq(fastq, UMI_fastq, barcodes,
+                                               processes=job_threads,
+                                               tagged=True,
+                                               submit=True,
+                                               job_threads=job_threads)
+
+
+@mkdir("GSE53638/tagged.dir")
+@follows(indexFastaGSE53638)
+@transform(extractTaggedGSE53638,
+           regex("GSE53638/fastqs.dir/(\S+)_tagged.fastq.gz"),
+           add_inputs(indexFastaGSE53638),
+           r"GSE53638/tagged.dir/\1.trans.bam")
+def mapBWATaggedGSE53638(infiles, outfile):
+    ''' map all the reads for a run against the transcriptome in a single
+    BWA job, parameterised as for mapBWAAgainstGenesetGSE53638 '''
+
+    infile, reference = infiles
+    job_threads = 4
+    job_options = "-l mem_free=1.9G"
+    bwa_aln_options = "-l 24 -k 2 -n 0.04"
+    bwa_index_dir = os.path.abspath(
+        os.path.dirname(reference))
+    genome = P.snip(os.path.basename(reference), ".sa")
+    bwa_threads = job_threads
+    bwa_samse_options = ""
+    m = PipelineMapping.BWA(remove_non_unique=0,
+                            strip_sequence=0,
+                            set_nh=1)
+
+    statement = m.build((infile,), outfile)
+    P.run()
+
+
+@subdivide(mapBWATaggedGSE53638,
+           regex("GSE53638/tagged.dir/(\S+).trans.bam"),
+           [r"GSE53638/tagged.dir/\1_dedup_unique.trans.bam",
+            r"GSE53638/tagged.dir/\1_dedup_percentile.trans.bam",
+            r"GSE53638/tagged.dir/\1_dedup_cluster.trans.bam",
+            r"GSE53638/tagged.dir/\1_dedup_adjacency.trans.bam",
+            r"GSE53638/tagged.dir/\1_dedup_directional.trans.bam"])
+def dedupTaggedGSE53638(infile, outfiles):
+    ''' perform deduping with various methods, separately for each cell,
+    reading and grouping the reads once for all the methods
+    '''
+
+    methods = [P.snip(outfile, ".trans.bam").split("_dedup_")[-1]
+               for outfile in outfiles]
+
+    job_memory = "4G"
+
+    PipelineUMI.dedupBamAllMethods(
+        infile, outfiles, methods,
+        per_contig=True, per_cell=True,
+        counts_outfile=P.snip(infile, ".trans.bam") + "_dedup.log",
+        submit=True,
+        job_memory=job_memory)
+
+
+@transform([mapBWATaggedGSE53638,
+            dedupTaggedGSE53638],
+           suffix(".trans.bam"),
+           ".trans.gene.counts.tsv")
+def countGenesPerCellTaggedGSE53638(infile, outfile):
+    ''' summarise counts per gene for every cell in a single pass '''
+
+    job_memory = "4G"
+    PipelineScRNASeq.countAlignmentsPerGenePerCell(
+        infile, outfile, mapq_threshold=10, submit=True,
+        job_memory=job_memory)
+
+
+@follows(countGenesPerCellTaggedGSE53638)
+def GSE53638Tagged():
+    pass
+
+
 @follows(countGenesGSE53638,
          mergeAndPlotEditDistancesGSE53638,
          mergeCountsGSE53638,
@@ -419,10 +526,12 @@ def extractUMIsAndFilterGSE65525(infile, outfiles):
     cell_barcodes = sample2cellbarcodes[sample]
 
     job_memory = "2G"
+    job_threads = 4
 
     PipelineScRNASeq.extractUMIsAndFilterFastqGSE65525(
         UMI_fastq, fastq, barcodes1_infile, barcodes2_infile, cell_barcodes,
-        submit=True)
+        processes=job_threads, submit=True, job_threads=job_threads,
+        job_memory=job_memory)
 
 
 @mkdir("GSE65525/processed.dir")
@@ -519,32 +628,23 @@ def mapBowtieAgainstTranscriptomeGSE65525(infiles, outfile):
             r"GSE65525/dedup_adjacency.dir/\1_UMI_\2_deduped.trans.bam",
             r"GSE65525/dedup_directional.dir/\1_UMI_\2_deduped.trans.bam"])
 def dedupGSE65525(infile, outfiles):
-    ''' perform deduping with various methods'''
-
-    for outfile in outfiles:
-        outfile_tmp = outfile.replace("_deduped.trans.bam", "_temp.trans.bam")
-
-        method = P.snip(os.path.basename(
-            os.path.dirname(outfile).replace("dedup_", "")), ".dir")
-        
-        if method == "directional":
-            method = "directional"
-
-        if method == "adjacency":
-            stats_cmd = ("--output-stats=%(outfile)s.stats "
-                         "--further-stats" % locals())
-        else:
-            stats_cmd = ("--output-stats=%(outfile)s.stats " % locals())
-
-        statement = '''umi_tools dedup
-                   --per-contig --method=%(method)s %(stats_cmd)s
-                   -I %(infile)s -S %(outfile_tmp)s -L %(outfile)s.log;
-                   checkpoint;
-                   samtools sort %(outfile_tmp)s > %(outfile)s;
-                   checkpoint;
-                   samtools index %(outfile)s;
-                   rm -rf %(outfile_tmp)s'''
-        P.run()
+    ''' perform deduping with various methods, reading and grouping the
+    reads once for all the methods'''
+
+    methods = [P.snip(os.path.basename(os.path.dirname(outfile)),
+                      ".dir").replace("dedup_", "")
+               for outfile in outfiles]
+
+    job_memory = "4G"
+
+    PipelineUMI.dedupBamAllMethods(
+        infile, outfiles, methods,
+        stats_prefixes=[outfile + ".stats" for outfile in outfiles],
+        further_stats_prefix=outfiles[methods.index("adjacency")] + ".stats",
+        per_contig=True,
+        counts_outfile=P.snip(infile, ".trans.bam") + "_dedup.log",
+        submit=True,
+        job_memory=job_memory)
 
 
 @collate([mapBowtieAgainstTranscriptomeGSE65525,
@@ -629,7 +729,7 @@ def plotCVGSE65525(infiles, plotfile):
 def plotHeatmapsGSE65525(infiles, outfile):
     ''' plot heatmaps for each dedup method'''
 
-    PipelineScRNASeq.bplotHeatmapGSE65525(
+    PipelineScRNASeq.plotHeatmapGSE65525(
         infiles, outfile, submit=True, job_memory="2G")
 
 
@@ -659,6 +759,145 @@ def plotloadingsPCAGSE65525(infiles, outfile):
         infiles, outfile, submit=False)
 
 
+###############################################################################
+# Cell-tagged workflow - a single fastq and bam for each run, with the cell
+# barcode and UMI in the read name, rather than one for each cell
+###############################################################################
+
+
+@transform(extractGSE65525,
+           regex("GSE65525/fastqs.dir/(\S+)_1.fastq.gz"),
+           r"GSE65525/fastqs.dir/\1_tagged.fastq.gz")
+def extractTaggedGSE65525(infile, outfile):
+    ''' extract UMIs from read 1 and filter as per Allon et al 2015,
+    writing all selected cells to a single fastq with the cell barcode and
+    UMI in the read name '''
+
+    UMI_fastq = infile
+    fastq = infile.replace("_1.fastq.gz", "_2.fastq.gz")
+
+    barcodes1_infile = PARAMS['klein_barcodes1']
+    barcodes2_infile = PARAMS['klein_barcodes2']
+
+    sample = P.snip(os.path.basename(infile), "_1.fastq.gz")
+
+    # These are the number of cell barcodes according to Klein et al
+    sample2cellbarcodes = {
+        "SRR1784310": 935,
+        "SRR1784313": 301,
+        "SRR1784314": 682,
+        "SRR1784315": 799
+    }
+
+    cell_barcodes = sample2cellbarcodes[sample]
+
+    job_memory = "2G"
+    job_threads = 4
+
+    PipelineScRNASeq.extractUMIsAndFilterFastqGSE65525(
+        UMI_fastq, fastq, barcodes1_infile, barcodes2_infile, cell_barcodes,
+        processes=job_threads, tagged=True, submit=True,
+        job_threads=job_threads, job_memory=job_memory)
+
+
+@mkdir("GSE65525/processed.dir")
+@transform(extractTaggedGSE65525,
+           regex("GSE65525/fastqs.dir/(\S+)_tagged.fastq.gz"),
+           r"GSE65525/processed.dir/trimmed-\1_tagged.fastq.gz")
+def processTaggedReadsGSE65525(infile, outfile):
+    ''' process the reads with trimmomatic as per Klein et al 2015 '''
+
+    track = P.snip(os.path.basename(infile), ".fastq.gz")
+
+    threads = 1
+    job_memory = "7G"
+
+    # as per Allon et al 2015
+    trimmomatic_options = "LEADING:28 SLIDINGWINDOW:4:20 MINLEN:19"
+
+    m = PipelinePreprocess.MasterProcessor(
+        threads=threads)
+
+    m.add(PipelinePreprocess.Trimmomatic(
+        trimmomatic_options, threads=threads))
+
+    statement = m.build((infile,), "GSE65525/processed.dir/trimmed-", track)
+
+    P.run()
+
+
+@follows(mkdir("GSE65525/tagged.dir"),
+         indexFastaGSE65525)
+@transform(processTaggedReadsGSE65525,
+           regex("GSE65525/processed.dir/trimmed-(\S+)_tagged.fastq.gz"),
+           add_inputs(indexFastaGSE65525),
+           r"GSE65525/tagged.dir/\1.trans.bam")
+def mapBowtieTaggedGSE65525(infiles, outfile):
+    ''' map all the reads for a run against the transcriptome in a single
+    Bowtie job, parameterised as for mapBowtieAgainstTranscriptomeGSE65525
+    '''
+
+    infile, reference = infiles
+    job_threads = 4
+    job_options = "-l mem_free=1.9G"
+    bowtie_options = "-n1 -l 15 -e 300 -M 1 --best --strata"
+    bowtie_index_dir = os.path.abspath(
+        os.path.dirname(reference))
+    genome = P.snip(os.path.basename(reference), ".1.ebwt")
+    reffile = reference
+    bowtie_threads = job_threads
+
+    m = PipelineMapping.Bowtie(tool_options=bowtie_options,
+                               remove_non_unique=0,
+                               strip_sequence=0)
+
+    statement = m.build((infile,), outfile)
+    P.run()
+
+
+@subdivide(mapBowtieTaggedGSE65525,
+           regex("GSE65525/tagged.dir/(\S+).trans.bam"),
+           [r"GSE65525/tagged.dir/\1_dedup_unique.trans.bam",
+            r"GSE65525/tagged.dir/\1_dedup_percentile.trans.bam",
+            r"GSE65525/tagged.dir/\1_dedup_cluster.trans.bam",
+            r"GSE65525/tagged.dir/\1_dedup_adjacency.trans.bam",
+            r"GSE65525/tagged.dir/\1_dedup_directional.trans.bam"])
+def dedupTaggedGSE65525(infile, outfiles):
+    ''' perform deduping with various methods, separately for each cell,
+    reading and grouping the reads once for all the methods
+    '''
+
+    methods = [P.snip(outfile, ".trans.bam").split("_dedup_")[-1]
+               for outfile in outfiles]
+
+    job_memory = "4G"
+
+    PipelineUMI.dedupBamAllMethods(
+        infile, outfiles, methods,
+        per_contig=True, per_cell=True,
+        counts_outfile=P.snip(infile, ".trans.bam") + "_dedup.log",
+        submit=True,
+        job_memory=job_memory)
+
+
+@transform([mapBowtieTaggedGSE65525,
+            dedupTaggedGSE65525],
+           suffix(".trans.bam"),
+           ".trans.gene.counts.tsv")
+def countGenesPerCellTaggedGSE65525(infile, outfile):
+    ''' summarise counts per gene for every cell in a single pass '''
+
+    job_memory = "4G"
+    PipelineScRNASeq.countAlignmentsPerGenePerCell(
+        infile, outfile, mapq_threshold=10, submit=True,
+        job_memory=job_memory)
+
+
+@follows(countGenesPerCellTaggedGSE65525)
+def GSE65525Tagged():
+    pass
+
+
 @follows(mergeAndPlotEditDistancesGSE65525,
          mergeGeneCountsPerDayGSE65525,
          plotCVGSE65525,
@@ -701,6 +940,13 @@ def full():
     pass
 
 
+@follows(GSE65525Tagged,
+         GSE53638Tagged)
+def tagged():
+    ''' run the cell-tagged workflow for both datasets '''
+    pass
+
+
 @follows(mkdir("report"))
 def build_report():
     '''build report from scratch.
@@ -0,0 +1,42 @@
+''' Helpers for writing small bam files for the tests '''
+
+import pysam
+
+
+def make_read(name, contig_id, pos, cigar, is_reverse=False, mapq=255,
+              flag=0, tags=()):
+    ''' Make a pysam.AlignedSegment. cigar is a list of (operation,
+    length) tuples. '''
+
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.reference_id = contig_id
+    read.reference_start = pos
+    read.flag = flag | (16 if is_reverse else 0)
+    read.mapping_quality = mapq
+    read.cigartuples = cigar
+    length = sum(l for op, l in cigar if op in (0, 1, 4, 7, 8))
+    read.query_sequence = "A" * length
+    read.query_qualities = pysam.qualitystring_to_array("I" * length)
+    for tag, value in tags:
+        read.set_tag(tag, value)
+    return read
+
+
+def write_bam(filename, reads, contigs=(("chr1", 100000),), index=True):
+    ''' Write reads, sorted by position, to a bam file with the given
+    (name, length) contigs, and index it '''
+
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": name, "LN": length} for name, length in contigs]}
+
+    reads = sorted(reads, key=lambda read: (read.reference_id,
+                                            read.reference_start))
+    with pysam.AlignmentFile(filename, "wb", header=header) as outf:
+        for read in reads:
+            outf.write(read)
+
+    if index:
+        pysam.index(filename)
+
+    return filename
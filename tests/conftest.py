@@ -0,0 +1,14 @@
+''' Make the pipeline modules, the iCLIP package and the iCLIP scripts
+importable from the tests, without installing them '''
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in (os.path.join(ROOT, "iCLIPlib", "scripts"),
+             os.path.join(ROOT, "iCLIPlib"),
+             ROOT,
+             os.path.dirname(os.path.abspath(__file__))):
+    if path not in sys.path:
+        sys.path.insert(0, path)
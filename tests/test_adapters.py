@@ -0,0 +1,57 @@
+''' Tests for PipelineScRNASeq.AdapterMatcher, against comparing the
+adapter with each offset of the read in turn, as the fuzzy regex search
+(ADAPTER){s<=k} it replaces does '''
+
+import random
+
+import PipelineScRNASeq
+
+
+def _naive_search(adapter, seq, max_mismatches):
+
+    for start in range(len(seq) - len(adapter) + 1):
+        mismatches = sum(a != b for a, b in
+                         zip(adapter, seq[start:start + len(adapter)]))
+        if mismatches <= max_mismatches:
+            return start
+    return -1
+
+
+def _random_reads(rng, adapter, n):
+
+    reads = []
+    for i in range(n):
+        length = rng.randint(0, 60)
+        read = [rng.choice("ACGTN") for j in range(length)]
+        # insert a copy of the adapter with a few substitutions
+        if length >= len(adapter) and rng.random() < 0.7:
+            start = rng.randint(0, length - len(adapter))
+            read[start:start + len(adapter)] = adapter
+            for j in range(rng.randint(0, 4)):
+                read[start + rng.randrange(len(adapter))] = rng.choice("ACGT")
+        reads.append("".join(read))
+    return reads
+
+
+def test_search_matches_naive():
+
+    rng = random.Random(6)
+    adapter = PipelineScRNASeq.INDROP_ADAPTER.adapter
+
+    for max_mismatches in (0, 1, 2, 3):
+        matcher = PipelineScRNASeq.AdapterMatcher(adapter, max_mismatches)
+        reads = _random_reads(rng, adapter, 500)
+
+        expected = [_naive_search(adapter, read, max_mismatches)
+                    for read in reads]
+
+        assert [matcher.search(read) for read in reads] == expected
+        assert list(matcher.searchBatch(reads)) == expected
+
+
+def test_search_batch_empty():
+
+    matcher = PipelineScRNASeq.AdapterMatcher("ACGT", 1)
+
+    assert list(matcher.searchBatch([])) == []
+    assert list(matcher.searchBatch(["", "AC"])) == [-1, -1]
@@ -0,0 +1,99 @@
+''' Tests for PipelineiCLIP.collectBamStats, against counting each statistic
+separately, as bam2stats.py, samtools view | awk, umi_hist.py and
+bam_vs_bed.py did '''
+
+import collections
+import gzip
+import random
+
+import PipelineiCLIP
+
+from bam_helpers import make_read, write_bam
+
+
+def _read_table(filename, opener=open):
+    with opener(filename) as inf:
+        lines = [line.rstrip("\n").split("\t") for line in inf]
+    return dict((line[0], line[1]) for line in lines[1:])
+
+
+def test_collect_bam_stats(tmpdir):
+
+    rng = random.Random(1)
+    umis = ["AAAA", "CCCC", "GGGG", "TTTT", "ACGT"]
+    contigs = [("chr1", 10000), ("chr2", 10000)]
+
+    bedfile = str(tmpdir.join("contexts.bed"))
+    intervals = []
+    with open(bedfile, "w") as outf:
+        for contig, length in contigs:
+            for start in range(0, 5000, 500):
+                name = rng.choice(["exon", "intron", "utr3"])
+                intervals.append((contig, start, start + 300, name))
+                outf.write("%s\t%i\t%i\t%s\n" % (contig, start, start + 300,
+                                                 name))
+
+    reads = []
+    nspliced = 0
+    for i in range(600):
+        name = "read%i_%s" % (i, rng.choice(umis))
+        # reads mapped to 1, 2 or 3 places, some alignments of which are
+        # missing (e.g. removed by dedup), so that the NH counts do not
+        # divide exactly
+        nh = rng.choice([1, 1, 1, 2, 3])
+        for j in range(nh):
+            if nh > 1 and rng.random() < 0.3:
+                continue
+            if rng.random() < 0.1:
+                cigar = [(0, 10), (3, 100), (0, 20)]
+                nspliced += 1
+            else:
+                cigar = [(0, 30)]
+            reads.append(make_read(name, rng.randrange(2),
+                                   rng.randrange(0, 5000), cigar,
+                                   is_reverse=rng.random() < 0.5,
+                                   flag=256 if j > 0 else 0,
+                                   tags=[("NH", nh)]))
+
+    bamfile = write_bam(str(tmpdir.join("reads.bam")), reads, contigs)
+    prefix = str(tmpdir.join("reads"))
+
+    PipelineiCLIP.collectBamStats(bamfile, bedfile, prefix)
+
+    stats = _read_table(prefix + ".bam_stats.tsv")
+    assert int(stats["alignments_total"]) == len(reads)
+    assert int(stats["alignments_mapped"]) == len(reads)
+    assert int(stats["alignments_reverse"]) == \
+        sum(read.is_reverse for read in reads)
+    assert int(stats["alignments_secondary"]) == \
+        sum(read.is_secondary for read in reads)
+
+    # each alignment counts as 1/NH of a read
+    expected_reads = sum(1.0 / read.get_tag("NH") for read in reads)
+    assert int(stats["reads_mapped"]) == int(round(expected_reads))
+    assert int(stats["reads_unique"]) == \
+        sum(read.get_tag("NH") == 1 for read in reads)
+
+    with open(prefix + ".nspliced.txt") as inf:
+        assert int(inf.read()) == nspliced
+
+    umi_counts = collections.Counter(read.query_name.split("_")[-1]
+                                     for read in reads)
+    assert _read_table(prefix + ".umi_stats.tsv.gz", gzip.open) == \
+        dict((umi, str(count)) for umi, count in umi_counts.items())
+
+    contexts = collections.Counter()
+    for read in reads:
+        contig = contigs[read.reference_id][0]
+        length = read.aend - read.pos
+        for interval_contig, start, end, name in intervals:
+            if interval_contig == contig and \
+               min(end, read.aend) - max(start, read.pos) >= 0.5 * length:
+                contexts[name] += 1
+
+    context_stats = _read_table(prefix + ".reference_context.tsv")
+    assert int(context_stats.pop("total")) == len(reads)
+    assert context_stats == dict((context, str(count))
+                                 for context, count in contexts.items())
+
+    assert not tmpdir.join("reads.frag_length.tsv").exists()
@@ -0,0 +1,183 @@
+''' Tests for the bounded memory barcode counting and cell calling in
+PipelineScRNASeq, against exact counting of all the barcodes, which they
+replace '''
+
+import collections
+import gzip
+import random
+
+import PipelineScRNASeq
+
+ADAPTER = "GAGTGATTGCTTGTGACGCCTT"
+
+COMP = {"A": "T", "C": "G", "G": "C", "T": "A"}
+
+
+def _reverse_comp(seq):
+    return "".join(COMP[base] for base in seq[::-1])
+
+
+def _zipf_barcodes(rng, nbarcodes, n):
+    barcodes = ["bc%i" % i for i in range(nbarcodes)]
+    weights = [1.0 / (i + 1) for i in range(nbarcodes)]
+    return [_weighted_choice(rng, barcodes, weights) for i in range(n)]
+
+
+def _weighted_choice(rng, items, weights):
+    r = rng.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        r -= weight
+        if r < 0:
+            return item
+    return items[-1]
+
+
+def test_exact_counter_matches_counter():
+
+    barcodes = _zipf_barcodes(random.Random(7), 200, 5000)
+
+    counter = PipelineScRNASeq.BarcodeCounter()
+    counter.update(barcodes)
+
+    assert counter.total == len(barcodes)
+    assert dict(counter.most_common()) == collections.Counter(barcodes)
+
+
+def test_space_saving_bounds():
+
+    barcodes = _zipf_barcodes(random.Random(8), 500, 20000)
+    exact = collections.Counter(barcodes)
+
+    capacity = 50
+    counter = PipelineScRNASeq.BarcodeCounter(capacity)
+    counter.update(barcodes)
+
+    assert counter.total == len(barcodes)
+    assert len(counter.counts) == capacity
+    assert sum(counter.counts.values()) == len(barcodes)
+
+    for barcode, count in counter.most_common():
+        # counts overestimate by at most the recorded error
+        assert exact[barcode] <= count
+        assert count - counter.errors[barcode] <= exact[barcode]
+
+    # every barcode more frequent than total/capacity is counted
+    for barcode, count in exact.items():
+        if count > len(barcodes) / float(capacity):
+            assert barcode in counter.counts
+
+    # and the most frequent barcodes are found in order
+    assert [barcode for barcode, count in counter.most_common(5)] == \
+        [barcode for barcode, count in exact.most_common(5)]
+
+
+def test_find_knee():
+
+    # 100 cells with many reads, then a long tail of background barcodes
+    rng = random.Random(9)
+    counts = sorted([rng.randint(5000, 10000) for i in range(100)] +
+                    [rng.randint(1, 50) for i in range(5000)],
+                    reverse=True)
+
+    assert PipelineScRNASeq.findKnee(counts) == 100
+    assert PipelineScRNASeq.findKnee([10, 5]) == 2
+
+
+def test_spill_store(tmpdir):
+
+    rng = random.Random(10)
+    added = collections.defaultdict(list)
+
+    store = PipelineScRNASeq.BarcodeSpillStore(
+        str(tmpdir.join("spill.tmp")), buffer_size=500)
+
+    for i in range(2000):
+        barcode = "bc%i" % rng.randrange(300)
+        record = "read%i\n" % i
+        added[barcode].append(record)
+        store.add(barcode, record)
+
+    selected = ["bc%i" % i for i in range(0, 300, 7)]
+    retrieved = collections.defaultdict(list)
+    for barcode, block in store.blocks(selected):
+        retrieved[barcode].append(block)
+
+    store.close()
+    assert not tmpdir.join("spill.tmp").exists()
+
+    assert set(retrieved) == set(b for b in selected if b in added)
+    for barcode in retrieved:
+        assert "".join(retrieved[barcode]) == "".join(added[barcode])
+
+
+def _write_fastqs(tmpdir, cells, rng):
+
+    barcodes1 = sorted(set(cell[:8] for cell in cells))
+    barcodes2 = sorted(set(cell[8:] for cell in cells))
+
+    with open(str(tmpdir.join("barcodes1.txt")), "w") as outf:
+        outf.write("".join(_reverse_comp(b) + "\n" for b in barcodes1))
+    with open(str(tmpdir.join("barcodes2.txt")), "w") as outf:
+        outf.write("".join(_reverse_comp(b) + "\n" for b in barcodes2))
+
+    weights = [1.0 / (i + 1) ** 2 for i in range(len(cells))]
+    reads = collections.Counter()
+
+    UMI_fastq = gzip.open(str(tmpdir.join("sample_1.fastq.gz")), "w")
+    seq_fastq = gzip.open(str(tmpdir.join("sample_2.fastq.gz")), "w")
+
+    for i in range(3000):
+        cell = _weighted_choice(rng, cells, weights)
+        reads[cell] += 1
+        UMI = "".join(rng.choice("ACGT") for j in range(6))
+        UMI_seq = cell[:8] + ADAPTER + cell[8:] + UMI + "TTTTTTT"
+        UMI_fastq.write("@read%i 1\n%s\n+\n%s\n" % (
+            i, UMI_seq, "I" * len(UMI_seq)))
+        seq_fastq.write("@read%i 2\n%s\n+\n%s\n" % (
+            i, "ACGT" * 10, "I" * 40))
+
+    UMI_fastq.close()
+    seq_fastq.close()
+
+    return reads
+
+
+def test_extract_counts_written_reads(tmpdir):
+
+    rng = random.Random(11)
+    cells = ["".join(rng.choice("ACGT") for j in range(16))
+             for i in range(60)]
+    reads = _write_fastqs(tmpdir, cells, rng)
+
+    PipelineScRNASeq.extractUMIsAndFilterFastqGSE65525(
+        str(tmpdir.join("sample_1.fastq.gz")),
+        str(tmpdir.join("sample_2.fastq.gz")),
+        str(tmpdir.join("barcodes1.txt")),
+        str(tmpdir.join("barcodes2.txt")),
+        cell_barcode_count=10, chunk_size=100, barcode_distance=0,
+        spill_buffer_size=2000, barcode_counter_capacity=15)
+
+    prefix = str(tmpdir.join("sample"))
+
+    with open(prefix + "_barcode_counts2.tsv") as inf:
+        reported = dict((line.split("\t")[0], int(line.split("\t")[1]))
+                        for line in inf)
+
+    assert len(reported) == 10
+    for cell, count in reported.items():
+        with gzip.open(prefix + "_UMI_%s.fastq.gz" % cell) as inf:
+            nrecords = sum(1 for line in inf) // 4
+        assert count == nrecords == reads[cell]
+
+    with open(prefix + "_log2.tsv") as inf:
+        log = dict((line.split("\t")[0], int(line.split("\t")[1]))
+                   for line in inf)
+
+    assert log["total"] == 3000
+    assert log["kept"] == sum(reported.values())
+    assert log["cell_barcode_mismatch"] == 3000 - log["kept"]
+
+    # the refreshed table is rewritten with every counted barcode at the end
+    with open(prefix + "_barcode_counts.tsv") as inf:
+        assert len(inf.readlines()) == 15
+    assert not tmpdir.join("sample_barcode_counts.tsv.tmp").exists()
@@ -0,0 +1,60 @@
+''' Tests for PipelineScRNASeq.BarcodeCorrector, against finding the
+closest whitelisted barcode by brute force '''
+
+import itertools
+import random
+
+import PipelineScRNASeq
+
+
+def _hamming(a, b):
+    return sum(x != y for x, y in zip(a, b))
+
+
+def _brute_force_correct(barcodes, sequence, distance):
+
+    dists = sorted((_hamming(sequence, barcode), barcode)
+                   for barcode in barcodes if len(barcode) == len(sequence))
+    dists = [(d, barcode) for d, barcode in dists if d <= distance]
+
+    if not dists:
+        return None, False
+    if len(dists) > 1 and dists[0][0] == dists[1][0]:
+        return None, True
+    return dists[0][1], False
+
+
+def test_matches_brute_force():
+
+    rng = random.Random(5)
+    barcodes = set("".join(rng.choice("ACGT") for i in range(6))
+                   for j in range(30))
+    # some barcodes close together, so that some sequences are ambiguous
+    barcodes.update(["AAAAAA", "AAAACC", "AAACCC"])
+
+    for distance in (0, 1, 2):
+        index = PipelineScRNASeq.BarcodeCorrector(barcodes, distance)
+
+        sequences = set(barcodes)
+        for barcode in barcodes:
+            sequences.update(neighbour for neighbour, d in
+                             index._neighbourhood(barcode, 3, "ACGTN"))
+        sequences.update("".join(bases)
+                         for bases in itertools.product("ACN", repeat=6))
+
+        for sequence in sequences:
+            expected, ambiguous = _brute_force_correct(barcodes, sequence,
+                                                       distance)
+            assert index.correct(sequence) == expected, sequence
+            assert index.isAmbiguous(sequence) == ambiguous, sequence
+            assert (sequence in index) == (sequence in barcodes)
+
+
+def test_different_lengths():
+
+    index = PipelineScRNASeq.BarcodeCorrector(["ACGTACGT", "TTTTTT"], 2)
+
+    assert index.correct("ACGTACGA") == "ACGTACGT"
+    assert index.correct("TTTTAA") == "TTTTTT"
+    assert index.correct("ACGTACG") is None
+    assert index.correct("TTTTTTT") is None
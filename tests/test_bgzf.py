@@ -0,0 +1,74 @@
+''' Tests for PipelineScRNASeq.CellFastqWriter, against writing each cell's
+records to its own gzip file as IOTools.FilePool did '''
+
+import collections
+import gzip
+import random
+import struct
+import zlib
+
+import PipelineScRNASeq
+
+
+def _bgzf_blocks(filename):
+    ''' Return the uncompressed sizes of the BGZF blocks in filename,
+    checking the block sizes in the headers '''
+
+    data = open(filename, "rb").read()
+    sizes = []
+    offset = 0
+    while offset < len(data):
+        assert data[offset:offset + 4] == "\x1f\x8b\x08\x04"
+        assert data[offset + 12:offset + 14] == "BC"
+        bsize = struct.unpack("<H", data[offset + 16:offset + 18])[0] + 1
+        sizes.append(struct.unpack("<I", data[offset + bsize - 4:
+                                              offset + bsize])[0])
+        offset += bsize
+
+    assert offset == len(data)
+    return sizes
+
+
+def _gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def test_matches_gzip_per_cell(tmpdir):
+
+    rng = random.Random(12)
+    expected = collections.defaultdict(list)
+
+    pattern = str(tmpdir.join("%s.fastq.gz"))
+    writer = PipelineScRNASeq.CellFastqWriter(
+        pattern, buffer_size=20000, threads=2, max_open=3)
+
+    for i in range(3000):
+        cell = "cell%i" % rng.randrange(10)
+        # some records larger than a BGZF block
+        length = rng.choice([50, 50, 50, 70000])
+        record = "@read%i\n%s\n+\n%s\n" % (i, "A" * length, "I" * length)
+        expected[cell].append(record)
+        writer.write(cell, record)
+
+    writer.close()
+
+    for cell, records in expected.items():
+        filename = pattern % cell
+        with gzip.open(filename) as inf:
+            assert inf.read() == "".join(records)
+
+        sizes = _bgzf_blocks(filename)
+        # the file ends with the empty EOF block
+        assert sizes[-1] == 0
+        assert max(sizes) <= PipelineScRNASeq.BGZF_BLOCK_SIZE
+        assert sum(sizes) == len("".join(records))
+
+
+def test_compress_block():
+
+    data = "ACGT" * 1000
+    block = PipelineScRNASeq.compressBGZFBlock(data)
+
+    assert len(block) == struct.unpack("<H", block[16:18])[0] + 1
+    assert _gunzip(block) == data
+    assert _gunzip(PipelineScRNASeq.BGZF_EOF) == ""
@@ -0,0 +1,130 @@
+''' Tests for iCLIP.call_reproducible_clusters, against merging all the
+replicates' clusters pairwise, as the bed2bed.py merges it replaces did '''
+
+import gzip
+import random
+
+import iCLIP
+
+
+def _write_bed12(filename, clusters):
+    ''' clusters is a list of (contig, strand, blocks) '''
+
+    with gzip.open(filename, "w") as outf:
+        for contig, strand, blocks in sorted(clusters):
+            start, end = blocks[0][0], blocks[-1][1]
+            outf.write("\t".join(map(str, [
+                contig, start, end, "cluster", 1, strand, start, end, 0,
+                len(blocks),
+                ",".join(str(e - s) for s, e in blocks),
+                ",".join(str(s - start) for s, e in blocks)])) + "\n")
+
+
+def _read_bed12(filename):
+
+    clusters = []
+    with gzip.open(filename) as inf:
+        for line in inf:
+            fields = line.rstrip("\n").split("\t")
+            start = int(fields[1])
+            sizes = map(int, fields[10].split(","))
+            starts = map(int, fields[11].split(","))
+            clusters.append((fields[0], fields[5], int(fields[4]),
+                             [(start + s, start + s + l)
+                              for s, l in zip(starts, sizes)]))
+    return clusters
+
+
+def _naive_merge(replicates, min_overlap):
+    ''' Merge clusters from all replicates that overlap or abut,
+    transitively, by repeated pairwise comparison '''
+
+    clusters = [(contig, strand, blocks[0][0], blocks[-1][1],
+                 set([rep]), list(blocks))
+                for rep, replicate in enumerate(replicates)
+                for contig, strand, blocks in replicate]
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(clusters)):
+            for j in range(i + 1, len(clusters)):
+                a, b = clusters[i], clusters[j]
+                if a[:2] == b[:2] and a[2] <= b[3] and b[2] <= a[3]:
+                    clusters[i] = (a[0], a[1], min(a[2], b[2]),
+                                   max(a[3], b[3]), a[4] | b[4],
+                                   a[5] + b[5])
+                    del clusters[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    result = []
+    for contig, strand, start, end, reps, blocks in clusters:
+        if len(reps) < min_overlap:
+            continue
+        combined = []
+        for block_start, block_end in sorted(blocks):
+            if combined and block_start <= combined[-1][1]:
+                combined[-1] = (combined[-1][0],
+                                max(combined[-1][1], block_end))
+            else:
+                combined.append((block_start, block_end))
+        result.append((contig, strand, len(reps), combined))
+
+    return sorted(result)
+
+
+def _random_replicate(rng, n):
+
+    clusters = []
+    for i in range(n):
+        start = rng.randrange(0, 5000)
+        blocks = []
+        for j in range(rng.randint(1, 3)):
+            block_start = start + rng.randint(0, 50)
+            blocks.append((block_start, block_start + rng.randint(5, 40)))
+            start = blocks[-1][1]
+        clusters.append((rng.choice(["chr1", "chr2"]), rng.choice("+-"),
+                         blocks))
+    return clusters
+
+
+def test_simple_reproducible_clusters(tmpdir):
+
+    replicates = [
+        [("chr1", "+", [(100, 120)]), ("chr1", "+", [(500, 520)])],
+        [("chr1", "+", [(110, 130), (150, 160)]),
+         ("chr1", "-", [(500, 520)])],
+        [("chr1", "+", [(120, 125)])]]
+
+    infiles = []
+    for i, replicate in enumerate(replicates):
+        infiles.append(str(tmpdir.join("rep%i.bed.gz" % i)))
+        _write_bed12(infiles[-1], replicate)
+
+    outfile = str(tmpdir.join("reproducible.bed.gz"))
+    n = iCLIP.call_reproducible_clusters(infiles, outfile, min_overlap=2)
+
+    assert n == 1
+    assert _read_bed12(outfile) == [
+        ("chr1", "+", 3, [(100, 130), (150, 160)])]
+
+
+def test_matches_pairwise_merge(tmpdir):
+
+    rng = random.Random(4)
+    replicates = [_random_replicate(rng, 80) for i in range(3)]
+
+    infiles = []
+    for i, replicate in enumerate(replicates):
+        infiles.append(str(tmpdir.join("rep%i.bed.gz" % i)))
+        _write_bed12(infiles[-1], replicate)
+
+    for min_overlap in (1, 2, 3):
+        outfile = str(tmpdir.join("reproducible%i.bed.gz" % min_overlap))
+        iCLIP.call_reproducible_clusters(infiles, outfile, min_overlap)
+
+        assert sorted(_read_bed12(outfile)) == \
+            _naive_merge(replicates, min_overlap)
@@ -0,0 +1,77 @@
+''' Tests for the sweep counting in iCLIP.counting, against counting each
+feature with fetch, which it replaces '''
+
+import random
+
+import pysam
+
+import iCLIP
+from iCLIP import counting
+
+from bam_helpers import make_read, write_bam
+
+
+def _random_reads(n, contigs, length, seed):
+
+    rng = random.Random(seed)
+    reads = []
+    for i in range(n):
+        contig = rng.randrange(len(contigs))
+        pos = rng.randrange(10, length - 100)
+        if rng.random() < 0.2:
+            cigar = [(0, 10), (2, 2), (0, 20)]
+        else:
+            cigar = [(0, rng.choice([20, 35]))]
+        reads.append(make_read("read%i" % i, contig, pos, cigar,
+                               is_reverse=rng.random() < 0.5))
+    return reads
+
+
+def _random_features(n, contigs, length, seed):
+
+    rng = random.Random(seed)
+    features = []
+    for i in range(n):
+        contig = rng.choice(contigs)
+        start = rng.randrange(0, length - 1000)
+        exons = []
+        for j in range(rng.randint(1, 4)):
+            exon_start = start + rng.randint(1, 150)
+            exon_end = exon_start + rng.randint(20, 200)
+            exons.append((exon_start, exon_end))
+            start = exon_end
+        features.append((contig, exons, rng.choice("+-.")))
+    return features
+
+
+def test_iterate_crosslinks_is_sorted(tmpdir):
+
+    contigs = [("chr1", 5000)]
+    bamfile = write_bam(str(tmpdir.join("reads.bam")),
+                        _random_reads(500, contigs, 5000, seed=1), contigs)
+
+    bam = pysam.AlignmentFile(bamfile)
+    expected = sorted((counting.getCrosslink(read), read.is_reverse)
+                      for read in bam.fetch("chr1"))
+    observed = list(iCLIP.iterate_crosslinks(bam.fetch("chr1")))
+
+    assert observed == sorted(observed)
+    assert sorted(observed) == expected
+
+
+def test_sweep_matches_fetch(tmpdir):
+
+    contigs = [("chr1", 5000), ("chr2", 5000)]
+    bamfile = write_bam(str(tmpdir.join("reads.bam")),
+                        _random_reads(2000, contigs, 5000, seed=2), contigs)
+    features = _random_features(60, ["chr1", "chr2", "chr3"], 5000, seed=3)
+
+    bam = pysam.AlignmentFile(bamfile)
+    fetch_exons, fetch_introns = iCLIP.count_features(bam, features,
+                                                      method="fetch")
+    sweep_exons, sweep_introns = iCLIP.count_features(bam, features,
+                                                      method="sweep")
+
+    assert fetch_exons.sum() > 0
+    assert list(sweep_exons) == list(fetch_exons)
+    assert list(sweep_introns) == list(fetch_introns)
@@ -0,0 +1,67 @@
+''' Tests for the heatmap clustering in PipelineScRNASeq, against
+scipy's Spearman correlation, which replaces R's cor(method="spearman") '''
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+import PipelineScRNASeq
+
+
+def _random_df(seed, ngenes=30, ncells=8):
+
+    random_state = np.random.RandomState(seed)
+    # poisson counts, so there are ties to rank
+    values = random_state.poisson(2, size=(ngenes, ncells))
+    return pd.DataFrame(values,
+                        index=["gene%i" % i for i in range(ngenes)],
+                        columns=["cell%i" % i for i in range(ncells)])
+
+
+def test_spearman_matches_scipy():
+
+    df = _random_df(1)
+
+    np.testing.assert_allclose(
+        PipelineScRNASeq.spearmanCorrelation(df),
+        scipy.stats.spearmanr(df.values)[0])
+
+
+def test_spearman_constant_column():
+
+    df = _random_df(2)
+    df["cell3"] = 1
+
+    correlation = PipelineScRNASeq.spearmanCorrelation(df)
+
+    assert (correlation[3, np.arange(8) != 3] == 0).all()
+
+
+def test_cluster_heatmap_cache(tmpdir):
+
+    cache_file = str(tmpdir.join("clustering.npz"))
+    df = _random_df(3)
+
+    first = PipelineScRNASeq.clusterHeatmap(df, cache_file)
+    np.testing.assert_array_equal(
+        first["columns"], PipelineScRNASeq.spearmanLinkage(df, "ward"))
+    np.testing.assert_array_equal(
+        first["rows"], PipelineScRNASeq.spearmanLinkage(df.T, "average"))
+
+    cached = PipelineScRNASeq.clusterHeatmap(df, cache_file)
+    assert str(cached["digest"]) == str(first["digest"])
+    np.testing.assert_array_equal(cached["columns"], first["columns"])
+
+    # the same labels with different values are clustered again
+    changed = _random_df(4)
+    clustering = PipelineScRNASeq.clusterHeatmap(changed, cache_file)
+    np.testing.assert_array_equal(
+        clustering["columns"],
+        PipelineScRNASeq.spearmanLinkage(changed, "ward"))
+
+    # as are the same values with a different method
+    clustering = PipelineScRNASeq.clusterHeatmap(changed, cache_file,
+                                                 column_method="complete")
+    np.testing.assert_array_equal(
+        clustering["columns"],
+        PipelineScRNASeq.spearmanLinkage(changed, "complete"))
@@ -0,0 +1,86 @@
+''' Tests for PipelineScRNASeq.randomizedPCA, against a full PCA by SVD of
+the centred matrix, as computed by R's prcomp which it replaces '''
+
+import numpy as np
+import pandas as pd
+
+import PipelineScRNASeq
+
+
+def _exact_pca(matrix):
+
+    centred = matrix - matrix.mean(axis=0)
+    U, s, Vt = np.linalg.svd(centred, full_matrices=False)
+
+    # the same sign convention as randomizedPCA
+    signs = np.sign(Vt[np.arange(len(s)), np.abs(Vt).argmax(axis=1)])
+    U *= signs
+    Vt *= signs[:, np.newaxis]
+
+    return U * s, Vt.T, s ** 2 / (s ** 2).sum()
+
+
+def _low_rank_matrix(seed, nrows=60, ncols=200, rank=5):
+
+    random_state = np.random.RandomState(seed)
+    scale = 10.0 * 2.0 ** -np.arange(rank)
+    return (random_state.normal(size=(nrows, rank)) * scale).dot(
+        random_state.normal(size=(rank, ncols))) + \
+        random_state.normal(scale=0.1, size=(nrows, ncols))
+
+
+def test_matches_exact_pca():
+
+    matrix = _low_rank_matrix(1)
+    n_components = 4
+
+    scores, loadings, variance = PipelineScRNASeq.randomizedPCA(
+        matrix, n_components)
+    exact_scores, exact_loadings, exact_variance = _exact_pca(matrix)
+
+    assert scores.shape == (60, n_components)
+    assert loadings.shape == (200, n_components)
+
+    np.testing.assert_allclose(variance, exact_variance[:n_components],
+                               rtol=1e-6)
+    np.testing.assert_allclose(scores, exact_scores[:, :n_components],
+                               atol=1e-6)
+    np.testing.assert_allclose(loadings, exact_loadings[:, :n_components],
+                               atol=1e-6)
+
+
+def test_reproducible_and_more_components_than_rank():
+
+    matrix = _low_rank_matrix(2, nrows=8, ncols=30)
+
+    first = PipelineScRNASeq.randomizedPCA(matrix, 20, seed=3)
+    second = PipelineScRNASeq.randomizedPCA(matrix, 20, seed=3)
+
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+
+    # at most as many components as observations
+    scores, loadings, variance = first
+    assert scores.shape == (8, 8)
+    np.testing.assert_allclose(variance.sum(), 1.0)
+
+
+def test_run_pca():
+
+    matrix = _low_rank_matrix(4, nrows=20, ncols=50)
+    df = pd.DataFrame(matrix.T,
+                      index=["gene%i" % i for i in range(50)],
+                      columns=["cell%i" % i for i in range(20)])
+
+    PCs_df, loadings_df, variance_df = PipelineScRNASeq.runPCA(df, 3)
+
+    assert list(PCs_df.columns) == ["PC1", "PC2", "PC3"]
+    assert list(PCs_df.index) == list(df.columns)
+    assert list(loadings_df.index) == list(df.index)
+    assert list(variance_df["PC"]) == [1, 2, 3]
+
+    exact_scores, exact_loadings, exact_variance = _exact_pca(matrix)
+    np.testing.assert_allclose(PCs_df.values, exact_scores[:, :3],
+                               atol=1e-6)
+    np.testing.assert_allclose(variance_df["Variance_explained"].values,
+                               np.round(exact_variance[:3], 5))
@@ -0,0 +1,74 @@
+''' Tests for PipelineiCLIP.reservoirSample, against the proportional
+sampling of fasta2fasta.py it replaces, which kept each sequence with
+probability nreads/nseqs '''
+
+import collections
+
+import PipelineiCLIP
+
+
+def test_sample_size_and_order():
+
+    items = range(1000)
+    for seed in range(20):
+        sample = PipelineiCLIP.reservoirSample(iter(items), 50, seed=seed)
+        assert len(sample) == 50
+        assert len(set(sample)) == 50
+        assert sample == sorted(sample)
+
+
+def test_fewer_items_than_n():
+
+    assert PipelineiCLIP.reservoirSample(iter(range(10)), 50) == range(10)
+    assert PipelineiCLIP.reservoirSample(
+        iter(range(10)), 50, weight=lambda x: 1) == range(10)
+
+
+def test_uniform_inclusion_matches_proportion():
+
+    nitems, n, ntrials = 100, 10, 5000
+    counts = collections.Counter()
+    for seed in range(ntrials):
+        counts.update(PipelineiCLIP.reservoirSample(iter(range(nitems)), n,
+                                                    seed=seed))
+
+    # every item should be kept with probability n/nitems, as the
+    # proportional sampler did
+    expected = ntrials * float(n) / nitems
+    for item in range(nitems):
+        assert abs(counts[item] - expected) < 0.2 * expected
+
+
+def test_weighted_sample():
+
+    weights = dict((item, item % 4) for item in range(40))
+    counts = collections.Counter()
+    for seed in range(2000):
+        sample = PipelineiCLIP.reservoirSample(
+            iter(range(40)), 5, seed=seed, weight=weights.get)
+        assert len(sample) == 5
+        assert sample == sorted(sample)
+        counts.update(weights[item] for item in sample)
+
+    assert counts[0] == 0
+    assert counts[1] < counts[2] < counts[3]
+
+
+def test_subsample_fasta(tmpdir):
+
+    infile = str(tmpdir.join("in.fasta"))
+    with open(infile, "w") as outf:
+        for i in range(200):
+            outf.write(">seq%i\n%s\n" % (i, "ACGT" * (i % 5 + 1)))
+
+    outfile = str(tmpdir.join("out.fasta"))
+    logfile = str(tmpdir.join("out.log"))
+    PipelineiCLIP.subsampleNReadsFromFasta(infile, outfile, 30,
+                                           logfile=logfile, seed=1)
+
+    with open(outfile) as inf:
+        titles = [line[1:].strip() for line in inf if line.startswith(">")]
+
+    assert len(titles) == 30
+    assert len(set(titles)) == 30
+    assert open(logfile).read().startswith("sampled 30 of 200 sequences")
@@ -0,0 +1,135 @@
+''' Tests for PipelineiCLIP.ContextCounter and saturationAnalysis, against
+checking every alignment against every context, as bam_vs_bed.py does,
+and deduping the whole bam '''
+
+import collections
+import random
+
+import pysam
+
+import PipelineiCLIP
+from iCLIP import umi
+
+from bam_helpers import make_read, write_bam
+
+CONTEXTS = ["exon", "intron", "utr3", "repeat"]
+
+
+def _write_contexts(filename, seed, contigs=("chr1", "chr2")):
+
+    rng = random.Random(seed)
+    intervals = []
+    for contig in contigs:
+        for i in range(150):
+            start = rng.randrange(0, 5000)
+            intervals.append((contig, start, start + rng.randint(5, 400),
+                              rng.choice(CONTEXTS)))
+
+    with open(filename, "w") as outf:
+        for contig, start, end, name in sorted(intervals):
+            outf.write("%s\t%i\t%i\t%s\t0\t+\n" % (contig, start, end, name))
+
+    return intervals
+
+
+def _naive_contexts(intervals, contig, start, end, min_overlap=0.5):
+
+    return sorted(name for interval_contig, interval_start, interval_end, name
+                  in intervals
+                  if interval_contig == contig and
+                  min(end, interval_end) - max(start, interval_start) >=
+                  max(min_overlap * (end - start), 1))
+
+
+def test_context_counter_matches_naive(tmpdir):
+
+    bedfile = str(tmpdir.join("contexts.bed"))
+    intervals = _write_contexts(bedfile, 1)
+
+    # sorted on start within each contig, but contigs in any order, and
+    # one contig without any contexts
+    rng = random.Random(2)
+    alignments = []
+    for contig in ("chr1", "chr3", "chr2"):
+        alignments.extend(sorted(
+            (contig, start, start + rng.randint(1, 60))
+            for start in (rng.randrange(0, 5200) for i in range(300))))
+
+    for min_overlap in (0.5, 1.0, 0.1):
+        counter = PipelineiCLIP.ContextCounter(bedfile, min_overlap)
+        for contig, start, end in alignments:
+            counter.release(start)
+            assert sorted(counter.contexts(contig, start, end)) == \
+                _naive_contexts(intervals, contig, start, end, min_overlap)
+
+
+def test_context_counter_release_out_of_order(tmpdir):
+
+    bedfile = str(tmpdir.join("contexts.bed"))
+    intervals = _write_contexts(bedfile, 3, contigs=("chr1",))
+
+    # alignments out of order by up to 100 bases, released 100 bases
+    # behind the furthest start seen
+    rng = random.Random(4)
+    starts = sorted(rng.randrange(100, 5000) for i in range(500))
+    starts = [start - rng.randint(0, 100) for start in starts]
+
+    counter = PipelineiCLIP.ContextCounter(bedfile)
+    furthest = 0
+    for start in starts:
+        furthest = max(furthest, start)
+        counter.release(furthest - 100)
+        assert sorted(counter.contexts("chr1", start, start + 30)) == \
+            _naive_contexts(intervals, "chr1", start, start + 30)
+
+
+def _read_table(filename):
+    with open(filename) as inf:
+        lines = [line.rstrip("\n").split("\t") for line in inf]
+    return [dict(zip(lines[0], line)) for line in lines[1:]]
+
+
+def test_saturation_matches_full_dedup(tmpdir):
+
+    bedfile = str(tmpdir.join("contexts.bed"))
+    intervals = _write_contexts(bedfile, 5)
+
+    rng = random.Random(6)
+    umis = ["".join(rng.choice("ACGT") for i in range(4)) for j in range(8)]
+    reads = [make_read("read%i_%s" % (i, rng.choice(umis)),
+                       rng.randrange(2), rng.randrange(0, 5000, 5),
+                       [(0, 30)], is_reverse=rng.random() < 0.5)
+             for i in range(3000)]
+    contigs = [("chr1", 10000), ("chr2", 10000)]
+    bamfile = write_bam(str(tmpdir.join("reads.bam")), reads, contigs)
+
+    stats_outfile = str(tmpdir.join("stats.tsv"))
+    context_outfile = str(tmpdir.join("contexts.tsv"))
+    PipelineiCLIP.saturationAnalysis(bamfile, bedfile,
+                                     (stats_outfile, context_outfile),
+                                     seed=7)
+
+    # dedup the whole bam, and count the contexts of the deduped reads
+    dedup_bamfile = str(tmpdir.join("dedup.bam"))
+    counts = umi.dedup_bam(bamfile, {"cluster": dedup_bamfile})
+
+    expected_contexts = collections.Counter()
+    for read in pysam.AlignmentFile(dedup_bamfile):
+        expected_contexts.update(_naive_contexts(
+            intervals, contigs[read.reference_id][0], read.pos, read.aend))
+
+    molecules = dict((float(row["subset"]), int(row["counts"]))
+                     for row in _read_table(stats_outfile)
+                     if row["category"] == "reads_total")
+
+    assert molecules[1.0] == counts["cluster"]
+    fractions = sorted(molecules)
+    assert [molecules[f] for f in fractions] == \
+        sorted(molecules[f] for f in fractions)
+
+    observed_contexts = dict((row["category"], int(row["alignments"]))
+                             for row in _read_table(context_outfile)
+                             if float(row["subset"]) == 1.0 and
+                             row["category"] != "total")
+
+    assert observed_contexts == dict(expected_contexts)
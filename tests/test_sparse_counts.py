@@ -0,0 +1,105 @@
+''' Tests for PipelineScRNASeq.SparseCounts, against the dense pandas
+operations on gene x cell tables it replaces '''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import PipelineScRNASeq
+
+
+def _random_counts(seed, ngenes=40, ncells=12):
+
+    random_state = np.random.RandomState(seed)
+    values = random_state.poisson(0.5, size=(ngenes, ncells))
+    values[random_state.rand(ngenes, ncells) < 0.5] = 0
+    # one cell without any counts
+    values[:, 3] = 0
+
+    genes = ["gene%02i" % i for i in random_state.permutation(ngenes)]
+    cells = ["cell%i" % i for i in range(ncells)]
+
+    df = pd.DataFrame(values, index=genes, columns=cells)
+    df.index.names = ["gene"]
+    return df
+
+
+def test_round_trip(tmpdir):
+
+    df = _random_counts(1)
+    counts = PipelineScRNASeq.SparseCounts.fromDataFrame(df)
+
+    outfile = str(tmpdir.join("counts.tsv.gz"))
+    counts.writeTable(outfile)
+
+    table = pd.read_csv(outfile, sep="\t", index_col=0)
+    pd.util.testing.assert_frame_equal(table, df)
+
+    pd.util.testing.assert_frame_equal(
+        PipelineScRNASeq.readCounts(outfile).toDataFrame(), df)
+
+
+def test_read_counts_ignores_stale_sparse_matrix(tmpdir):
+
+    outfile = str(tmpdir.join("counts.tsv.gz"))
+    PipelineScRNASeq.SparseCounts.fromDataFrame(
+        _random_counts(2)).writeTable(outfile)
+
+    # the table is rewritten by something other than writeTable
+    df = _random_counts(3)
+    df.to_csv(outfile, sep="\t", compression="gzip")
+    sparse_file = PipelineScRNASeq.sparseCountsFilename(outfile)
+    mtime = os.path.getmtime(sparse_file)
+    os.utime(outfile, (mtime + 10, mtime + 10))
+
+    pd.util.testing.assert_frame_equal(
+        PipelineScRNASeq.readCounts(outfile).toDataFrame(), df)
+
+
+def test_matches_dense_operations():
+
+    df = _random_counts(4)
+    other = _random_counts(5, ngenes=30).iloc[:, :5]
+    other.columns = ["other%i" % i for i in range(5)]
+
+    counts = PipelineScRNASeq.SparseCounts.fromDataFrame(df)
+
+    pd.util.testing.assert_frame_equal(
+        counts.sortGenes().toDataFrame(), df.sort_index())
+
+    # removeObservationsFreq
+    pd.util.testing.assert_frame_equal(
+        counts.removeObservationsFreq(2).toDataFrame(),
+        df[df.max(axis=1) >= 2])
+
+    # subsetCells by name
+    pd.util.testing.assert_frame_equal(
+        counts.subsetCells(["cell5", "cell1"]).toDataFrame(),
+        df[["cell5", "cell1"]])
+
+    # concat, filling genes missing from either table with zeros
+    dense = pd.concat([df, other], axis=1).fillna(0).astype(np.int64)
+    dense.index.names = ["gene"]
+    pd.util.testing.assert_frame_equal(
+        counts.concat(
+            [PipelineScRNASeq.SparseCounts.fromDataFrame(other)]
+        ).toDataFrame().astype(np.int64),
+        dense.sort_index())
+
+    # normalise
+    size_factors = df.sum(axis=0).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for method, target in (("total-count", size_factors.mean()),
+                               ("total-column", 1.0),
+                               ("million-counts", 1000000.0)):
+            expected = (df * target / size_factors).fillna(0)
+            observed = counts.normalise(method).toDataFrame()
+            np.testing.assert_allclose(observed.values, expected.values)
+
+    # mean and CV
+    mean, cv = counts.meanAndCV()
+    np.testing.assert_allclose(mean, df.mean(axis=1).values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.testing.assert_allclose(
+            cv, (df.std(axis=1, ddof=0) / df.mean(axis=1)).values)
@@ -0,0 +1,79 @@
+''' Tests for PipelineiCLIP.calculateSplicingIndex '''
+
+import PipelineiCLIP
+
+from bam_helpers import make_read, write_bam
+
+
+def _write_gtf(filename, transcripts):
+    ''' transcripts is a list of (transcript_id, contig, strand, exons) '''
+
+    with open(filename, "w") as outf:
+        for transcript_id, contig, strand, exons in transcripts:
+            for start, end in exons:
+                outf.write("\t".join(map(str, [
+                    contig, "protein_coding", "exon", start + 1, end, ".",
+                    strand, ".",
+                    'gene_id "%s"; transcript_id "%s";' % (
+                        transcript_id, transcript_id)])) + "\n")
+
+
+def _read_table(filename):
+    with open(filename) as inf:
+        lines = [line.rstrip("\n").split("\t") for line in inf]
+    return [dict(zip(lines[0], line)) for line in lines[1:]]
+
+
+def test_shared_intron_counted_once(tmpdir):
+
+    gtffile = str(tmpdir.join("genes.gtf"))
+    _write_gtf(gtffile, [
+        ("T1", "chr1", "+", [(100, 200), (300, 400)]),
+        ("T2", "chr1", "+", [(100, 200), (300, 400), (500, 600)]),
+        # the same intron annotated on the other strand on chr2
+        ("T3", "chr2", "+", [(100, 200), (300, 400)]),
+        ("T4", "chr2", "-", [(100, 200), (300, 400)])])
+
+    reads = [
+        # spliced at the shared intron
+        make_read("spliced", 0, 150, [(0, 50), (3, 100), (0, 50)]),
+        # across the exon-intron boundary of the shared intron
+        make_read("exon_intron", 0, 190, [(0, 20)]),
+        # across the intron-exon boundary of the shared intron
+        make_read("intron_exon", 0, 290, [(0, 20)]),
+        # across the exon-intron boundary of the unshared intron
+        make_read("exon_intron2", 0, 390, [(0, 20)]),
+        # chr2: across the start of the intron on both strands
+        make_read("both_strands", 1, 190, [(0, 20)])]
+
+    bamfile = write_bam(str(tmpdir.join("reads.bam")), reads,
+                        contigs=[("chr1", 1000), ("chr2", 1000)])
+
+    outfile = str(tmpdir.join("splicing_index.tsv"))
+    intron_outfile = str(tmpdir.join("introns.tsv"))
+    PipelineiCLIP.calculateSplicingIndex(bamfile, gtffile, outfile,
+                                         intron_outfile=intron_outfile)
+
+    totals = _read_table(outfile)[0]
+    assert totals["Exon_Exon"] == "1"
+    assert totals["Exon_Intron"] == "3"
+    assert totals["Intron_Exon"] == "1"
+
+    introns = dict(((row["contig"], row["start"], row["end"]), row)
+                   for row in _read_table(intron_outfile))
+
+    assert len(introns) == 3
+
+    shared = introns[("chr1", "200", "300")]
+    assert shared["strand"] == "+"
+    assert (shared["Exon_Exon"], shared["Exon_Intron"],
+            shared["Intron_Exon"]) == ("1", "1", "1")
+
+    unshared = introns[("chr1", "400", "500")]
+    assert (unshared["Exon_Exon"], unshared["Exon_Intron"],
+            unshared["Intron_Exon"]) == ("0", "1", "0")
+
+    conflicting = introns[("chr2", "200", "300")]
+    assert conflicting["strand"] == "."
+    assert (conflicting["Exon_Exon"], conflicting["Exon_Intron"],
+            conflicting["Intron_Exon"]) == ("0", "1", "0")
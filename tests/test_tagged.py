@@ -0,0 +1,75 @@
+''' Tests for the cell-tagged output of PipelineScRNASeq's UMI extractors,
+against the per-cell output they parallel '''
+
+import collections
+import gzip
+import random
+
+import PipelineScRNASeq
+
+
+def _read_fastq(filename):
+    with gzip.open(filename) as inf:
+        lines = inf.read().split("\n")
+    return [tuple(lines[i:i + 4]) for i in range(0, len(lines) - 1, 4)]
+
+
+def _read_summary(filename):
+    with open(filename) as inf:
+        return [line.rstrip("\n").split("\t") for line in inf]
+
+
+def test_tagged_matches_per_cell(tmpdir):
+
+    rng = random.Random(13)
+    barcodes = ["".join(rng.choice("ACGT") for j in range(6))
+                for i in range(5)]
+
+    UMI_fastq = gzip.open(str(tmpdir.join("sample_1.fastq.gz")), "w")
+    seq_fastq = gzip.open(str(tmpdir.join("sample_2.fastq.gz")), "w")
+
+    for i in range(500):
+        if rng.random() < 0.9:
+            cell = rng.choice(barcodes)
+        else:
+            cell = "NNNNNN"
+        UMI = "".join(rng.choice("ACGT") for j in range(10))
+        # a few bases below the quality thresholds
+        qual = "".join("5" if rng.random() < 0.02 else "I"
+                       for j in range(16))
+        UMI_fastq.write("@read%i 1\n%s\n+\n%s\n" % (i, cell + UMI, qual))
+        seq_fastq.write("@read%i 2\n%s\n+\n%s\n" % (
+            i, "ACGT" * 10, "I" * 40))
+
+    UMI_fastq.close()
+    seq_fastq.close()
+
+    for tagged in (False, True):
+        PipelineScRNASeq.extractUMIsAndFilterFastq(
+            str(tmpdir.join("sample_2.fastq.gz")),
+            str(tmpdir.join("sample_1.fastq.gz")),
+            barcodes, chunk_size=64, tagged=tagged)
+
+    prefix = str(tmpdir.join("sample"))
+
+    # each run writes its own summary
+    summary = _read_summary(prefix + "_filter_summary.tsv")
+    assert _read_summary(prefix + "_tagged_filter_summary.tsv") == summary
+
+    expected = collections.defaultdict(list)
+    for cell in barcodes:
+        if not tmpdir.join("sample_UMI_%s.fastq.gz" % cell).exists():
+            continue
+        for name, seq, plus, qual in _read_fastq(
+                prefix + "_UMI_%s.fastq.gz" % cell):
+            read_id, UMI = name.rsplit("_", 1)
+            expected[cell].append(("%s_%s_%s" % (read_id, cell, UMI),
+                                   seq, plus, qual))
+
+    tagged = collections.defaultdict(list)
+    for record in _read_fastq(prefix + "_tagged.fastq.gz"):
+        tagged[record[0].split("_")[-2]].append(record)
+
+    assert dict(tagged) == dict(expected)
+    assert sum(len(records) for records in tagged.values()) == \
+        int(dict(summary)["keep"])
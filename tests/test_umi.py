@@ -0,0 +1,150 @@
+''' Tests for iCLIP.umi, the single pass dedup with all the UMI-tools
+methods, against known results for each method and against grouping all
+the reads at each position at once '''
+
+import collections
+import random
+
+import pysam
+
+from iCLIP import umi
+
+from bam_helpers import make_read, write_bam
+
+
+def test_dedup_umis_known_set():
+
+    counts = {"AAAA": 100, "AAAT": 60, "AATT": 2, "CCCC": 10, "CCCG": 1}
+
+    selected, clusters = umi.dedup_umis(counts)
+
+    assert selected["unique"] == ["AAAA", "AAAT", "CCCC", "AATT", "CCCG"]
+    assert selected["percentile"] == selected["unique"]
+    # AAAA-AAAT-AATT and CCCC-CCCG are connected
+    assert selected["cluster"] == ["AAAA", "CCCC"]
+    # AATT is not adjacent to AAAA, so AAAT is needed to account for it
+    assert selected["adjacency"] == ["AAAA", "AAAT", "CCCC"]
+    # AAAT has too many reads to be an error from AAAA (100 < 2 * 60 - 1)
+    assert selected["directional"] == ["AAAA", "AAAT", "CCCC"]
+
+    assert sorted(sorted(component) for component, adjacency in clusters) \
+        == [["AAAA", "AAAT", "AATT"], ["CCCC", "CCCG"]]
+
+
+def test_dedup_umis_directional_and_percentile():
+
+    counts = {"AAAA": 100, "AAAT": 50, "AATT": 1, "GGGG": 1000,
+              "TTTT": 1000}
+
+    selected, clusters = umi.dedup_umis(counts)
+
+    # 100 >= 2 * 50 - 1, so AAAT is an error from AAAA
+    assert selected["directional"] == ["GGGG", "TTTT", "AAAA"]
+    # AATT has no more than 1% of the median count of 100
+    assert selected["percentile"] == ["GGGG", "TTTT", "AAAA", "AAAT"]
+
+    selected, clusters = umi.dedup_umis({"AAAA": 1}, ["unique", "cluster"])
+    assert selected == {"unique": ["AAAA"], "cluster": ["AAAA"]}
+
+
+def test_get_topology():
+
+    # a single UMI, a star around AAAA, and a chain
+    counts = {"TTTT": 1,
+              "AAAA": 10, "AAAC": 1, "AAAG": 1, "AACA": 1,
+              "CCCC": 10, "CCCG": 5, "CCGG": 2, "CGGG": 1}
+
+    selected, clusters = umi.dedup_umis(counts, ["cluster"])
+
+    topologies = dict((min(component), umi.get_topology(component,
+                                                        adjacency))
+                      for component, adjacency in clusters)
+
+    assert topologies == {"TTTT": "single node",
+                          "AAAA": "single hub",
+                          "CCCC": "complex"}
+
+
+def _random_reads(seed, n=2000):
+
+    rng = random.Random(seed)
+    umis = ["".join(rng.choice("ACGT") for i in range(5)) for j in range(20)]
+
+    reads = []
+    for i in range(n):
+        contig = rng.randrange(2)
+        pos = rng.randrange(100, 5000, 7)
+        cigar = [(0, 30)]
+        if rng.random() < 0.2:
+            cigar = [(4, rng.randint(1, 3)), (0, 30)]
+        name = "read%i_%s" % (i, rng.choice(umis[:rng.randint(1, 20)]))
+        reads.append(make_read(name, contig, pos, cigar,
+                               is_reverse=rng.random() < 0.5,
+                               mapq=rng.choice([10, 255])))
+    return reads
+
+
+def _naive_groups(bamfile):
+
+    groups = collections.defaultdict(collections.Counter)
+    for read in pysam.AlignmentFile(bamfile).fetch(until_eof=True):
+        position, is_reverse = umi.get_read_position(read)
+        groups[(read.reference_id, position, is_reverse)][
+            umi.get_umi(read)] += 1
+    return groups
+
+
+def test_grouper_matches_naive_grouping(tmpdir):
+
+    bamfile = write_bam(str(tmpdir.join("reads.bam")), _random_reads(1),
+                        contigs=[("chr1", 10000), ("chr2", 10000)])
+
+    grouper = umi.UMIGrouper(
+        pysam.AlignmentFile(bamfile).fetch(until_eof=True), window=50)
+
+    groups = {}
+    for contig, key, group in grouper:
+        position, is_reverse, cell = key
+        assert (contig, position, is_reverse) not in groups
+        groups[(contig, position, is_reverse)] = dict(group.counts)
+        for umi_seq, read in group.reads.items():
+            assert umi.get_umi(read) == umi_seq
+
+    assert groups == dict((key, dict(counts)) for key, counts in
+                          _naive_groups(bamfile).items())
+
+
+def test_dedup_bam(tmpdir):
+
+    bamfile = write_bam(str(tmpdir.join("reads.bam")), _random_reads(2),
+                        contigs=[("chr1", 10000), ("chr2", 10000)])
+
+    outfiles = dict((method, str(tmpdir.join("%s.bam" % method)))
+                    for method in umi.METHODS)
+    prefix = str(tmpdir.join("stats"))
+
+    counts = umi.dedup_bam(bamfile, outfiles, further_stats_prefix=prefix,
+                           window=50, seed=1)
+
+    expected = collections.Counter()
+    topologies = collections.Counter()
+    for key, group_counts in _naive_groups(bamfile).items():
+        selected, clusters = umi.dedup_umis(group_counts)
+        for method in umi.METHODS:
+            expected[method] += len(selected[method])
+        topologies.update(umi.get_topology(component, adjacency)
+                          for component, adjacency in clusters)
+
+    assert counts["input"] == 2000
+    for method in umi.METHODS:
+        reads = list(pysam.AlignmentFile(outfiles[method]))
+        assert len(reads) == counts[method] == expected[method]
+        positions = [(read.reference_id, read.pos) for read in reads]
+        assert positions == sorted(positions)
+
+    with open(prefix + "_topologies.tsv") as inf:
+        observed = dict((line.split("\t")[0], int(line.split("\t")[1]))
+                        for line in inf)
+
+    assert observed == dict(topologies)
+    assert set(observed) <= set(["single node", "single hub", "complex"])